@@ -0,0 +1,262 @@
+"""Offline benchmarks of the SSM core hot paths.
+
+Keys come from the signing test vectors and are restored in a temporary keys directory,
+transactions with many inputs are synthesized, so nothing touches /ssm-keys or the network.
+Results are written as JSON, one entry per benchmark with timings in seconds.
+
+Usage:
+python3 bench/bench.py [-o results.json] [-r REPEAT] [-i 1,10,100,1000] [-w WORKERS]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime, timezone
+from os import cpu_count, path
+from statistics import mean, median
+from time import perf_counter
+
+sys.path.insert(0, path.join(path.dirname(path.realpath(__file__)), '..'))
+
+import ssm.binary as binary
+import ssm.core as core
+import ssm.parallel as parallel
+from ssm.cache import DERIVATION_CACHE, MASTERKEY_CACHE
+from ssm.sighash import varint
+from ssm.util import get_masterkey_from_disk
+from cli.cli import cli
+from cli.client import SOCKET_ENV
+from cli.daemon import make_server
+
+ROOT_DIR = path.join(path.dirname(path.realpath(__file__)), '..')
+TESTS_DIR = path.join(ROOT_DIR, 'tests')
+BTC_VECTORS = path.join(TESTS_DIR, "sign_tx_btc_test_vectors.json")
+ELEMENTS_VECTORS = path.join(TESTS_DIR, "sign_tx_elements_test_vectors.json")
+
+BTC_CHAIN = 'bitcoin-regtest'
+ELEMENTS_CHAIN = 'elements-regtest'
+
+DERIVATION_DEPTHS = [1, 3, 5, 7]
+SIGN_INPUTS = [1, 10, 100, 1000]
+# Transactions of about 100 and 200 KB, sent to the JSON-RPC and the binary endpoints
+TRANSPORT_INPUTS = [2500, 5000]
+REPEAT = 5
+# Fast benchmarks are run in a loop so that each sample lasts long enough to be measured
+MIN_SAMPLE_TIME = 0.05
+
+# Amount of each synthetic input, and its explicit asset on Elements
+INPUT_VALUE = 100000
+ELEMENTS_ASSET = bytes(range(32))
+# P2WPKH script of the single output of the synthetic transactions
+OUTPUT_SCRIPT = bytes([0x00, 0x14]) + bytes(20)
+
+
+def load_case(filename, chain):
+    with open(filename) as f:
+        case = json.load(f)[chain][0]
+    return case["hdkeys"][0], case["master blinding key"][0] or None
+
+
+def make_tx(num_inputs, elements=False):
+    """Unsigned transaction spending num_inputs distinct outpoints to a single output
+    """
+    tx = (2).to_bytes(4, 'little')
+    if elements:
+        tx += b'\x00'
+    tx += varint(num_inputs)
+    for i in range(num_inputs):
+        tx += i.to_bytes(32, 'little') + (0).to_bytes(4, 'little') + b'\x00' + b'\xff' * 4
+    tx += varint(1)
+    value = INPUT_VALUE * num_inputs - 1000
+    if elements:
+        tx += b'\x01' + ELEMENTS_ASSET + b'\x01' + value.to_bytes(8, 'big') + b'\x00'
+    else:
+        tx += value.to_bytes(8, 'little')
+    tx += varint(len(OUTPUT_SCRIPT)) + OUTPUT_SCRIPT
+    tx += (0).to_bytes(4, 'little')
+    return tx.hex()
+
+
+def make_inputs(fingerprint, num_inputs, elements=False):
+    if elements:
+        value = (b'\x01' + INPUT_VALUE.to_bytes(8, 'big')).hex()
+    else:
+        value = INPUT_VALUE
+    return [{"fingerprint": fingerprint, "path": f"0h/0h/{i}h", "value": value} for i in range(num_inputs)]
+
+
+def json_round_trip(chain, tx, inputs, signed_tx):
+    """What the JSON-RPC sign_tx_v2 adds to signing: encoding and decoding the request and the response,
+    with the transactions as hex. Return the sizes of the request and of the response.
+    """
+    request = json.dumps({"jsonrpc": "2.0", "method": "sign_tx_v2", "params": [chain, tx.hex(), inputs, 1], "id": 1})
+    bytes.fromhex(json.loads(request)["params"][1])
+    response = json.dumps({"jsonrpc": "2.0", "result": {"chain": chain, "signed_tx": signed_tx.hex()}, "id": 1})
+    bytes.fromhex(json.loads(response)["result"]["signed_tx"])
+    return len(request), len(response)
+
+
+def binary_round_trip(chain, tx, inputs, signed_tx):
+    """Same as json_round_trip for the binary sign_tx endpoint, the response is the raw signed tx
+    """
+    request = binary.pack_request({"chain": chain, "inputs": inputs, "sighash": 1}, tx)
+    binary.unpack_request(request)
+    return len(request), len(signed_tx)
+
+
+def measure(fn, repeat, setup=None):
+    """Return the per call timings of fn, over repeat samples
+    """
+    loops = 1
+    while True:
+        if setup:
+            setup()
+        start = perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = perf_counter() - start
+        if elapsed >= MIN_SAMPLE_TIME or setup is not None:
+            break
+        loops *= 10
+
+    samples = [elapsed / loops]
+    for _ in range(repeat - 1):
+        if setup:
+            setup()
+        start = perf_counter()
+        for _ in range(loops):
+            fn()
+        samples.append((perf_counter() - start) / loops)
+    return samples
+
+
+def result(name, params, samples):
+    return {
+        "name": name,
+        "params": params,
+        "runs": len(samples),
+        "min": min(samples),
+        "median": median(samples),
+        "mean": mean(samples),
+        "ops_per_sec": 1 / median(samples) if median(samples) else None,
+    }
+
+
+def clear_caches():
+    MASTERKEY_CACHE.clear()
+    DERIVATION_CACHE.clear()
+
+
+def run(keys_dir, repeat=REPEAT, sign_inputs=SIGN_INPUTS, log=None):
+    results = []
+
+    def bench(name, params, fn, setup=None):
+        samples = measure(fn, repeat, setup)
+        results.append(result(name, params, samples))
+        if log:
+            log(f"{name} {params}: {median(samples) * 1000:.3f} ms")
+
+    btc_hdkey, _ = load_case(BTC_VECTORS, BTC_CHAIN)
+    el_hdkey, el_bkey = load_case(ELEMENTS_VECTORS, ELEMENTS_CHAIN)
+    btc_fp = core.restore_hd_wallet(BTC_CHAIN, btc_hdkey, None, keys_dir)
+    el_fp = core.restore_hd_wallet(ELEMENTS_CHAIN, el_hdkey, el_bkey, keys_dir)
+
+    # master key load, from disk and from the cache
+    bench("masterkey_load", {"cache": "cold"},
+            lambda: get_masterkey_from_disk(BTC_CHAIN, btc_fp, False, keys_dir), clear_caches)
+    bench("masterkey_load", {"cache": "warm"},
+            lambda: get_masterkey_from_disk(BTC_CHAIN, btc_fp, False, keys_dir))
+
+    # derivation at several depths, from the master key and from cached ancestors
+    for depth in DERIVATION_DEPTHS:
+        derivation_path = "/".join(["0h"] * (depth - 1) + ["0"])
+        bench("derive_path", {"depth": depth, "cache": "cold"},
+                lambda: core.get_child_from_path(BTC_CHAIN, btc_fp, derivation_path, keys_dir), clear_caches)
+        bench("derive_path", {"depth": depth, "cache": "warm"},
+                lambda: core.get_child_from_path(BTC_CHAIN, btc_fp, derivation_path, keys_dir))
+
+    # single addresses, and ranges of addresses
+    for chain, fingerprint in [(BTC_CHAIN, btc_fp), (ELEMENTS_CHAIN, el_fp)]:
+        bench("new_address", {"chain": chain},
+                lambda: core.get_address_from_path(chain, fingerprint, "84h/1h/0h/0/0", keys_dir))
+        bench("new_addresses", {"chain": chain, "count": 100},
+                lambda: core.get_addresses_from_path(chain, fingerprint, "84h/1h/0h/0", 0, 100, keys_dir))
+
+    # confidential address construction alone, from an already derived child
+    child = core.get_child_from_path(ELEMENTS_CHAIN, el_fp, "84h/1h/0h/0/0", keys_dir)
+    bench("confidential_address", {"chain": ELEMENTS_CHAIN},
+            lambda: core.get_address_from_child(ELEMENTS_CHAIN, el_fp, child, keys_dir))
+
+    # signing, keys derived from scratch for each sample
+    for chain, fingerprint, elements in [(BTC_CHAIN, btc_fp, False), (ELEMENTS_CHAIN, el_fp, True)]:
+        for num_inputs in sign_inputs:
+            tx = make_tx(num_inputs, elements)
+            inputs = make_inputs(fingerprint, num_inputs, elements)
+            bench("sign_tx_v2", {"chain": chain, "inputs": num_inputs, "workers": parallel.SIGN_WORKERS},
+                    lambda: core.sign_tx_v2(chain, tx, inputs, dir=keys_dir), clear_caches)
+
+    # transport of large transactions, as JSON with hex and through the binary endpoints.
+    # Signing itself is the same for both, it's measured above
+    for chain, fingerprint, elements in [(BTC_CHAIN, btc_fp, False), (ELEMENTS_CHAIN, el_fp, True)]:
+        for num_inputs in TRANSPORT_INPUTS:
+            tx = bytes.fromhex(make_tx(num_inputs, elements))
+            inputs = make_inputs(fingerprint, num_inputs, elements)
+            signed_tx = core.sign_tx_v2(chain, tx, inputs, dir=keys_dir)
+            for transport, round_trip in [("json", json_round_trip), ("binary", binary_round_trip)]:
+                request_size, response_size = round_trip(chain, tx, inputs, signed_tx)
+                bench("sign_tx_transport", {"chain": chain, "inputs": num_inputs, "transport": transport,
+                                            "request_bytes": request_size, "response_bytes": response_size},
+                        lambda: round_trip(chain, tx, inputs, signed_tx))
+
+    # ssm-cli startup, with the command run in a new process and forwarded to a daemon
+    command = [sys.executable, '-m', 'cli.client', '--help']
+    env = {k: v for k, v in os.environ.items() if k != SOCKET_ENV}
+    bench("cli_startup", {"daemon": False},
+            lambda: subprocess.run(command, cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, check=True))
+    server = make_server(cli, path.join(keys_dir, 'ssm-cli.sock'))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    env[SOCKET_ENV] = server.server_address
+    bench("cli_startup", {"daemon": True},
+            lambda: subprocess.run(command, cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, check=True))
+    server.shutdown()
+    server.server_close()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SSM core hot paths")
+    parser.add_argument('-o', '--output', help="Write the JSON results to this file instead of stdout")
+    parser.add_argument('-r', '--repeat', type=int, default=REPEAT, help="Number of samples of each benchmark")
+    parser.add_argument('-i', '--inputs', default=",".join(str(n) for n in SIGN_INPUTS),
+                        help="Comma separated numbers of inputs of the signed transactions")
+    parser.add_argument('-w', '--workers', type=int, default=0, help="Number of signing worker processes")
+    args = parser.parse_args()
+
+    parallel.configure(workers=args.workers)
+    sign_inputs = [int(n) for n in args.inputs.split(",")]
+    log = lambda line: print(line, file=sys.stderr)
+    with tempfile.TemporaryDirectory() as keys_dir:
+        results = run(keys_dir, args.repeat, sign_inputs, log)
+    parallel.shutdown()
+
+    report = {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
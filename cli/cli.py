@@ -1,21 +1,19 @@
 import click
 import json
 import logging
+import os
 import sys
 from collections import namedtuple
 
-import ssm.exceptions as exceptions
-import ssm.core as ssm
+# Only the modules needed to parse the command line are imported here: ssm.core and the like
+# import wally and take most of the startup time, commands import what they use themselves
+from cli.client import SOCKET_ENV, DEFAULT_SOCKET
 
-from ssm.connect import (
-    ConnCtx,
-    BITCOIN_REGTEST_RPC_PORT,
-    LIQUID_REGTEST_RPC_PORT
-)
-
-from ssm.util import (
+from ssm.constants import (
     CHAINS,
-    set_logging,
+    EXPORT_FORMATS,
+    IMPORT_BATCH,
+    JSON_RESPONSE_FORMATS,
 )
 
 def critical(title='', message='', start_over=True):
@@ -28,7 +26,18 @@ def critical(title='', message='', start_over=True):
         sys.exit(1)
 
 
-ConnParams = namedtuple('ConnParams', ['chain', 'password'])
+def set_logging(verbose):
+    """Set logging level
+    """
+
+    logging.basicConfig(format='SSM %(levelname)s %(message)s')
+    if verbose == 1:
+        logging.root.setLevel(logging.INFO)
+    elif verbose > 1:
+        logging.root.setLevel(logging.DEBUG)
+
+
+ConnParams = namedtuple('ConnParams', ['chain', 'password', 'index_addresses'])
 
 
 @click.group()
@@ -38,9 +47,11 @@ ConnParams = namedtuple('ConnParams', ['chain', 'password'])
                 help='Key to unlock the private keys.')
 @click.option('-v', '--verbose', count=True,
               help='Print more information, may be used multiple times.')
+@click.option('--index-addresses', is_flag=True, envvar='SSM_INDEX_ADDRESSES',
+                help='Add the generated addresses to the address index of the keys dir, for find-address.')
 @click.version_option()
 @click.pass_context
-def cli(ctx, verbose, chain, password):
+def cli(ctx, verbose, chain, password, index_addresses):
     """Crypto SSM Command-Line Interface
     """
 
@@ -48,7 +59,7 @@ def cli(ctx, verbose, chain, password):
 
     logging.info(f"Working on {chain}")
     
-    ctx.obj = ConnParams(chain, password)
+    ctx.obj = ConnParams(chain, password, index_addresses)
 
 
 @cli.command(short_help='Generate a new seed and master key for the chain')
@@ -67,6 +78,8 @@ def new_master(obj, entropy, isbytes, size):
 
     logging.info(f"Generating a new master key for {obj.chain}.")
 
+    import ssm.core as ssm
+
     fingerprint = ssm.generate_new_hd_wallet(obj.chain, entropy, isbytes, size)
 
     click.echo(fingerprint)
@@ -88,6 +101,11 @@ def new_address(obj, fingerprint, path):
 
     logging.info(f"Generating a new address for {obj.chain} and master key {fingerprint}.")
 
+    import ssm.address_index as address_index
+    import ssm.core as ssm
+
+    address_index.configure(obj.index_addresses)
+
     address, pubkey, bkey = ssm.get_address_from_path(obj.chain, fingerprint, path)
 
     return_value = {
@@ -100,6 +118,100 @@ def new_address(obj, fingerprint, path):
 
     click.echo(json.dumps(return_value))
 
+@cli.command(short_help='Generate a range of addresses for chain and master key')
+@click.argument('fingerprint')
+@click.argument('account_path')
+@click.option('-s', '--start', default=0, type=int,
+                help='Index of the first address of the range (default = 0).')
+@click.option('-n', '--count', default=1, type=int,
+                help='Number of addresses to generate (default = 1).')
+@click.pass_obj
+def new_addresses(obj, fingerprint, account_path, start, count):
+    """Get a range of new addresses for a said chain and masterkey.
+    The account node at account_path is derived only once, and the addresses are its 
+    children from index start to start + count - 1.
+    Return value is a list of the same objects as new-address, along with the path of each address.
+    """
+
+    logging.info(f"Generating {count} addresses for {obj.chain} and master key {fingerprint} "
+                    f"from {account_path}/{start}.")
+
+    import ssm.address_index as address_index
+    import ssm.core as ssm
+
+    address_index.configure(obj.index_addresses)
+
+    addresses = ssm.get_addresses_from_path(obj.chain, fingerprint, account_path, start, count)
+
+    return_value = []
+    for path, address, pubkey, bkey in addresses:
+        item = {
+            'path': path,
+            'address': address,
+            'pubkey': bytes(pubkey).hex()
+        }
+        if bkey is not None:
+            item['blinding_key'] = bytes(bkey).hex()
+        return_value.append(item)
+
+    click.echo(json.dumps(return_value))
+
+@cli.command(short_help='Stream a range of addresses as JSON lines, or as import requests')
+@click.argument('fingerprint')
+@click.argument('account_path')
+@click.option('-s', '--start', default=0, type=int,
+                help='Index of the first address of the range (default = 0).')
+@click.option('-n', '--count', default=1, type=int,
+                help='Number of addresses to export (default = 1).')
+@click.option('-f', '--format', 'export_format', default='ndjson', type=click.Choice(EXPORT_FORMATS),
+                help='One address per line, or batches of importmulti/importdescriptors requests (default = ndjson).')
+@click.option('-b', '--batch-size', default=IMPORT_BATCH, type=int,
+                help=f'Number of import requests per line (default = {IMPORT_BATCH}).')
+@click.option('--timestamp', default='now',
+                help='Rescan timestamp of the import requests, "now" or a unix time (default = now).')
+@click.option('--label', default=None,
+                help='Label of the imported addresses.')
+@click.option('-o', '--output', default='-', type=click.File('w'),
+                help='File to write to (default = stdout).')
+@click.pass_obj
+def export_addresses(obj, fingerprint, account_path, start, count, export_format, batch_size, timestamp, label, output):
+    """Export a range of addresses for a said chain and masterkey, without any limit on count.
+    The account node at account_path is derived only once, and addresses are written as they are
+    derived, so memory use is the same for any count.
+    With the ndjson format, each line is an object like those of new-addresses.
+    With the importmulti and importdescriptors formats, each line is a JSON array of watch-only
+    import requests that can be passed to the rpc of the same name of bitcoind or elementsd.
+    """
+
+    logging.info(f"Exporting {count} addresses for {obj.chain} and master key {fingerprint} "
+                    f"from {account_path}/{start} as {export_format}.")
+
+    import ssm.export as export
+
+    if timestamp != 'now':
+        timestamp = int(timestamp)
+
+    for line in export.iter_export(obj.chain, fingerprint, account_path, start, count, export_format,
+                                    batch_size, timestamp, label):
+        output.write(line)
+
+@cli.command(short_help='Find the master key and path of an address we generated')
+@click.argument('address')
+@click.pass_obj
+def find_address(obj, address):
+    """Find which master key and derivation path an address belongs to.
+    Addresses generated with --index-addresses are added to an index in the keys dir.
+    Return value is the fingerprint of the master key and the path of the address.
+    """
+
+    logging.info(f"Looking up the key of {address} on {obj.chain}.")
+
+    import ssm.core as ssm
+
+    fingerprint, path = ssm.get_path_from_address(obj.chain, address)
+
+    click.echo(json.dumps({'fingerprint': fingerprint, 'path': path}))
+
 @cli.command(short_help='Get the extended public key (xpub) that corresponds to some master key.')
 @click.argument('fingerprint')
 @click.option('-p', '--path', default="root")
@@ -114,19 +226,34 @@ def get_xpub(obj, fingerprint, path):
 
     logging.info(f"Getting the xpub for {obj.chain} and master key {fingerprint} on path {path}.")
 
+    import ssm.core as ssm
+
     xpub = ssm.get_xpub(obj.chain, fingerprint, path)
 
     logging.debug(f"{obj.chain} {fingerprint} masterkey's xpub on {path} is {xpub}")
 
     click.echo(xpub)
 
+def echo_signed(signed):
+    """Print a signed tx or base64 signatures as is, and JSON signatures as a JSON array"""
+    logging.debug(f"signed is {signed}")
+    if isinstance(signed, list):
+        signed = json.dumps(signed)
+    click.echo(signed)
+
 @cli.command(short_help='Sign all or some inputs of a serialized transaction.')
 @click.argument('transaction')
 @click.argument('fingerprints')
 @click.argument('paths')
 @click.argument('values')
+@click.option('-w', '--workers', default=0, type=int,
+                help='Number of processes signing inputs in parallel (default = 0, sign serially).')
+@click.option('-t', '--threshold', default=None, type=int,
+                help='Minimum number of inputs to sign before signing in parallel.')
+@click.option('-r', '--response', default='tx', type=click.Choice(JSON_RESPONSE_FORMATS),
+                help='Return the signed tx, or only the new signatures as JSON or a base64 blob (default = tx).')
 @click.pass_obj
-def sign_tx(obj, transaction, fingerprints, paths, values):
+def sign_tx(obj, transaction, fingerprints, paths, values, workers, threshold, response):
     """Take an unsigned, complete transaction, and return it signed and ready for broadcast.
     For each fingerprint, we need one path, but a fingerprint can be repeated as many time as necessary.
     SSM will take the fingerprint and the paths in the provided order, derivate the private key and try
@@ -137,8 +264,99 @@ def sign_tx(obj, transaction, fingerprints, paths, values):
 
     #logging.info(f"Signing tx {get_txid(transaction)} for {obj.chain}.")
 
-    signed_tx = ssm.sign_tx(obj.chain, transaction, fingerprints, paths, values)
+    import ssm.core as ssm
+    import ssm.parallel as parallel
+
+    parallel.configure(workers=workers, threshold=threshold)
+
+    signed = ssm.sign_tx(obj.chain, transaction, fingerprints, paths, values, response=response)
+
+    echo_signed(signed)
+
+@cli.command(short_help='Sign all or some inputs of a serialized transaction, inputs described in JSON.')
+@click.argument('transaction')
+@click.argument('inputs')
+@click.option('-s', '--sighash', default=1, type=int,
+                help='Sighash type of the signatures (default = 1, SIGHASH_ALL).')
+@click.option('-w', '--workers', default=0, type=int,
+                help='Number of processes signing inputs in parallel (default = 0, sign serially).')
+@click.option('-t', '--threshold', default=None, type=int,
+                help='Minimum number of inputs to sign before signing in parallel.')
+@click.option('-r', '--response', default='tx', type=click.Choice(JSON_RESPONSE_FORMATS),
+                help='Return the signed tx, or only the new signatures as JSON or a base64 blob (default = tx).')
+@click.pass_obj
+def sign_tx_v2(obj, transaction, inputs, sighash, workers, threshold, response):
+    """Take an unsigned, complete transaction, and return it signed and ready for broadcast.
+    INPUTS is a JSON array with one object per input of the transaction, in the same order:
+    {"fingerprint": "a2ef94f8", "path": "0h/0h/270h", "value": 100000000, "skip": false}
+    Value is an amount in satoshis, or a hex value commitment on Elements.
+    Inputs with skip set to true, or that already have a witness, are left untouched.
+    With -r signatures or -r base64, only the new signatures are returned, see the README.
+    """
+
+    import ssm.core as ssm
+    import ssm.parallel as parallel
+
+    parallel.configure(workers=workers, threshold=threshold)
+
+    signed = ssm.sign_tx_v2(obj.chain, transaction, json.loads(inputs), sighash, response=response)
+
+    echo_signed(signed)
+
+@cli.command(short_help='Sign the inputs of a PSBT that spend our keys.')
+@click.argument('psbt')
+@click.option('-w', '--workers', default=0, type=int,
+                help='Number of processes signing inputs in parallel (default = 0, sign serially).')
+@click.option('-t', '--threshold', default=None, type=int,
+                help='Minimum number of inputs to sign before signing in parallel.')
+@click.option('-r', '--response', default='signatures', type=click.Choice(JSON_RESPONSE_FORMATS[1:]),
+                help='Return the signatures as JSON or as a base64 blob (default = signatures).')
+@click.pass_obj
+def sign_psbt(obj, psbt, workers, threshold, response):
+    """Sign a base64 PSBT, or a PSET on Elements, with the values and key paths it contains.
+    Inputs are signed for each BIP32 derivation from one of our master keys, if they spend
+    the P2WPKH output of that key and don't have its signature yet.
+    Return value is a JSON array of the new partial signatures:
+    {"index": 0, "pubkey": "02...", "signature": "3044...01"}
+    """
+
+    import ssm.core as ssm
+    import ssm.parallel as parallel
+
+    parallel.configure(workers=workers, threshold=threshold)
+
+    signatures = ssm.sign_psbt(obj.chain, psbt, response=response)
+
+    echo_signed(signatures)
+
+@cli.command(short_help='Move the keys to a single file keystore.')
+def migrate_keystore():
+    """Copy all the master keys and master blinding keys of the keys dir to a single file keystore.
+    Keys are then read from and saved to the keystore only. Old key files are left untouched, 
+    they can be removed once the keystore has been checked.
+    Return value is the number of keys migrated.
+    """
+
+    logging.info("Migrating the keys dir to a single file keystore.")
+
+    import ssm.util as ssm_util
+
+    count = ssm_util.migrate_to_keystore()
+
+    logging.info(f"{count} keys migrated to the keystore")
+
+    click.echo(count)
+
+@cli.command(short_help='Run the commands of ssm-cli clients in a long-lived process.')
+@click.option('-s', '--socket', 'socket_path', default=None,
+                help=f'Unix socket to listen on (default = ${SOCKET_ENV}, or {DEFAULT_SOCKET}).')
+def daemon(socket_path):
+    """Listen on a unix socket and run the commands of ssm-cli, one at a time, until interrupted.
+    When SSM_CLI_SOCKET is set to the same socket, ssm-cli forwards its commands to the daemon
+    instead of running them, which saves the startup of the interpreter modules and the loading
+    of the keys on each call.
+    """
 
-    logging.debug(f"signed tx is {signed_tx}")
+    from cli.daemon import serve
 
-    click.echo(signed_tx)
+    serve(cli, socket_path or os.environ.get(SOCKET_ENV, DEFAULT_SOCKET))
@@ -0,0 +1,83 @@
+"""Entry point of ssm-cli.
+
+If SSM_CLI_SOCKET is set and an `ssm-cli daemon` listens on it, the command is run by the daemon
+and this process only forwards its arguments and output. The interpreter then doesn't import
+click, wally or ssm, and the keys stay cached in the daemon between calls. Otherwise, or if the
+daemon can't be reached, the command runs in this process as usual.
+
+This module must only import the standard library, so that forwarding stays cheap.
+"""
+import json
+import os
+import socket
+import sys
+
+# Path of the unix socket of the daemon, commands are only forwarded if it's set
+SOCKET_ENV = 'SSM_CLI_SOCKET'
+DEFAULT_SOCKET = '/ssm-keys/ssm-cli.sock'
+# Options of the cli group that take a value, keep in sync with cli.cli
+GROUP_VALUE_OPTIONS = ['-c', '--chain', '-p', '--password']
+
+
+def connect(socket_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        raise
+    return client
+
+
+def get_command(args):
+    """Name of the subcommand in args, after the options of the cli group, or None if there is none.
+    The value of an option, such as a password, may be the name of a command too.
+    """
+    args = iter(args)
+    for arg in args:
+        if arg == '--':
+            return next(args, None)
+        if not arg.startswith('-'):
+            return arg
+        if arg in GROUP_VALUE_OPTIONS:
+            next(args, None)
+    return None
+
+
+def forward(client, args, stdout=sys.stdout, stderr=sys.stderr):
+    """Run a command in the daemon, write its output as it comes and return its exit code.
+    The request is a JSON line, the response JSON lines of output followed by the exit code.
+    """
+    with client:
+        client.sendall((json.dumps({'args': args, 'cwd': os.getcwd()}) + '\n').encode())
+        with client.makefile('r', encoding='utf-8') as response:
+            for line in response:
+                frame = json.loads(line)
+                if 'exit' in frame:
+                    return frame['exit']
+                if 'stdout' in frame:
+                    stdout.write(frame['stdout'])
+                else:
+                    stderr.write(frame['stderr'])
+    # The command may have done part of its work, running it again here wouldn't be safe
+    stderr.write("Error: the ssm-cli daemon closed the connection before the end of the command.\n")
+    return 1
+
+
+def main():
+    args = sys.argv[1:]
+    socket_path = os.environ.get(SOCKET_ENV)
+    if socket_path and get_command(args) != 'daemon':
+        try:
+            client = connect(socket_path)
+        except OSError:
+            client = None
+        if client is not None:
+            sys.exit(forward(client, args))
+
+    from cli.cli import cli
+    cli(prog_name='ssm-cli')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Long-lived ssm-cli process, running the commands forwarded by cli.client.
+
+Commands are run one at a time, in the daemon process, with their output sent back to the client
+as it's written. Logs go to the stderr of the daemon.
+"""
+import io
+import json
+import logging
+import os
+import socketserver
+import sys
+
+import click
+
+from cli.client import connect, get_command
+
+
+class FrameWriter(io.RawIOBase):
+    """Binary stream sending what's written to it to the client, as JSON lines"""
+
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.wfile.write((json.dumps({self.name: bytes(b).decode('utf-8', 'replace')}) + '\n').encode())
+        return len(b)
+
+
+def run(cli, args, stdout, stderr):
+    """Run a command of the cli group with its output written to stdout and stderr, return its exit code
+    """
+    saved = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = stdout, stderr
+    # -v only applies to the command that sets it
+    logging.root.setLevel(logging.WARNING)
+    try:
+        rv = cli.main(args, prog_name='ssm-cli', standalone_mode=False)
+        # --help and the like return their exit code, commands return None
+        return rv if isinstance(rv, int) else 0
+    except click.ClickException as e:
+        e.show(file=stderr)
+        return e.exit_code
+    except click.Abort:
+        stderr.write("Aborted!\n")
+        return 1
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        logging.exception(f"Command {args} failed")
+        stderr.write(f"Error: {e}\n")
+        return 1
+    finally:
+        stdout.flush()
+        stderr.flush()
+        sys.stdout, sys.stderr = saved
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Someone checking that we are listening
+            return
+        request = json.loads(line)
+        args = request['args']
+        stdout = io.TextIOWrapper(FrameWriter(self.wfile, 'stdout'), encoding='utf-8')
+        stderr = io.TextIOWrapper(FrameWriter(self.wfile, 'stderr'), encoding='utf-8', line_buffering=True)
+        if get_command(args) == 'daemon':
+            stderr.write("Error: the daemon can't start another daemon.\n")
+            code = 2
+        else:
+            # Relative paths of the command are the client's, the daemon then goes back to its own dir
+            cwd = os.getcwd()
+            try:
+                os.chdir(request.get('cwd') or '/')
+                code = run(self.server.cli, args, stdout, stderr)
+            finally:
+                os.chdir(cwd)
+        self.wfile.write((json.dumps({'exit': code}) + '\n').encode())
+
+
+def make_server(cli, socket_path):
+    """Listen on socket_path, the caller then calls serve_forever and server_close
+    """
+    try:
+        connect(socket_path).close()
+    except OSError:
+        pass
+    else:
+        raise click.ClickException(f"A daemon is already listening on {socket_path}.")
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    # The daemon can use the keys, only its user may talk to it
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, CommandHandler)
+    finally:
+        os.umask(umask)
+    server.cli = cli
+    return server
+
+
+def serve(cli, socket_path):
+    """Answer the commands sent to socket_path until interrupted
+    """
+    # Logs of all the commands go to our own stderr, not to the clients
+    logging.basicConfig(format='SSM %(levelname)s %(message)s')
+    server = make_server(cli, socket_path)
+    logging.info(f"ssm-cli daemon listening on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
@@ -1,12 +1,26 @@
 from flask_jsonrpc import JSONRPC
 
 g_api = None
+g_endpoint = None
+# name -> (function, can be dispatched concurrently with other calls of a batch)
+g_methods = {}
 
 def jsonrpc(app=None, endpoint=None):
-  global g_api
+  global g_api, g_endpoint
 
   # initialize global api instance
   if not g_api:
     g_api = JSONRPC(app, endpoint, enable_web_browsable_api=False)
+    g_endpoint = endpoint
 
   return g_api
+
+def method(name, concurrent=True):
+  """Register a JSON-RPC method, and keep track of it for batch requests.
+  Batched calls go through the same parameter type checks as single calls.
+  """
+  def decorator(fn):
+    checked = jsonrpc().method(name)(fn)
+    g_methods[name] = (checked, concurrent)
+    return checked
+  return decorator
@@ -0,0 +1,123 @@
+import inspect
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, request
+
+import api
+import executor
+
+# Max number of calls in a single batch request
+MAX_BATCH_SIZE = 1000
+# Number of calls of a batch dispatched at the same time
+BATCH_THREADS = 32
+
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+# A batch is a JSON array, only these requests are decoded here
+BATCH_START = re.compile(rb'[ \t\n\r]*\[')
+
+_pool = ThreadPoolExecutor(max_workers=BATCH_THREADS)
+
+
+def error(code, message, data=None):
+    error = {'code': code, 'message': message}
+    if data is not None:
+        error['data'] = data
+    return error
+
+def response(call, result=None, error=None):
+    response = {'jsonrpc': '2.0', 'id': call.get('id') if isinstance(call, dict) else None}
+    if error is None:
+        response['result'] = result
+    else:
+        response['error'] = error
+    return response
+
+def call_method(call, client=None):
+    """Run a single call of a batch, errors are returned in the response instead of raised.
+    client is the name the client of the batch gave, calls may run on other threads.
+    """
+    executor.set_client(client)
+    if not isinstance(call, dict) or not isinstance(call.get('method'), str):
+        return response(call, error=error(INVALID_REQUEST, 'Invalid Request'))
+    method = api.g_methods.get(call['method'])
+    if method is None:
+        return response(call, error=error(METHOD_NOT_FOUND, 'Method not found', {'method': call['method']}))
+
+    fn = method[0]
+    params = call.get('params', [])
+    try:
+        if isinstance(params, list):
+            args = inspect.signature(fn).bind(*params)
+        elif isinstance(params, dict):
+            args = inspect.signature(fn).bind(**params)
+        else:
+            return response(call, error=error(INVALID_PARAMS, 'Invalid params'))
+    except TypeError as e:
+        return response(call, error=error(INVALID_PARAMS, 'Invalid params', {'message': str(e)}))
+
+    try:
+        result = fn(*args.args, **args.kwargs)
+    except TypeError as e:
+        # Parameters of the wrong type, like flask_jsonrpc answers single calls
+        return response(call, error=error(INVALID_PARAMS, 'Invalid params', {'message': str(e)}))
+    except Exception as e:
+        logging.exception(f"Error in batched {call['method']}")
+        return response(call, error=error(SERVER_ERROR, 'Server error', 
+                                            {'message': str(e), 'type': type(e).__name__}))
+    return response(call, result)
+
+def dispatch(batch):
+    """Dispatch all the calls of a batch and return their responses in the same order.
+    Calls of concurrent methods are run at the same time, the others one after the other.
+    Notifications (calls without id) get no response.
+    """
+    results = [None] * len(batch)
+    futures = {}
+    client = executor.get_client()
+    for i, call in enumerate(batch):
+        method = api.g_methods.get(call.get('method')) if isinstance(call, dict) else None
+        if method is not None and method[1]:
+            futures[i] = _pool.submit(call_method, call, client)
+        else:
+            results[i] = call_method(call, client)
+    for i, future in futures.items():
+        results[i] = future.result()
+
+    return [result for call, result in zip(batch, results)
+                if not (isinstance(call, dict) and 'id' not in call)]
+
+def handle_batch():
+    """before_request hook answering JSON-RPC batch requests (arrays of calls) on the api endpoint.
+    Single calls are left to flask_jsonrpc, without decoding their body here.
+    """
+    if request.method != 'POST' or request.path.rstrip('/') != api.g_endpoint:
+        return None
+    data = request.get_data()
+    if not BATCH_START.match(data):
+        return None
+    try:
+        batch = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(batch, list):
+        return None
+
+    if len(batch) == 0:
+        return Response(json.dumps(response(None, error=error(INVALID_REQUEST, 'Invalid Request'))),
+                        mimetype='application/json')
+    if len(batch) > MAX_BATCH_SIZE:
+        message = f"Batch can't have more than {MAX_BATCH_SIZE} calls."
+        return Response(json.dumps(response(None, error=error(INVALID_REQUEST, 'Invalid Request', 
+                                                                {'message': message}))),
+                        mimetype='application/json')
+
+    responses = dispatch(batch)
+    if not responses:
+        return Response(status=204)
+    return Response(json.dumps(responses), mimetype='application/json')
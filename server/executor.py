@@ -0,0 +1,257 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from time import perf_counter
+
+import ssm.address_index as address_index
+import ssm.exceptions as exceptions
+import ssm.metrics as metrics
+import ssm.parallel as parallel
+from ssm.scheduler import Scheduler, LANES, DEFAULT_LANE, DEFAULT_WEIGHT
+
+# Number of processes doing the CPU bound work of the handlers
+POOL_SIZE = cpu_count()
+
+# Max number of calls of a method processed at the same time, the others wait for their turn
+METHOD_LIMITS = {
+    'new_master': 1,
+    'new_address': 2 * POOL_SIZE,
+    'new_addresses': POOL_SIZE,
+    # refills of the address pool, or single addresses when it's empty
+    'derive_addresses': POOL_SIZE,
+    'sign_tx': POOL_SIZE,
+    'sign_tx_v2': POOL_SIZE,
+    'sign_psbt': POOL_SIZE,
+}
+DEFAULT_LIMIT = POOL_SIZE
+
+# Priority lane of each method, for clients that don't have their own, see ssm.scheduler
+METHOD_LANES = {
+    'new_master': 'low',
+    'new_addresses': 'low',
+}
+# Lane and weight of each client, that names itself with the X-SSM-Client header, e.g.
+# {'withdrawals': ('high', 4), 'consolidation': ('low', 1)}. Calls without a name, or with a name that
+# isn't one of these, are queued per method, so that made up names don't get their own queue and limits.
+CLIENTS = {}
+# Signing methods run in the request thread: the tx is decoded and its sighash engine built, and the keys
+# derived, there. Only their signing chunks are sent to the workers, so that a large transaction doesn't
+# hold a worker for long
+CHUNKED_METHODS = ['sign_tx', 'sign_tx_v2', 'sign_psbt']
+# Number of inputs signed by each chunk
+SIGN_CHUNK = 64
+
+# How long (in seconds) a call waits for its turn before we answer that the server is busy
+QUEUE_TIMEOUT = 30
+
+_pool = None
+_pool_size = 0
+_scheduler = None
+_lock = threading.Lock()
+_methods = {}
+# client name and method of the call the current thread is serving
+_context = threading.local()
+
+
+class MethodStats(object):
+    """Concurrency limit and counters of a single method"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        # The limit applies to each client, so that one of them can't hold all the calls of a method
+        self.semaphores = {}
+        self.waiting = 0
+        self.running = 0
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def to_dict(self):
+        return {
+            'limit': self.limit,
+            'waiting': self.waiting,
+            'running': self.running,
+            'calls': self.calls,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'avg_latency': self.total_latency / self.calls if self.calls else 0.0,
+            'max_latency': self.max_latency,
+        }
+
+    def get_semaphore(self, client):
+        with _lock:
+            semaphore = self.semaphores.get(client)
+            if semaphore is None:
+                semaphore = self.semaphores[client] = threading.BoundedSemaphore(self.limit)
+            return semaphore
+
+
+def init_worker(metrics_enabled=False, index_addresses=False):
+    # Workers already run on all the cores, they must not start their own signing pool
+    parallel.configure(workers=0)
+    metrics.configure(metrics_enabled)
+    address_index.configure(index_addresses)
+
+
+def call_in_worker(fn, *args):
+    """Run fn in a worker, and send back the metrics it recorded along with its result
+    """
+    return fn(*args), metrics.drain()
+
+
+def configure_clients(spec):
+    """Set CLIENTS from a comma separated list of name=lane:weight, e.g. withdrawals=high:4
+    """
+    clients = {}
+    for item in filter(None, spec.split(',')):
+        try:
+            name, lane_weight = item.split('=')
+            lane, _, weight = lane_weight.partition(':')
+            clients[name.strip()] = (lane.strip(), int(weight or DEFAULT_WEIGHT))
+        except ValueError:
+            raise exceptions.UnexpectedValueError(f"Invalid client {item}, must be name=lane:weight.")
+        if clients[name.strip()][0] not in LANES or clients[name.strip()][1] <= 0:
+            raise exceptions.UnexpectedValueError(f"Invalid client {item}, lane must be one of "
+                                                    f"{', '.join(LANES)} and weight positive.")
+    CLIENTS.clear()
+    CLIENTS.update(clients)
+
+
+def set_client(name):
+    """Name of the client of the calls made by the current thread, None if it didn't give one
+    """
+    _context.client = name
+
+
+def get_client():
+    return getattr(_context, 'client', None)
+
+
+def get_queue(method):
+    """Queue name, lane and weight of a call of method by the current thread's client
+    """
+    client = get_client()
+    if client in CLIENTS:
+        lane, weight = CLIENTS[client]
+        return client, lane, weight
+    return method, METHOD_LANES.get(method, DEFAULT_LANE), DEFAULT_WEIGHT
+
+
+def run_chunks(fn, calls):
+    """Signing chunks runner of ssm.parallel: each chunk is a task of the scheduler, so that the calls
+    of other clients get their turn between the chunks of a large transaction. Chunks only carry the
+    slice of the sighash engine for their inputs, the tx itself is not sent to the workers.
+    """
+    client, lane, weight = get_queue(getattr(_context, 'method', ''))
+    # The jobs of a chunk are its last argument
+    futures = [_scheduler.submit(client, call_in_worker, fn, *call, lane=lane, weight=weight, cost=len(call[-1]))
+                for call in calls]
+    results = []
+    for future in futures:
+        result, worker_metrics = future.result()
+        metrics.merge(worker_metrics)
+        results.append(result)
+    return results
+
+
+def start(pool_size=POOL_SIZE):
+    """Dispatch the handlers work to a pool of processes, instead of the request thread
+    """
+    global _pool, _pool_size, _scheduler
+    with _lock:
+        if _pool is None:
+            logging.info(f"Starting a pool of {pool_size} workers")
+            # Workers are forked from a clean server process rather than from a threaded caller
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = multiprocessing.get_context()
+            _pool = ProcessPoolExecutor(max_workers=pool_size, mp_context=context, initializer=init_worker,
+                                        initargs=(metrics.ENABLED, address_index.INDEX_ADDRESSES))
+            _pool_size = pool_size
+            # The scheduler decides which call gets the next free worker
+            _scheduler = Scheduler(_pool, pool_size)
+            parallel.set_runner(run_chunks, SIGN_CHUNK)
+
+
+def shutdown():
+    """Stop the worker pool, calls then run in the calling thread again
+    """
+    global _pool, _pool_size, _scheduler
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+            _pool_size = 0
+            _scheduler = None
+            parallel.set_runner(None)
+
+
+def get_method(method):
+    with _lock:
+        stats = _methods.get(method)
+        if stats is None:
+            stats = _methods[method] = MethodStats(METHOD_LIMITS.get(method, DEFAULT_LIMIT))
+        return stats
+
+
+def run(method, fn, *args):
+    """Call fn(*args) on the worker pool if it's started, in the calling thread otherwise.
+    At most METHOD_LIMITS[method] calls of each client run at the same time, the others wait up to
+    QUEUE_TIMEOUT. Calls then wait for a worker in the queue of their client, see get_queue.
+    """
+    stats = get_method(method)
+    client, lane, weight = get_queue(method)
+    semaphore = stats.get_semaphore(client)
+    with _lock:
+        stats.waiting += 1
+    acquired = semaphore.acquire(timeout=QUEUE_TIMEOUT)
+    with _lock:
+        stats.waiting -= 1
+        if not acquired:
+            stats.rejected += 1
+            raise exceptions.ServerBusyError(f"Too many {method} calls waiting, try again later.")
+        stats.running += 1
+
+    start = perf_counter()
+    try:
+        if _pool is None:
+            return fn(*args)
+        if method in CHUNKED_METHODS:
+            _context.method = method
+            return fn(*args)
+        result, worker_metrics = _scheduler.submit(client, call_in_worker, fn, *args,
+                                                    lane=lane, weight=weight).result()
+        metrics.merge(worker_metrics)
+        return result
+    except Exception as e:
+        with _lock:
+            stats.errors += 1
+        metrics.inc(metrics.ERRORS_TOTAL, method=method, type=type(e).__name__)
+        raise
+    finally:
+        latency = perf_counter() - start
+        # handlers functions all take the chain first
+        metrics.inc(metrics.REQUESTS_TOTAL, method=method, chain=args[0] if args else '')
+        metrics.observe(metrics.REQUEST_SECONDS, latency, method=method)
+        semaphore.release()
+        with _lock:
+            stats.running -= 1
+            stats.calls += 1
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+
+
+def status():
+    """Queue depth, concurrency and latency of each method called so far
+    """
+    with _lock:
+        return {
+            'pool_size': _pool_size,
+            'methods': {method: stats.to_dict() for method, stats in _methods.items()},
+            'scheduler': _scheduler.stats() if _scheduler is not None else None,
+        }
@@ -0,0 +1,14 @@
+from os import cpu_count
+
+bind = '0.0.0.0:5000'
+
+# A single pre-forked process accepts the requests and serves them on threads.
+# The CPU bound work is done by the pool of processes of server/executor.py, so that
+# a slow sign_tx doesn't block the other clients.
+workers = 1
+worker_class = 'gthread'
+threads = 4 * cpu_count()
+
+# Large transactions may take a while to sign
+timeout = 120
+graceful_timeout = 30
@@ -1,3 +1,11 @@
 from .new_master import new_master
 from .new_address import new_address
+from .next_address import next_address
+from .new_addresses import new_addresses, streams
+from .find_address import find_address
 from .sign_tx import sign_tx
+from .sign_tx_v2 import sign_tx_v2
+from .sign_psbt import sign_psbt
+from .server_status import server_status
+from .metrics import monitoring
+from .binary import binary
@@ -0,0 +1,65 @@
+import json
+from flask import Blueprint, Response, request
+import executor
+import ssm.binary as binary_format
+import ssm.core as ssm
+import ssm.exceptions as exceptions
+
+binary = Blueprint('binary', __name__)
+
+# binary endpoints answer the raw signed tx, or the packed signatures
+BINARY_RESPONSES = {'tx': 'tx', 'signatures': 'binary'}
+
+# Errors a malformed request may raise
+REQUEST_ERRORS = (exceptions.SsmError, KeyError, TypeError, ValueError, OSError)
+
+def error_message(e):
+    # OSError messages name files of the keys dir
+    return "Keys not found." if isinstance(e, OSError) else str(e)
+
+def error(e):
+    status = 503 if isinstance(e, exceptions.ServerBusyError) else 400
+    return Response(json.dumps({"error": error_message(e)}), status=status, mimetype='application/json')
+
+@binary.route('/sign_tx', methods=['POST'])
+def binary_sign_tx():
+    """Same parameters as the sign_tx_v2 method, chain, inputs, sighash and response ("tx" or "signatures"),
+    as the JSON object of a binary request followed by the raw unsigned tx.
+    """
+    try:
+        params, tx = binary_format.unpack_request(request.get_data())
+        response = params.get('response', 'tx')
+        if response not in BINARY_RESPONSES:
+            raise exceptions.UnexpectedValueError("Response format must be tx or signatures.")
+        signed = executor.run('sign_tx_v2', ssm.sign_tx_v2, params['chain'], tx, params['inputs'],
+                                params.get('sighash', 1), ssm.KEYS_DIR, BINARY_RESPONSES[response])
+    except REQUEST_ERRORS as e:
+        return error(e)
+    return Response(signed, mimetype=binary_format.MIMETYPE)
+
+@binary.route('/new_addresses', methods=['POST'])
+def binary_new_addresses():
+    """Same parameters as the new_addresses method, as the JSON object of a binary request.
+    Addresses are streamed back as binary records, without any limit on count.
+    """
+    try:
+        params, _ = binary_format.unpack_request(request.get_data())
+        chain, fingerprint, account_path = params['chain'], params['fingerprint'], params['account_path']
+        if not isinstance(account_path, str):
+            raise exceptions.UnexpectedValueError("Account path must be a string.")
+        ssm.load_masterkey(chain, fingerprint, ssm.KEYS_DIR)
+        addresses = ssm.iter_addresses_from_path(chain, fingerprint, account_path,
+                                                    int(params['start']), int(params['count']), ssm.KEYS_DIR)
+        # Derive the account node now, so that errors are reported before we start streaming
+        first = next(addresses, None)
+    except REQUEST_ERRORS as e:
+        return error(e)
+
+    def generate():
+        if first is None:
+            return
+        yield binary_format.pack_address(*first)
+        for address in addresses:
+            yield binary_format.pack_address(*address)
+
+    return Response(generate(), mimetype=binary_format.MIMETYPE)
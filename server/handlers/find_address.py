@@ -0,0 +1,8 @@
+import api
+import executor
+import ssm.core as ssm
+
+@api.method('find_address')
+def find_address(chain: str, address: str) -> dict:
+    fingerprint, path = executor.run('find_address', ssm.get_path_from_address, chain, address)
+    return {"chain": chain, "address": address, "fingerprint": fingerprint, "path": path}
@@ -0,0 +1,15 @@
+from flask import Blueprint, Response, abort, request
+import ssm.metrics as metrics
+
+monitoring = Blueprint('monitoring', __name__)
+
+# Metrics are only served to local clients, e.g. a Prometheus agent running next to the server
+LOCAL_ADDRESSES = ['127.0.0.1', '::1']
+
+@monitoring.route('/metrics', methods=['GET'])
+def get_metrics():
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        abort(403)
+    if not metrics.ENABLED:
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
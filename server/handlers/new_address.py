@@ -1,11 +1,10 @@
 import api
+import executor
 import ssm.core as ssm
 
-jsonrpc = api.jsonrpc()
-
-@jsonrpc.method('new_address')
+@api.method('new_address')
 def new_address(chain: str, fingerprint: str, path: str) -> dict:
-    address, pubkey, bkey = ssm.get_address_from_path(chain, fingerprint, path)
+    address, pubkey, bkey = executor.run('new_address', ssm.get_address_from_path, chain, fingerprint, path)
     if chain in ['bitcoin-main', 'bitcoin-test', 'bitcoin-regtest']:
         return {"chain": chain, "address": address, "pubkey": bytes(pubkey).hex()}
     else:
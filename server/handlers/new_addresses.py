@@ -0,0 +1,72 @@
+import json
+from flask import Blueprint, Response, request
+import api
+import executor
+import ssm.core as ssm
+import ssm.exceptions as exceptions
+from .binary import REQUEST_ERRORS, error, error_message
+
+streams = Blueprint('streams', __name__)
+
+# Number of addresses derived by each executor call of a stream, other calls get a worker between them
+STREAM_CHUNK = 1000
+
+def format_address(chain, path, address, pubkey, bkey):
+    if chain in ['bitcoin-main', 'bitcoin-test', 'bitcoin-regtest']:
+        return {"path": path, "address": address, "pubkey": bytes(pubkey).hex()}
+    else:
+        return {
+            "path": path,
+            "address": address, 
+            "pubkey": bytes(pubkey).hex(), 
+            "blinding_key": bytes(bkey).hex()
+            }
+
+@api.method('new_addresses')
+def new_addresses(chain: str, fingerprint: str, account_path: str, start: int, count: int) -> dict:
+    addresses = executor.run('new_addresses', ssm.get_addresses_from_path, 
+                                chain, fingerprint, account_path, start, count)
+    return {
+        "chain": chain,
+        "addresses": [format_address(chain, *address) for address in addresses]
+        }
+
+def iter_chunks(chain, fingerprint, account_path, start, count):
+    """Derive the addresses of a stream STREAM_CHUNK at a time, each chunk is a new_addresses call
+    of the executor, with its limits and lane.
+    """
+    for chunk_start in range(start, start + count, STREAM_CHUNK):
+        yield executor.run('new_addresses', ssm.get_addresses_from_path, chain, fingerprint, account_path,
+                            chunk_start, min(STREAM_CHUNK, start + count - chunk_start), ssm.KEYS_DIR)
+
+@streams.route('/new_addresses', methods=['POST'])
+def stream_new_addresses():
+    """Same parameters as the new_addresses method, as a JSON object.
+    Addresses are streamed back as newline delimited JSON, without any limit on count.
+    """
+    try:
+        params = request.get_json(force=True)
+        chain, fingerprint, account_path = params['chain'], params['fingerprint'], params['account_path']
+        if not isinstance(account_path, str):
+            raise exceptions.UnexpectedValueError("Account path must be a string.")
+        start, count = int(params['start']), int(params['count'])
+        ssm.check_address_range(start, count)
+        ssm.load_masterkey(chain, fingerprint, ssm.KEYS_DIR)
+        chunks = iter_chunks(chain, fingerprint, account_path, start, count)
+        # Derive the first chunk now, so that errors are reported before we start streaming
+        first = next(chunks, [])
+    except REQUEST_ERRORS as e:
+        return error(e)
+
+    def generate():
+        for address in first:
+            yield json.dumps(format_address(chain, *address)) + '\n'
+        try:
+            for addresses in chunks:
+                for address in addresses:
+                    yield json.dumps(format_address(chain, *address)) + '\n'
+        except REQUEST_ERRORS as e:
+            # The status was sent with the first chunk, the error is the last line of the stream
+            yield json.dumps({"error": error_message(e)}) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
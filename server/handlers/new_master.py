@@ -1,9 +1,8 @@
 import api
+import executor
 import ssm.core as ssm
 
-jsonrpc = api.jsonrpc()
-
-@jsonrpc.method('new_master')
+@api.method('new_master', concurrent=False)
 def new_master(chain: str, entropy: str, isbytes: bool, size="64") -> dict:
-  fingerprint = ssm.generate_new_hd_wallet(chain, entropy, isbytes, size)
+  fingerprint = executor.run('new_master', ssm.generate_new_hd_wallet, chain, entropy, isbytes, size)
   return {'chain': chain, 'fingerprint': fingerprint}
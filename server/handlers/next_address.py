@@ -0,0 +1,24 @@
+import api
+import executor
+import ssm.core as ssm
+from ssm.address_pool import get_address_pool
+
+def derive_addresses(chain, fingerprint, account_path, start, count):
+    return executor.run('derive_addresses', ssm.get_addresses_from_path, chain, fingerprint, account_path, start, count)
+
+# addresses are derived ahead of time by the workers, and handed out from the pool
+pool = get_address_pool(derive=derive_addresses)
+
+@api.method('next_address')
+def next_address(chain: str, fingerprint: str, account_path: str) -> dict:
+    path, address, pubkey, bkey = pool.next_address(chain, fingerprint, account_path)
+    if chain in ['bitcoin-main', 'bitcoin-test', 'bitcoin-regtest']:
+        return {"chain": chain, "path": path, "address": address, "pubkey": bytes(pubkey).hex()}
+    else:
+        return {
+            "chain": chain,
+            "path": path,
+            "address": address,
+            "pubkey": bytes(pubkey).hex(),
+            "blinding_key": bytes(bkey).hex()
+            }
@@ -0,0 +1,9 @@
+import api
+import executor
+from ssm.address_pool import get_address_pool
+
+@api.method('server_status')
+def server_status() -> dict:
+    status = executor.status()
+    status['address_pools'] = get_address_pool().stats()
+    return status
@@ -0,0 +1,10 @@
+import api
+import executor
+import ssm.core as ssm
+
+@api.method('sign_psbt')
+def sign_psbt(chain: str, psbt: str, response: str = 'signatures') -> dict:
+    # the binary blob only goes through the binary endpoints
+    ssm.check_response_format(response, ssm.JSON_RESPONSE_FORMATS[1:])
+    signatures = executor.run('sign_psbt', ssm.sign_psbt, chain, psbt, ssm.KEYS_DIR, response)
+    return {'chain': chain, "signatures": signatures}
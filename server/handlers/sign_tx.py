@@ -1,9 +1,12 @@
 import api
+import executor
 import ssm.core as ssm
 
-jsonrpc = api.jsonrpc()
-
-@jsonrpc.method('sign_tx')
-def sign_tx(chain: str, tx: str, fingerprints: str, paths: str, values: str) -> dict:
-    signed_tx = ssm.sign_tx(chain, tx, fingerprints, paths, values)
-    return {'chain': chain, "signed_tx": signed_tx}
+@api.method('sign_tx')
+def sign_tx(chain: str, tx: str, fingerprints: str, paths: str, values: str, response: str = 'tx') -> dict:
+    # the binary blob only goes through the binary endpoints
+    ssm.check_response_format(response, ssm.JSON_RESPONSE_FORMATS)
+    signed = executor.run('sign_tx', ssm.sign_tx, chain, tx, fingerprints, paths, values, ssm.KEYS_DIR, response)
+    if response == 'tx':
+        return {'chain': chain, "signed_tx": signed}
+    return {'chain': chain, "signatures": signed}
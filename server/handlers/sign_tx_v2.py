@@ -0,0 +1,12 @@
+import api
+import executor
+import ssm.core as ssm
+
+@api.method('sign_tx_v2')
+def sign_tx_v2(chain: str, tx: str, inputs: list, sighash: int = 1, response: str = 'tx') -> dict:
+    # the binary blob only goes through the binary endpoints
+    ssm.check_response_format(response, ssm.JSON_RESPONSE_FORMATS)
+    signed = executor.run('sign_tx_v2', ssm.sign_tx_v2, chain, tx, inputs, sighash, ssm.KEYS_DIR, response)
+    if response == 'tx':
+        return {'chain': chain, "signed_tx": signed}
+    return {'chain': chain, "signatures": signed}
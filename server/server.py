@@ -1,11 +1,34 @@
-from flask import Flask
+from os import cpu_count, environ
+from flask import Flask, request
 import api
+import batch
+import executor
+import ssm.address_index as address_index
+import ssm.metrics as metrics
+import ssm.parallel as parallel
 
 app = Flask(__name__)
+
+# per-stage latency metrics, served on /metrics, are disabled unless SSM_METRICS=1
+metrics.configure(environ.get('SSM_METRICS') == '1')
+# generated addresses are only indexed for find_address and signing by script_pubkey if SSM_INDEX_ADDRESSES=1
+address_index.configure(environ.get('SSM_INDEX_ADDRESSES') == '1')
 api.jsonrpc(app, '/api/v1')
+# lanes and weights of the clients sharing the server, e.g. SSM_CLIENTS=withdrawals=high:4,consolidation=low:1
+executor.configure_clients(environ.get('SSM_CLIENTS', ''))
 
 # register handlers
 import handlers
+app.register_blueprint(handlers.streams, url_prefix='/api/v1/stream')
+app.register_blueprint(handlers.binary, url_prefix='/api/v1/binary')
+app.register_blueprint(handlers.monitoring)
+# calls are scheduled in the queue of the client that names itself, see executor.get_queue
+app.before_request(lambda: executor.set_client(request.headers.get('X-SSM-Client')))
+# answer batch requests before flask_jsonrpc, which only dispatches them serially
+app.before_request(batch.handle_batch)
+
+# sign large transactions on all the cores
+parallel.configure(workers=cpu_count())
 
 if __name__ == '__main__':
   app.run(host='0.0.0.0', debug=False)
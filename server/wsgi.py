@@ -0,0 +1,9 @@
+"""Production entry point, to be served by gunicorn from the server dir:
+
+  gunicorn --config gunicorn.conf.py wsgi:app
+"""
+import executor
+from server import app
+
+# Handlers work is done by a pool of processes, request threads only wait for it
+executor.start()
@@ -7,7 +7,7 @@ setup(
     #include_package_data=True,
     entry_points={
         'console_scripts': [
-            'ssm-cli=cli.cli:cli',
+            'ssm-cli=cli.client:main',
         ],
     },
     description='Simple cli tool for the software secured module',
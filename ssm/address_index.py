@@ -0,0 +1,95 @@
+import hashlib
+import threading
+from os import path
+
+from ssm.records import RecordFile
+
+# Name of the address index file in the keys dir
+ADDRESS_INDEX_FILE = 'address_index.bin'
+# If True, generated addresses are added to the index. Every indexed address costs a record on disk and
+# an entry in memory, so this is off unless the index is used, e.g. to sign inputs by script_pubkey.
+INDEX_ADDRESSES = False
+
+# Record body:
+# script hash (20B) | chain (16B, zero padded) | fingerprint (4B) | depth (1B) | path (8 x 4B indexes)
+SCRIPT_HASH_LEN = 20
+CHAIN_LEN = 16
+FINGERPRINT_LEN = 4
+MAX_DEPTH = 8
+PATH_OFFSET = SCRIPT_HASH_LEN + CHAIN_LEN + FINGERPRINT_LEN + 1
+
+HARDENED = 2**31
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_script_hash(script_pubkey):
+    return hashlib.sha256(bytes(script_pubkey)).digest()[:SCRIPT_HASH_LEN]
+
+
+def format_path(lpath):
+    return "/".join(f"{index - HARDENED}h" if index >= HARDENED else str(index) for index in lpath)
+
+
+class AddressIndex(RecordFile):
+    """Append-only index of the scripts of the generated addresses, script -> (fingerprint, path).
+    Lookups are served by an in-memory dict built from the file, so they are O(1).
+    """
+
+    MAGIC = b'SSMA'
+    RECORD_LEN = 80
+    BODY_LEN = PATH_OFFSET + 4 * MAX_DEPTH
+
+    @classmethod
+    def pack(cls, chain, script_pubkey, fingerprint, lpath):
+        return cls.seal(get_script_hash(script_pubkey) + chain.encode().ljust(CHAIN_LEN, b'\0')
+                            + bytes.fromhex(fingerprint) + bytes([len(lpath)])
+                            + b''.join(index.to_bytes(4, 'big') for index in lpath).ljust(4 * MAX_DEPTH, b'\0'))
+
+    def get_record_id(self, body):
+        chain = bytes(body[SCRIPT_HASH_LEN:SCRIPT_HASH_LEN + CHAIN_LEN]).rstrip(b'\0').decode()
+        return chain, bytes(body[:SCRIPT_HASH_LEN])
+
+    def lookup(self, chain, script_pubkey):
+        """Return (fingerprint, path) of the key of a script, or None if it's not in the index
+        """
+        body = self.find((chain, get_script_hash(script_pubkey)))
+        if body is None:
+            return None
+        fingerprint = bytes(body[SCRIPT_HASH_LEN + CHAIN_LEN:PATH_OFFSET - 1]).hex()
+        depth = body[PATH_OFFSET - 1]
+        lpath = [int.from_bytes(body[PATH_OFFSET + 4 * i:PATH_OFFSET + 4 * (i + 1)], 'big') for i in range(depth)]
+        return fingerprint, format_path(lpath)
+
+    def add(self, chain, fingerprint, entries):
+        """Index a list of (path as a list of indexes, script_pubkey), the scripts already indexed are skipped.
+        Paths deeper than MAX_DEPTH can't be indexed.
+        """
+        with self._lock:
+            self._refresh()
+            records = [self.pack(chain, script_pubkey, fingerprint, lpath) for lpath, script_pubkey in entries
+                        if len(lpath) <= MAX_DEPTH and (chain, get_script_hash(script_pubkey)) not in self._index]
+        self.append(records)
+        return len(records)
+
+
+def configure(enabled):
+    global INDEX_ADDRESSES
+    INDEX_ADDRESSES = enabled
+
+
+def get_address_index(dir):
+    """Return the address index of a keys dir, it is created if necessary
+    """
+    filename = path.join(dir, ADDRESS_INDEX_FILE)
+    with _indexes_lock:
+        index = _indexes.get(filename)
+        if index is None:
+            if not path.isfile(filename):
+                try:
+                    AddressIndex.create(filename)
+                except FileExistsError:
+                    pass
+            index = _indexes[filename] = AddressIndex(filename)
+        return index
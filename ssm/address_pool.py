@@ -0,0 +1,202 @@
+import functools
+import logging
+import threading
+from collections import deque
+from os import path
+
+from ssm.address_index import MAX_DEPTH, format_path
+from ssm.core import get_addresses_from_path, load_masterkey
+from ssm.exceptions import UnexpectedValueError
+from ssm.records import RecordFile
+from ssm.util import KEYS_DIR, INITIAL_HARDENED_INDEX, parse_path
+
+# Name of the file of the issued indexes in the keys dir
+ADDRESS_POOL_FILE = 'address_pool.bin'
+
+# The background worker refills a pool up to POOL_HIGH_WATER addresses when it goes below POOL_LOW_WATER
+POOL_HIGH_WATER = 100
+POOL_LOW_WATER = 20
+# Issued indexes are persisted by blocks, so that issuing an address rarely waits for the disk.
+# After a restart, issuance resumes after the last reserved block: at most this many indexes are
+# skipped, which stays within the usual wallet gap limit, and no address is ever issued twice.
+RESERVE_BLOCK = 20
+
+# Record body:
+# chain (16B, zero padded) | fingerprint (4B) | depth (1B) | account path (8 x 4B indexes) | reserved (4B)
+CHAIN_LEN = 16
+FINGERPRINT_LEN = 4
+PATH_OFFSET = CHAIN_LEN + FINGERPRINT_LEN + 1
+RESERVED_OFFSET = PATH_OFFSET + 4 * MAX_DEPTH
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class Reservations(RecordFile):
+    """First index not yet reserved for issuance, for each (chain, fingerprint, account path)
+    """
+
+    MAGIC = b'SSMP'
+    RECORD_LEN = 64
+    BODY_LEN = RESERVED_OFFSET + 4
+
+    @classmethod
+    def pack(cls, chain, fingerprint, lpath, reserved):
+        return cls.seal(chain.encode().ljust(CHAIN_LEN, b'\0') + bytes.fromhex(fingerprint) + bytes([len(lpath)])
+                            + b''.join(index.to_bytes(4, 'big') for index in lpath).ljust(4 * MAX_DEPTH, b'\0')
+                            + reserved.to_bytes(4, 'big'))
+
+    def get_record_id(self, body):
+        chain = bytes(body[:CHAIN_LEN]).rstrip(b'\0').decode()
+        fingerprint = bytes(body[CHAIN_LEN:CHAIN_LEN + FINGERPRINT_LEN]).hex()
+        lpath = tuple(int.from_bytes(body[PATH_OFFSET + 4 * i:PATH_OFFSET + 4 * (i + 1)], 'big')
+                        for i in range(body[PATH_OFFSET - 1]))
+        return chain, fingerprint, lpath
+
+    def get_reserved(self, chain, fingerprint, lpath):
+        body = self.find((chain, fingerprint, tuple(lpath)))
+        return 0 if body is None else int.from_bytes(body[RESERVED_OFFSET:RESERVED_OFFSET + 4], 'big')
+
+    def reserve(self, chain, fingerprint, lpath, reserved):
+        self.append([self.pack(chain, fingerprint, lpath, reserved)])
+
+
+class Pool(object):
+    """Pre-derived addresses of a single account, from index next_index on"""
+
+    def __init__(self, next_index):
+        self.next_index = next_index
+        self.reserved = next_index
+        self.addresses = deque()
+        self.refilling = False
+
+    def end(self):
+        return self.next_index + len(self.addresses)
+
+
+class AddressPool(object):
+    """Pools of pre-derived addresses, one per (chain, fingerprint, account path).
+
+    next_address hands out the next unused index of an account, from its pool if it's there.
+    A background thread refills the pools that get low. derive(chain, fingerprint, account_path, start, count)
+    returns the (path, address, pubkey, blinding privkey) of a range of addresses.
+
+    Usage:
+    pool = AddressPool(keys_dir)
+    path, address, pubkey, blinding_privkey = pool.next_address(chain, fingerprint, "84h/0h/0h/0")
+    """
+
+    def __init__(self, dir=KEYS_DIR, derive=None, high_water=POOL_HIGH_WATER, low_water=POOL_LOW_WATER):
+        self.dir = dir
+        self.derive = derive or functools.partial(get_addresses_from_path, dir=dir)
+        self.high_water = high_water
+        self.low_water = low_water
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._todo = deque()
+        self._thread = None
+        self._reservations = None
+
+    def get_reservations(self):
+        # Caller must hold the lock
+        if self._reservations is None:
+            filename = path.join(self.dir, ADDRESS_POOL_FILE)
+            if not path.isfile(filename):
+                try:
+                    Reservations.create(filename)
+                except FileExistsError:
+                    pass
+            self._reservations = Reservations(filename)
+        return self._reservations
+
+    def start(self):
+        # Caller must hold the lock
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.refill_loop, name='address-pool', daemon=True)
+            self._thread.start()
+
+    def next_address(self, chain, fingerprint, account_path):
+        """Issue the next unused address of an account, return (path, address, pubkey, blinding privkey)
+        """
+        lpath = parse_path(account_path)
+        if len(lpath) > MAX_DEPTH - 1:
+            raise UnexpectedValueError(f"Account path can't be deeper than {MAX_DEPTH - 1}.")
+        key = (chain, fingerprint, tuple(lpath))
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                # Pools and reservations are only created for accounts of our own masterkeys
+                load_masterkey(chain, fingerprint, self.dir)
+                pool = self._pools[key] = Pool(self.get_reservations().get_reserved(chain, fingerprint, lpath))
+            index = pool.next_index
+            if index >= INITIAL_HARDENED_INDEX:
+                raise UnexpectedValueError(f"No address left on account {account_path}.")
+            if index >= pool.reserved:
+                # Persist the next block before handing out any of its indexes
+                reserved = min(index + RESERVE_BLOCK, INITIAL_HARDENED_INDEX)
+                self.get_reservations().reserve(chain, fingerprint, lpath, reserved)
+                pool.reserved = reserved
+            pool.next_index += 1
+            address = pool.addresses.popleft() if pool.addresses else None
+            if len(pool.addresses) < self.low_water and not pool.refilling:
+                pool.refilling = True
+                self._todo.append((key, account_path))
+                self.start()
+                self._wakeup.notify()
+
+        if address is None:
+            # The pool is empty, derive this one right away
+            address = self.derive(chain, fingerprint, account_path, index, 1)[0]
+        return address
+
+    def refill_loop(self):
+        while True:
+            with self._lock:
+                while not self._todo:
+                    self._wakeup.wait()
+                key, account_path = self._todo.popleft()
+            try:
+                self.refill(key, account_path)
+            except Exception:
+                logging.exception(f"Can't refill the address pool of {account_path}")
+            finally:
+                with self._lock:
+                    self._pools[key].refilling = False
+
+    def refill(self, key, account_path):
+        chain, fingerprint, _ = key
+        with self._lock:
+            pool = self._pools[key]
+            start = pool.end()
+            count = min(self.high_water - len(pool.addresses), INITIAL_HARDENED_INDEX - start)
+        if count <= 0:
+            return
+        addresses = self.derive(chain, fingerprint, account_path, start, count)
+        with self._lock:
+            # Addresses issued meanwhile were derived on the spot, skip them
+            skip = pool.end() - start
+            if skip < 0:
+                return
+            pool.addresses.extend(addresses[skip:])
+
+    def stats(self):
+        with self._lock:
+            return {
+                f"{chain}/{fingerprint}/{format_path(lpath)}": {
+                    'next_index': pool.next_index,
+                    'reserved': pool.reserved,
+                    'available': len(pool.addresses),
+                }
+                for (chain, fingerprint, lpath), pool in self._pools.items()
+            }
+
+
+def get_address_pool(dir=KEYS_DIR, derive=None):
+    """Return the address pool of a keys dir, derive is only used when the pool is created
+    """
+    with _pools_lock:
+        pool = _pools.get(str(dir))
+        if pool is None:
+            pool = _pools[str(dir)] = AddressPool(dir, derive)
+        return pool
@@ -0,0 +1,62 @@
+"""Framing of the binary endpoints, /api/v1/binary, for transactions too large to go through JSON as hex.
+
+A request is the varint length of a JSON object of parameters, the object itself, then the raw
+transaction. Responses are the raw signed transaction, or the signatures packed by
+ssm.core.pack_signatures. Addresses are streamed as records, each field prefixed with its varint length.
+"""
+import json
+from io import BytesIO
+
+from ssm.exceptions import UnexpectedValueError
+from ssm.sighash import read_varbytes, varint
+from ssm.util import read_varint
+
+MIMETYPE = 'application/octet-stream'
+# Larger parameters don't fit in memory, no transaction has that many inputs
+MAX_PARAMS_SIZE = 16 * 1024 * 1024
+
+
+def pack_request(params, payload=b''):
+    data = json.dumps(params, separators=(',', ':')).encode()
+    return varint(len(data)) + data + payload
+
+
+def unpack_request(body):
+    """Return the parameters object and the payload of a request
+    """
+    s = BytesIO(body)
+    try:
+        size = read_varint(s)
+    except IndexError:
+        raise UnexpectedValueError("Request is empty.")
+    if size > MAX_PARAMS_SIZE:
+        raise UnexpectedValueError("Request parameters are too large.")
+    data = s.read(size)
+    if len(data) != size:
+        raise UnexpectedValueError("Request is truncated.")
+    try:
+        params = json.loads(data)
+    except ValueError:
+        raise UnexpectedValueError("Request parameters must be a JSON object.")
+    if not isinstance(params, dict):
+        raise UnexpectedValueError("Request parameters must be a JSON object.")
+    return params, body[s.tell():]
+
+
+def pack_address(path, address, pubkey, bkey=None):
+    """Address record: path, address, pubkey and blinding private key, empty on Bitcoin
+    """
+    fields = [path.encode(), address.encode(), bytes(pubkey), bytes(bkey) if bkey is not None else b'']
+    return b''.join(varint(len(field)) + field for field in fields)
+
+
+def unpack_addresses(data):
+    """Iterate over the (path, address, pubkey, bkey or None) of a stream of address records
+    """
+    s = BytesIO(data)
+    while s.tell() < len(data):
+        try:
+            path, address, pubkey, bkey = [read_varbytes(s) for _ in range(4)]
+        except IndexError:
+            raise UnexpectedValueError("Address record is truncated.")
+        yield path.decode(), address.decode(), pubkey, bkey or None
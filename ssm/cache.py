@@ -0,0 +1,172 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from wallycore import (
+    bip32_key_serialize,
+    bip32_key_unserialize,
+    BIP32_FLAG_KEY_PUBLIC,
+)
+
+# Maximum number of master keys kept in memory, and how long (in seconds) they stay there
+KEY_CACHE_SIZE = 1024
+KEY_CACHE_TTL = 3600
+
+# Memory budget (in bytes) of each derivation cache. Entries all have about the same size: a wally ext_key,
+# its (master, path prefix) key and the LRU links take 700B for paths of up to 5 levels, as measured on
+# CPython 3.11. The budget is enforced as the number of entries it holds.
+DERIVATION_CACHE_BYTES = 2 * 1024 * 1024
+DERIVATION_ENTRY_SIZE = 700
+DERIVATION_CACHE_SIZE = DERIVATION_CACHE_BYTES // DERIVATION_ENTRY_SIZE
+DERIVATION_CACHE_TTL = 3600
+# If False, no private node is kept in memory, private derivations then always start from the master key
+DERIVATION_CACHE_KEEP_PRIVATE = True
+
+
+def get_public_node(node):
+    """Copy of an ext_key without its private key
+    """
+    return bip32_key_unserialize(bip32_key_serialize(node, BIP32_FLAG_KEY_PUBLIC))
+
+
+class LRUCache(object):
+    """Thread safe least recently used cache, with an optional time to live on its entries.
+
+    Usage:
+    cache = LRUCache(max_size=128, ttl=60)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.put(key, value)
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the value stored for key, or None if it is missing or has expired
+        """
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def _get(self, key):
+        # Caller must hold the lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= monotonic():
+            # Expired, forget it right away
+            del self._entries[key]
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires = monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def resize(self, max_size, ttl=None):
+        """Change the bounds of the cache, evicting the oldest entries if necessary
+        """
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            while len(self._entries) > max(max_size, 0):
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DerivationCache(LRUCache):
+    """Cache of the intermediate nodes of BIP32 derivations.
+
+    Nodes are stored by (master key, path prefix), so that a new derivation can start from
+    its deepest cached ancestor instead of the master key. When keep_private is False private
+    nodes are not stored at all, only public ones, that can only be used for public derivation.
+    """
+
+    def __init__(self, max_size, ttl=None, keep_private=True):
+        super(DerivationCache, self).__init__(max_size, ttl)
+        self.keep_private = keep_private
+
+    def deepest(self, master, lpath, private=True):
+        """Return (depth, node) for the deepest cached strict prefix of lpath, or (0, None)
+        """
+        with self._lock:
+            if private and not self.keep_private:
+                self.misses += 1
+                return 0, None
+            for depth in range(len(lpath) - 1, 0, -1):
+                entry = self._get((master, tuple(lpath[:depth])))
+                if entry is None:
+                    continue
+                node, is_private = entry
+                if private and not is_private:
+                    continue
+                self.hits += 1
+                return depth, node
+            self.misses += 1
+        return 0, None
+
+    def store(self, master, prefix, node, is_private=True):
+        if is_private and not self.keep_private:
+            # A private lookup couldn't use its public copy, and public derivation has its own cache
+            return
+        self.put((master, tuple(prefix)), (node, is_private))
+
+    def invalidate_master(self, master):
+        """Drop every node derived from a master key, e.g. because it has been overwritten
+        """
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == master]:
+                del self._entries[key]
+
+
+# Master keys and master blinding keys read from disk, keyed by (dir, chain, fingerprint, is_blinding)
+MASTERKEY_CACHE = LRUCache(KEY_CACHE_SIZE, KEY_CACHE_TTL)
+
+# Intermediate derivation nodes, keyed by (masterkey cache key, path prefix)
+DERIVATION_CACHE = DerivationCache(DERIVATION_CACHE_SIZE, DERIVATION_CACHE_TTL, DERIVATION_CACHE_KEEP_PRIVATE)
+
+# Public account nodes and their non hardened descendants, used to derive addresses without private keys
+PUBLIC_DERIVATION_CACHE = DerivationCache(DERIVATION_CACHE_SIZE, DERIVATION_CACHE_TTL, keep_private=False)
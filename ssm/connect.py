@@ -27,16 +27,21 @@ class ConnCtx(object):
         # function to prompt a critical message, e.g. popup or logs
         self.critical = critical
         self.start_over = start_over
+        self._connection = None
 
     def __enter__(self):
         return self
 
     @property
     def connection(self):
-        """Get a connection with the node
+        """Get a connection with the node, the same one each time.
+        Its calls use the keep-alive connections of a pool shared by all the proxies.
         """
+        if self._connection is not None:
+            return self._connection
         try:
-            return RawProxy(**self.credentials)
+            self._connection = RawProxy(**self.credentials)
+            return self._connection
         except Exception as e:
             raise ConnectionError('{}\n\n{}'.format(CONNECTION_ERROR_MESSAGE,
                                                     str(e)))
@@ -1,3 +1,23 @@
+# Chains we have keys for
+CHAINS = [
+    'bitcoin-main', 
+    'bitcoin-test', 
+    'bitcoin-regtest', 
+    'liquidv1', 
+    'elements-regtest',
+]
+
+# What signing returns: the signed tx, or only the new signatures, as JSON objects or as a base64 blob,
+# or as the raw blob for the binary endpoints
+RESPONSE_FORMATS = ['tx', 'signatures', 'base64', 'binary']
+JSON_RESPONSE_FORMATS = RESPONSE_FORMATS[:3]
+
+# Address export formats: ndjson is one address object per line, the others one JSON array of import
+# requests per line, to be passed as is to the importmulti or importdescriptors rpc of bitcoind or elementsd
+EXPORT_FORMATS = ('ndjson', 'importmulti', 'importdescriptors')
+# Number of import requests in each line of the importmulti and importdescriptors formats
+IMPORT_BATCH = 1000
+
 NLOCKTIME = 0
 IS_REPLACEABLE = False
 ADDRESS_TYPE = None # Use the default for the wallet
@@ -1,8 +1,18 @@
 import wallycore as wally
+import base64
+import hashlib
+import hmac
 import logging
+from collections import Counter
+from io import BytesIO
 from os import urandom, path
 
+import ssm.address_index as address_index
 import ssm.exceptions as exceptions
+import ssm.metrics as metrics
+import ssm.parallel as parallel
+import ssm.psbt as psbt_parser
+from ssm.sighash import SighashEngine, SIGHASH_TYPES, read_tx_header, read_varbytes, varint
 from ssm.util import (
     CHAINS,
     PREFIXES,
@@ -13,16 +23,36 @@ from ssm.util import (
     save_masterkey_to_disk,
     save_salt_to_disk,
     get_masterkey_from_disk,
+    masterkey_cache_key,
     harden,
     bin_to_hex,
     check_dir,
     parse_path,
+    read_varint,
     hdkey_to_base58,
-    tx_input_has_witness
+    tx_input_has_witness,
+    INITIAL_HARDENED_INDEX,
 )
+from ssm.cache import DERIVATION_CACHE, PUBLIC_DERIVATION_CACHE, get_public_node
+from ssm.constants import RESPONSE_FORMATS, JSON_RESPONSE_FORMATS
 
 SALT_LEN = 32
 HMAC_COST = 2048
+# Max number of addresses returned at once by get_addresses_from_path, use the iterator beyond that
+MAX_ADDRESSES_BATCH = 10000
+# Addresses of a range are generated by chunks of this size, so that their blinding keys are derived together
+ADDRESSES_CHUNK = 256
+# SLIP-077 blinding private keys are HMAC-SHA256 digests
+BLINDING_PRIVKEY_LEN = 32
+
+# No valid transaction is larger than a block, 4M weight units on Bitcoin and Elements
+MAX_TX_SIZE = 4000000
+
+# No amount can be greater than the total supply
+MAX_SATOSHIS = 21000000 * 10**8
+
+# Cumulative signing counters: inputs signed, keys derived and derivations avoided by the key plan
+SIGN_STATS = Counter()
 
 def generate_entropy_from_password(password):
     """we can generate entropy from some password. A salt is generated randomly and then discarded.
@@ -72,9 +102,9 @@ def generate_seed_from_mnemonic(mnemonic, passphrase=None):
     wally.bip39_mnemonic_to_seed(mnemonic, passphrase, seed)
     return seed
 
-def get_blinding_key_from_address(address, chain, fingerprint):
+def get_blinding_key_from_address(address, chain, fingerprint, dir=KEYS_DIR):
     # First retrieve the master blinding key from disk
-    masterkey = get_masterkey_from_disk(chain, fingerprint, True)
+    masterkey = get_masterkey_from_disk(chain, fingerprint, True, dir)
     # Next we compute the blinding keys for the address
     script_pubkey = wally.addr_segwit_to_bytes(address, PREFIXES.get(chain), 0)
     private_blinding_key = wally.asset_blinding_key_to_ec_private_key(masterkey, script_pubkey)
@@ -117,41 +147,167 @@ def generate_masterkey_from_mnemonic(mnemonic, chain, size, passphrase=None, dir
     # We return the fingerprint only to the caller and keep the keys here
     return str(bin_to_hex(fingerprint))
 
+@metrics.timed('derivation')
 def get_child_from_path(chain, fingerprint, derivation_path, dir=KEYS_DIR):
-    masterkey = get_masterkey_from_disk(chain, fingerprint, False, dir)
-    lpath = parse_path(derivation_path)
-    last = lpath.pop()
-    current = masterkey
-    for path in lpath:
-        child = wally.bip32_key_from_parent(current, path, wally.BIP32_FLAG_KEY_PRIVATE)
-        current = child
-    return wally.bip32_key_from_parent(current, last, wally.BIP32_FLAG_KEY_PRIVATE)
-
-
-def get_address_from_path(chain, fingerprint, derivation_path, dir=KEYS_DIR):
-    # get the child extended key
-    child = get_child_from_path(chain, fingerprint, derivation_path, dir)
-    # get a new segwit native address from the child
-    address = wally.bip32_key_to_addr_segwit(child, PREFIXES.get(chain), 0)
+    return derive_child_from_path(chain, fingerprint, derivation_path, dir)
 
-    # get the pubkey
-    pubkey = wally.ec_public_key_from_private_key(wally.bip32_key_get_priv_key(child))
-    
-    # If Elements, get the blinding key, and create the corresponding confidential address
-    if chain in ['liquidv1', 'elements-regtest']:
-        blinding_privkey = get_blinding_key_from_address(address, chain, fingerprint)
-        blinding_pubkey = wally.ec_public_key_from_private_key(blinding_privkey)
+def derive_child_from_path(chain, fingerprint, derivation_path, dir=KEYS_DIR):
+    """get_child_from_path without its own derivation stage, for callers that already time theirs
+    """
+    lpath = parse_path(derivation_path)
+    # Start from the deepest ancestor we already derived, or from the masterkey
+    master = masterkey_cache_key(chain, fingerprint, False, dir)
+    depth, current = DERIVATION_CACHE.deepest(master, lpath)
+    if current is None:
+        current = get_masterkey_from_disk(chain, fingerprint, False, dir)
+    for i in range(depth, len(lpath) - 1):
+        current = wally.bip32_key_from_parent(current, lpath[i], wally.BIP32_FLAG_KEY_PRIVATE)
+        DERIVATION_CACHE.store(master, lpath[:i + 1], current)
+    return wally.bip32_key_from_parent(current, lpath[-1], wally.BIP32_FLAG_KEY_PRIVATE)
+
+@metrics.timed('derivation')
+def get_public_child_from_path(chain, fingerprint, derivation_path, dir=KEYS_DIR):
+    """Public child key at derivation_path, for watch-only work like address generation.
+    Only the hardened part of the path (the account) needs the private masterkey, and its public
+    node is cached: the non hardened rest of the path is then derived without any private key.
+    """
+    lpath = parse_path(derivation_path)
+    # Depth of the account, the non hardened suffix starts right after it
+    hardened = max([i + 1 for i, index in enumerate(lpath) if index >= INITIAL_HARDENED_INDEX] + [0])
+    master = masterkey_cache_key(chain, fingerprint, False, dir)
+    depth, current = PUBLIC_DERIVATION_CACHE.deepest(master, lpath, private=False)
+    if current is None or depth < hardened:
+        if hardened == 0:
+            current = get_masterkey_from_disk(chain, fingerprint, False, dir)
+        else:
+            current = derive_child_from_path(chain, fingerprint, "/".join(derivation_path.split('/')[:hardened]), dir)
+        if hardened == len(lpath):
+            # Nothing left to derive publicly
+            return get_public_node(current)
+        current = get_public_node(current)
+        if hardened > 0:
+            PUBLIC_DERIVATION_CACHE.store(master, lpath[:hardened], current, False)
+        depth = hardened
+    for i in range(depth, len(lpath) - 1):
+        current = wally.bip32_key_from_parent(current, lpath[i], wally.BIP32_FLAG_KEY_PUBLIC)
+        PUBLIC_DERIVATION_CACHE.store(master, lpath[:i + 1], current, False)
+    return wally.bip32_key_from_parent(current, lpath[-1], wally.BIP32_FLAG_KEY_PUBLIC)
+
+def get_p2wpkh_script(pubkey):
+    return bytes([0x00, 0x14]) + bytes(wally.hash160(pubkey))
+
+def get_blinding_keys_from_scripts(chain, fingerprint, script_pubkeys, dir=KEYS_DIR):
+    """SLIP-077 blinding keys of a list of script_pubkeys, the master blinding key is read only once.
+    Return (privkeys, pubkeys): the 32B private keys and the 33B public keys, packed in script_pubkeys order.
+    """
+    masterkey = get_masterkey_from_disk(chain, fingerprint, True, dir)
+    # The blinding private key of a script is HMAC-SHA256(second half of the master blinding key, script)
+    slip77 = hmac.new(bytes(masterkey[BLINDING_PRIVKEY_LEN:]), digestmod=hashlib.sha256)
+    privkeys = bytearray()
+    pubkeys = bytearray()
+    for script_pubkey in script_pubkeys:
+        h = slip77.copy()
+        h.update(script_pubkey)
+        privkey = h.digest()
+        privkeys += privkey
+        pubkeys += wally.ec_public_key_from_private_key(privkey)
+    return bytes(privkeys), bytes(pubkeys)
+
+@metrics.timed('address')
+def get_addresses_from_children(chain, fingerprint, children, dir=KEYS_DIR):
+    """Return (address, pubkey, blinding privkey) for each child, the children may be public keys only.
+    On Elements, the blinding keys of all the children are derived at once from their script_pubkeys.
+    """
+    # get the new segwit native addresses and the pubkeys of the children
+    addresses = [wally.bip32_key_to_addr_segwit(child, PREFIXES.get(chain), 0) for child in children]
+    pubkeys = [wally.bip32_key_get_pub_key(child) for child in children]
+
+    if chain not in ['liquidv1', 'elements-regtest']:
+        return [(address, pubkey, None) for address, pubkey in zip(addresses, pubkeys)]
+
+    # If Elements, get the blinding keys, and create the corresponding confidential addresses
+    blinding_privkeys, blinding_pubkeys = get_blinding_keys_from_scripts(
+                                            chain, fingerprint, [get_p2wpkh_script(pubkey) for pubkey in pubkeys], dir)
+    result = []
+    for i, (address, pubkey) in enumerate(zip(addresses, pubkeys)):
+        blinding_pubkey = blinding_pubkeys[i * wally.EC_PUBLIC_KEY_LEN:(i + 1) * wally.EC_PUBLIC_KEY_LEN]
         address = wally.confidential_addr_from_addr_segwit(
                                                             address, 
                                                             PREFIXES.get(chain),
                                                             CA_PREFIXES.get(chain), 
                                                             blinding_pubkey
                                                         )
-    else:
-        blinding_privkey = None
+        result.append((address, pubkey, blinding_privkeys[i * BLINDING_PRIVKEY_LEN:(i + 1) * BLINDING_PRIVKEY_LEN]))
+    return result
+
+def get_address_from_child(chain, fingerprint, child, dir=KEYS_DIR):
+    return get_addresses_from_children(chain, fingerprint, [child], dir)[0]
+
+def index_addresses(chain, fingerprint, paths, pubkeys, dir=KEYS_DIR):
+    """Add the scripts of generated addresses to the address index, so that we can find their keys back
+    """
+    if not address_index.INDEX_ADDRESSES:
+        return
+    entries = [(parse_path(path), get_p2wpkh_script(pubkey)) for path, pubkey in zip(paths, pubkeys)]
+    address_index.get_address_index(dir).add(chain, fingerprint, entries)
 
+def get_address_from_path(chain, fingerprint, derivation_path, dir=KEYS_DIR):
+    # get the child extended key, addresses don't need the private key
+    child = get_public_child_from_path(chain, fingerprint, derivation_path, dir)
+    address, pubkey, blinding_privkey = get_address_from_child(chain, fingerprint, child, dir)
+    index_addresses(chain, fingerprint, [derivation_path], [pubkey], dir)
     return address, pubkey, blinding_privkey
 
+def get_path_from_script(chain, script_pubkey, dir=KEYS_DIR):
+    """Return (fingerprint, path) of the key of a script_pubkey we generated an address for
+    """
+    found = address_index.get_address_index(dir).lookup(chain, script_pubkey)
+    if found is None:
+        raise exceptions.UnknownAddressError(f"Unknown script_pubkey {bytes(script_pubkey).hex()}.")
+    return found
+
+def get_path_from_address(chain, address, dir=KEYS_DIR):
+    """Return (fingerprint, path) of the key of an address we generated
+    """
+    try:
+        if chain in ['liquidv1', 'elements-regtest']:
+            address = wally.confidential_addr_to_addr_segwit(address, CA_PREFIXES.get(chain), PREFIXES.get(chain))
+        script_pubkey = wally.addr_segwit_to_bytes(address, PREFIXES.get(chain), 0)
+    except ValueError:
+        raise exceptions.InvalidAddressError(f"Invalid address: {address}")
+    return get_path_from_script(chain, script_pubkey, dir)
+
+def check_address_range(start, count):
+    if start < 0 or count < 0:
+        raise exceptions.UnexpectedValueError("Start and count can't be negative.")
+    # Only non hardened children can be part of a range
+    if start + count > INITIAL_HARDENED_INDEX:
+        raise exceptions.UnexpectedValueError("Range must stay below the first hardened index.")
+
+def iter_addresses_from_path(chain, fingerprint, account_path, start, count, dir=KEYS_DIR, index=True):
+    """Derive the public account node once, then yield (path, address, pubkey, blinding privkey)
+    for the children of the account from index start to start + count - 1.
+    Memory use doesn't depend on count, this is meant for very large ranges.
+    If index is False, the addresses are not added to the address index even if it's enabled.
+    """
+    check_address_range(start, count)
+    account = get_public_child_from_path(chain, fingerprint, account_path, dir)
+    for batch_start in range(start, start + count, ADDRESSES_CHUNK):
+        indexes = range(batch_start, min(batch_start + ADDRESSES_CHUNK, start + count))
+        children = [wally.bip32_key_from_parent(account, i, wally.BIP32_FLAG_KEY_PUBLIC) for i in indexes]
+        addresses = get_addresses_from_children(chain, fingerprint, children, dir)
+        paths = [f"{account_path}/{i}" for i in indexes]
+        if index:
+            index_addresses(chain, fingerprint, paths, [pubkey for _, pubkey, _ in addresses], dir)
+        for path, address in zip(paths, addresses):
+            yield (path,) + address
+
+def get_addresses_from_path(chain, fingerprint, account_path, start, count, dir=KEYS_DIR):
+    if count > MAX_ADDRESSES_BATCH:
+        raise exceptions.UnexpectedValueError(f"Can't generate more than {MAX_ADDRESSES_BATCH} "
+                                                "addresses at once.")
+    return list(iter_addresses_from_path(chain, fingerprint, account_path, start, count, dir))
+
 def generate_new_hd_wallet(chain, entropy, is_bytes, size):
     # First make sure we know for which network we need a seed
     try:
@@ -209,66 +365,122 @@ def restore_hd_wallet(chain, hdkey, bkey=None, dir=KEYS_DIR):
 
 def get_xpub(chain, fingerprint, path, dir=KEYS_DIR):
     if path == 'root':
-        masterkey = get_masterkey_from_disk(chain, fingerprint)
+        masterkey = get_masterkey_from_disk(chain, fingerprint, False, dir)
     else:
-        masterkey = get_child_from_path(chain, fingerprint, path, dir)
+        masterkey = get_public_child_from_path(chain, fingerprint, path, dir)
     return hdkey_to_base58(masterkey, False)
 
-def get_btc_sighash(tx, index, scriptCode, value):
+def get_btc_sighash(tx, index, scriptCode, value, sighash=wally.WALLY_SIGHASH_ALL):
     hashToSign = wally.tx_get_btc_signature_hash(tx, index, 
         scriptCode, 
         value, 
-        wally.WALLY_SIGHASH_ALL, 
+        sighash, 
         wally.WALLY_TX_FLAG_USE_WITNESS)
     return hashToSign
 
-def get_elements_sighash(tx, index, scriptCode, value):
+def get_elements_sighash(tx, index, scriptCode, value, sighash=wally.WALLY_SIGHASH_ALL):
     hashToSign = wally.tx_get_elements_signature_hash(tx, index, 
         scriptCode, 
         value, 
-        wally.WALLY_SIGHASH_ALL, 
+        sighash, 
         wally.WALLY_TX_FLAG_USE_WITNESS)
     return hashToSign
 
-def sign_btc_input(tx, index, privkey, value):
+def get_script_code(pubkey):
+    """ScriptCode of a P2WPKH output, this is what the signature hash commits to
+    """
+    witnessProgram = wally.hash160(pubkey)
+    return bytearray([0x76, 0xa9, 0x14]) + witnessProgram + bytearray([0x88, 0xac])
+
+def sign_btc_input(tx, index, privkey, value, scriptCode=None, sighashes=None, sighash=wally.WALLY_SIGHASH_ALL):
     # we need the value as an int in satoshis
-    value = btc2sat(float(value))
+    if isinstance(value, str):
+        value = btc2sat(float(value))
 
-    # we need the pubkey to write the ScriptCode that will be signed
-    pubkey = wally.ec_public_key_from_private_key(privkey)
-    witnessProgram = wally.hash160(pubkey)
-    scriptCode = bytearray([0x76, 0xa9, 0x14]) + witnessProgram + bytearray([0x88, 0xac])
+    # we need the pubkey to write the ScriptCode that will be signed, unless the caller already did
+    if scriptCode is None:
+        scriptCode = get_script_code(wally.ec_public_key_from_private_key(privkey))
 
-    # we can now calculate the signature hash
-    hashToSign = get_btc_sighash(tx, index, scriptCode, value)
+    # we can now calculate the signature hash, from the shared midstates if we have them
+    with metrics.stage('sighash'):
+        if sighashes is None:
+            hashToSign = get_btc_sighash(tx, index, scriptCode, value, sighash)
+        else:
+            hashToSign = sighashes.get_sighash(index, scriptCode, value, sighash)
 
     # We sign the signature hash with the private key
-    sig = wally.ec_sig_from_bytes(privkey, hashToSign, wally.EC_FLAG_ECDSA | wally.EC_FLAG_GRIND_R)
+    with metrics.stage('ecdsa'):
+        sig = wally.ec_sig_from_bytes(privkey, hashToSign, wally.EC_FLAG_ECDSA | wally.EC_FLAG_GRIND_R)
 
     # We now return the signature encoded in der format and add the SIGHASH
-    return wally.ec_sig_to_der(sig) + bytearray([wally.WALLY_SIGHASH_ALL])
+    return wally.ec_sig_to_der(sig) + bytearray([sighash])
 
-def sign_elements_input(tx, index, privkey, value):
+def sign_elements_input(tx, index, privkey, value, scriptCode=None, sighashes=None, sighash=wally.WALLY_SIGHASH_ALL):
     # we need the blinded value as a bytearray
-    try:
-        value = bytearray.fromhex(value)
-    except ValueError:
-        value = btc2sat(float(value))
-        value = wally.tx_confidential_value_from_satoshi(value)
+    if isinstance(value, str):
+        value = parse_elements_value(value)
 
-    # we need the pubkey to write the ScriptCode that will be signed
-    pubkey = wally.ec_public_key_from_private_key(privkey)
-    witnessProgram = wally.hash160(pubkey)
-    scriptCode = bytearray([0x76, 0xa9, 0x14]) + witnessProgram + bytearray([0x88, 0xac])
+    # we need the pubkey to write the ScriptCode that will be signed, unless the caller already did
+    if scriptCode is None:
+        scriptCode = get_script_code(wally.ec_public_key_from_private_key(privkey))
 
-    # we can now calculate the signature hash
-    hashToSign = get_elements_sighash(tx, index, scriptCode, value)
+    # we can now calculate the signature hash, from the shared midstates if we have them
+    with metrics.stage('sighash'):
+        if sighashes is None:
+            hashToSign = get_elements_sighash(tx, index, scriptCode, value, sighash)
+        else:
+            hashToSign = sighashes.get_sighash(index, scriptCode, value, sighash)
 
     # We sign the signature hash with the private key
-    sig = wally.ec_sig_from_bytes(privkey, hashToSign, wally.EC_FLAG_ECDSA | wally.EC_FLAG_GRIND_R)
+    with metrics.stage('ecdsa'):
+        sig = wally.ec_sig_from_bytes(privkey, hashToSign, wally.EC_FLAG_ECDSA | wally.EC_FLAG_GRIND_R)
 
     # We now return the signature encoded in der format and add the SIGHASH
-    return wally.ec_sig_to_der(sig) + bytearray([wally.WALLY_SIGHASH_ALL])
+    return wally.ec_sig_to_der(sig) + bytearray([sighash])
+
+def sign_input(chain, tx, index, privkey, value, scriptCode=None, sighashes=None, sighash=wally.WALLY_SIGHASH_ALL):
+    if chain in ['bitcoin-main', 'bitcoin-test', 'bitcoin-regtest']: 
+        return sign_btc_input(tx, index, privkey, value, scriptCode, sighashes, sighash)
+    else: 
+        return sign_elements_input(tx, index, privkey, value, scriptCode, sighashes, sighash)
+
+def parse_elements_value(value):
+    """Legacy values are either a hex value commitment or an amount in BTC
+    """
+    try:
+        return bytearray.fromhex(value)
+    except ValueError:
+        return wally.tx_confidential_value_from_satoshi(btc2sat(float(value)))
+
+def get_sighash_engine(chain, raw_tx):
+    return SighashEngine(raw_tx, chain in ['liquidv1', 'elements-regtest'])
+
+def sign_inputs_chunk(chain, sighash, sighashes, jobs):
+    """Sign a list of (index, privkey, scriptCode, value) jobs, this is what parallel signing workers run.
+    sighashes is the SighashEngine of the tx, or its slice for these inputs.
+    """
+    return [sign_input(chain, None, index, privkey, value, scriptCode, sighashes, sighash) 
+                for index, privkey, scriptCode, value in jobs]
+
+def get_key_plan(chain, fingerprints, paths, dir=KEYS_DIR):
+    """Derive the private key, pubkey and scriptCode of each distinct (fingerprint, path) only once,
+    however many inputs it has to sign.
+    Return a dict (fingerprint, path) -> (privkey, pubkey, scriptCode)
+    """
+    plan = {}
+    for key in zip(fingerprints, paths):
+        if key in plan:
+            continue
+        child = get_child_from_path(chain, key[0], key[1], dir)
+        privkey = wally.bip32_key_get_priv_key(child)
+        pubkey = wally.ec_public_key_from_private_key(privkey)
+        plan[key] = (privkey, pubkey, get_script_code(pubkey))
+
+    avoided = len(fingerprints) - len(plan)
+    SIGN_STATS['keys_derived'] += len(plan)
+    SIGN_STATS['derivations_avoided'] += avoided
+    logging.debug(f"{len(plan)} keys derived for {len(fingerprints)} inputs, {avoided} derivations avoided")
+    return plan
 
 def get_witness_stack(sig, pubkey):
     witnessStack = wally.tx_witness_stack_init(2)
@@ -276,8 +488,116 @@ def get_witness_stack(sig, pubkey):
     wally.tx_witness_stack_add(witnessStack, pubkey)
     return witnessStack
 
-def sign_tx(chain, tx, fingerprints, paths, values, dir=KEYS_DIR):
-    """TODO: we can't know if an input is spending a segwit UTXO without access to the UTXO
+@metrics.timed('decode')
+def check_tx(chain, tx):
+    """Cheap checks of a tx, hex or raw, before wally parses it: its size, and its header.
+    Return its TxHeader and raw bytes.
+    """
+    size = len(tx) // 2 if isinstance(tx, str) else len(tx)
+    if size > MAX_TX_SIZE:
+        raise exceptions.UnexpectedValueError(f"Transaction is larger than {MAX_TX_SIZE} bytes.")
+    if isinstance(tx, str):
+        try:
+            tx = bytes.fromhex(tx)
+        except ValueError:
+            raise exceptions.UnexpectedValueError("Transaction is not hex.")
+    return read_tx_header(BytesIO(tx), len(tx), chain in ['liquidv1', 'elements-regtest']), tx
+
+@metrics.timed('decode')
+def get_tx_from_hex(chain, tx):
+    """tx is hex, or the raw bytes of the transaction as sent to the binary endpoints
+    """
+    if chain in ['bitcoin-main', 'bitcoin-test', 'bitcoin-regtest']: 
+        flags = wally.WALLY_TX_FLAG_USE_WITNESS
+    else: 
+        flags = wally.WALLY_TX_FLAG_USE_WITNESS | wally.WALLY_TX_FLAG_USE_ELEMENTS
+    if isinstance(tx, (bytes, bytearray)):
+        return wally.tx_from_bytes(tx, flags)
+    return wally.tx_from_hex(tx, flags)
+
+def check_response_format(response, formats=RESPONSE_FORMATS):
+    if response not in formats:
+        raise exceptions.UnexpectedValueError(f"Response format must be one of {', '.join(formats)}.")
+
+def pack_signatures(signatures):
+    """Binary form of a list of (index, signature, pubkey): their count, then for each of them the input
+    index, the DER signature with its sighash byte and the pubkey, all prefixed with a varint length.
+    """
+    blob = bytearray(varint(len(signatures)))
+    for i, sig, pubkey in signatures:
+        blob += varint(i) + varint(len(sig)) + sig + varint(len(pubkey)) + pubkey
+    return bytes(blob)
+
+def unpack_signatures(blob):
+    """Reverse of pack_signatures, return a list of (index, signature, pubkey)
+    """
+    s = BytesIO(blob)
+    try:
+        return [(read_varint(s), read_varbytes(s), read_varbytes(s)) for _ in range(read_varint(s))]
+    except (IndexError, exceptions.UnexpectedValueError):
+        raise exceptions.UnexpectedValueError("Signatures blob is truncated.")
+
+def format_signatures(signatures, response):
+    """Signatures as returned to the caller: a binary or base64 blob, or a list of hex
+    {"index", "signature", "pubkey"}
+    """
+    if response == 'binary':
+        return pack_signatures(signatures)
+    if response == 'base64':
+        return base64.b64encode(pack_signatures(signatures)).decode()
+    return [{"index": i, "signature": bytes(sig).hex(), "pubkey": bytes(pubkey).hex()}
+                for i, sig, pubkey in signatures]
+
+def sign_tx_inputs(chain, tx, raw_tx, Tx, inputs, sighash=wally.WALLY_SIGHASH_ALL, dir=KEYS_DIR, response='tx'):
+    """Sign the inputs of a tx that has already been decoded to raw_tx, parsed to Tx and validated.
+    inputs is a list of (index, fingerprint, path, value), with value in satoshis for Bitcoin,
+    and a serialized confidential value for Elements.
+    Return the signed tx, as hex or as bytes like tx, or only the signatures if response is another
+    of RESPONSE_FORMATS.
+    """
+    # We derive the child key for each distinct fingerprint and path only once
+    plan = get_key_plan(chain, [fingerprint for _, fingerprint, _, _ in inputs], 
+                        [path for _, _, path, _ in inputs], dir)
+    jobs = []
+    pubkeys = []
+    for i, fingerprint, path, value in inputs:
+        privkey, pubkey, scriptCode = plan[(fingerprint, path)]
+        pubkeys.append(pubkey)
+        jobs.append((i, privkey, scriptCode, value))
+
+    # we now sign the inputs and get the signatures to populate the witnesses.
+    # Sighashes don't commit to witnesses, so inputs can be signed in any order, or at the same time
+    sighashes = get_sighash_engine(chain, raw_tx)
+    sigs = None
+    if parallel.use_parallel(len(jobs)):
+        logging.info(f"Signing {len(jobs)} inputs in parallel")
+        sigs = parallel.map_chunks(sign_inputs_chunk, (chain, sighash), sighashes, jobs)
+    if sigs is None:
+        sigs = [sign_input(chain, Tx, i, privkey, value, scriptCode, sighashes, sighash) 
+                    for i, privkey, scriptCode, value in jobs]
+    SIGN_STATS['inputs_signed'] += len(jobs)
+
+    if response != 'tx':
+        # The caller adds the witnesses itself, we don't need to serialize the whole tx again
+        with metrics.stage('encode'):
+            return format_signatures([(i, sig, pubkey) for (i, _, _, _), sig, pubkey in zip(jobs, sigs, pubkeys)],
+                                        response)
+
+    for (i, _, _, _), sig, pubkey in zip(jobs, sigs, pubkeys):
+        # Create a new witness stack and populate it with sig and pubkey
+        witnessStack = get_witness_stack(sig, pubkey)
+
+        # now add the witness stack to the current input
+        wally.tx_set_input_witness(Tx, i, witnessStack)
+
+    with metrics.stage('encode'):
+        if isinstance(tx, (bytes, bytearray)):
+            return bytes(wally.tx_to_bytes(Tx, wally.WALLY_TX_FLAG_USE_WITNESS))
+        return wally.tx_to_hex(Tx, wally.WALLY_TX_FLAG_USE_WITNESS)
+
+def sign_tx(chain, tx, fingerprints, paths, values, dir=KEYS_DIR, response='tx'):
+    """See sign_tx_inputs for the response formats.
+    TODO: we can't know if an input is spending a segwit UTXO without access to the UTXO
     to prevent exchanging too much data, we should rely on the client signaling a 
     non-segwit UTXO
     TODO: since we only need `value` for spending segwit output, maybe we could say that
@@ -285,19 +605,16 @@ def sign_tx(chain, tx, fingerprints, paths, values, dir=KEYS_DIR):
     TODO: we still can't handle P2SH
     """
 
+    check_response_format(response)
+
     # first extract the fingerprints and paths in lists
     fingerprints = fingerprints.split()
     paths = paths.split()
     values = values.split()
 
-    # Get a tx object from the tx_hex
-    if chain in ['bitcoin-main', 'bitcoin-test', 'bitcoin-regtest']: 
-        Tx = wally.tx_from_hex(tx, wally.WALLY_TX_FLAG_USE_WITNESS) 
-    else: 
-        Tx = wally.tx_from_hex(tx, wally.WALLY_TX_FLAG_USE_WITNESS | wally.WALLY_TX_FLAG_USE_ELEMENTS)
-
-    # Get the number of inputs
-    inputs_len = wally.tx_get_num_inputs(Tx)
+    # Get the number of inputs from the header, before parsing the whole tx
+    header, raw_tx = check_tx(chain, tx)
+    inputs_len = header.num_inputs
 
     # Check if all the lists are of the same length
     try:
@@ -308,31 +625,171 @@ def sign_tx(chain, tx, fingerprints, paths, values, dir=KEYS_DIR):
                                             {len(paths)} paths, and {len(values)} values provided. 
                                             Must be the same number.
                                             """)
+
+    # Get a tx object from the raw tx
+    Tx = get_tx_from_hex(chain, raw_tx)
            
-    # Now we loop on each fingerprint provided, compute the sighash and sign the same index input
+    # First check which inputs already have a witness. If so it means that the input was
+    # signed either by us or someone else, and we just skip it
+    inputs = []
     for i in range(0, inputs_len):
-        # First check if the input already has a witness. If so it means that this input was
-        # signed either by us or someone else, and we just skip it
         if tx_input_has_witness(Tx, i) == True:
             continue
-
-        # We derive the child key for the provided fingerprint and path
-        child = get_child_from_path(chain, fingerprints[i], paths[i], dir)
-
-        # From here we extract the private key that we will sign with
-        privkey = wally.bip32_key_get_priv_key(child)
-        pubkey = wally.ec_public_key_from_private_key(privkey)
-
-        # we now sign the input and get the signature and pubkey to populate the witness
         if chain in ['bitcoin-main', 'bitcoin-test', 'bitcoin-regtest']: 
-            sig = sign_btc_input(Tx, i, privkey, values[i])
-        else: 
-            sig = sign_elements_input(Tx, i, privkey, values[i])
+            value = btc2sat(float(values[i]))
+        else:
+            value = parse_elements_value(values[i])
+        inputs.append((i, fingerprints[i], paths[i], value))
+
+    return sign_tx_inputs(chain, tx, raw_tx, Tx, inputs, wally.WALLY_SIGHASH_ALL, dir, response)
+
+def parse_sign_inputs(chain, inputs, inputs_len, dir=KEYS_DIR):
+    """Validate the inputs of a v2 signing request in one pass.
+    Each input is an object with:
+    - fingerprint and path of the key to sign with, or the hex script_pubkey of the spent output
+      if we generated its address, its key is then found in the address index
+    - value, an int in satoshis, or for Elements a hex value commitment
+    - skip, optional, true if we must not sign this input
+    Return the (index, fingerprint, path, value) of the inputs to sign.
+    """
+    if not isinstance(inputs, list) or len(inputs) != inputs_len:
+        raise exceptions.MissingValueError(f"Tx has {inputs_len} inputs, "
+                                            f"{len(inputs) if isinstance(inputs, list) else 0} provided. "
+                                            "Must be the same number.")
+    is_elements = chain in ['liquidv1', 'elements-regtest']
+    parsed = []
+    for i, txin in enumerate(inputs):
+        if not isinstance(txin, dict):
+            raise exceptions.UnexpectedValueError(f"Input {i} must be an object.")
+        if txin.get('skip', False) == True:
+            continue
+        if 'fingerprint' not in txin and 'path' not in txin and 'script_pubkey' in txin:
+            try:
+                script_pubkey = bytes.fromhex(txin['script_pubkey'])
+            except (TypeError, ValueError):
+                raise exceptions.UnexpectedValueError(f"Input {i} script_pubkey is not hex.")
+            fingerprint, path = get_path_from_script(chain, script_pubkey, dir)
+            txin = dict(txin, fingerprint=fingerprint, path=path)
+        try:
+            fingerprint, path, value = txin['fingerprint'], txin['path'], txin['value']
+        except KeyError as e:
+            raise exceptions.MissingValueError(f"Input {i} has no {e.args[0]}.")
+        if not isinstance(fingerprint, str) or not isinstance(path, str):
+            raise exceptions.UnexpectedValueError(f"Input {i} fingerprint and path must be strings.")
+        if isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= MAX_SATOSHIS:
+            if is_elements:
+                value = wally.tx_confidential_value_from_satoshi(value)
+        elif is_elements and isinstance(value, str) and len(value) in [2 * 9, 2 * 33]:
+            try:
+                value = bytearray.fromhex(value)
+            except ValueError:
+                raise exceptions.UnexpectedValueError(f"Input {i} value commitment is not hex.")
+        else:
+            raise exceptions.UnexpectedValueError(f"Input {i} value must be an amount in satoshis"
+                                                    f"{' or a value commitment' if is_elements else ''}.")
+        parsed.append((i, fingerprint, path, value))
+    return parsed
+
+def sign_tx_v2(chain, tx, inputs, sighash=wally.WALLY_SIGHASH_ALL, dir=KEYS_DIR, response='tx'):
+    """Same as sign_tx, but with one typed object per input instead of space separated strings.
+    See parse_sign_inputs for the format of inputs. Inputs that already have a witness are skipped.
+    """
+    if sighash not in SIGHASH_TYPES:
+        raise exceptions.UnexpectedValueError(f"Unsupported sighash type {sighash}.")
+    check_response_format(response)
 
-        # Create a new witness stack and populate it with sig and pubkey
-        witnessStack = get_witness_stack(sig, pubkey)
+    # Inputs are checked against the header, before parsing the whole tx
+    header, raw_tx = check_tx(chain, tx)
+    inputs = parse_sign_inputs(chain, inputs, header.num_inputs, dir)
+    Tx = get_tx_from_hex(chain, raw_tx)
+    inputs = [txin for txin in inputs if tx_input_has_witness(Tx, txin[0]) == False]
 
-        # now add the witness stack to the current input
-        wally.tx_set_input_witness(Tx, i, witnessStack)
+    return sign_tx_inputs(chain, tx, raw_tx, Tx, inputs, sighash, dir, response)
+
+def check_fingerprint(chain, fingerprint):
+    """Chain and fingerprint of a request name the masterkey, check them before they reach the disk
+    """
+    if chain not in CHAINS:
+        raise exceptions.UnexpectedValueError(f"Unknown chain {chain}.")
+    if not isinstance(fingerprint, str) or len(fingerprint) != 8 or \
+            any(c not in '0123456789abcdefABCDEF' for c in fingerprint):
+        raise exceptions.UnexpectedValueError("Fingerprint must be 8 hex characters.")
+
+def load_masterkey(chain, fingerprint, dir=KEYS_DIR):
+    """Masterkey of an untrusted (chain, fingerprint), that must exist
+    """
+    check_fingerprint(chain, fingerprint)
+    try:
+        return get_masterkey_from_disk(chain, fingerprint, False, dir)
+    except FileNotFoundError:
+        raise exceptions.UnexpectedValueError(f"No masterkey {fingerprint} on {chain}.")
 
-    return wally.tx_to_hex(Tx, wally.WALLY_TX_FLAG_USE_WITNESS) 
\ No newline at end of file
+def has_masterkey(chain, fingerprint, dir=KEYS_DIR):
+    try:
+        get_masterkey_from_disk(chain, fingerprint, False, dir)
+    except FileNotFoundError:
+        return False
+    return True
+
+def sign_psbt_chunk(chain, sighashes, jobs):
+    """Sign a list of (index, privkey, scriptCode, value, sighash) jobs of a PSBT, this is what
+    parallel signing workers run. sighashes is the SighashEngine of the transaction of the PSBT,
+    or its slice for these inputs.
+    """
+    return [sign_input(chain, None, index, privkey, value, scriptCode, sighashes, sighash)
+                for index, privkey, scriptCode, value, sighash in jobs]
+
+def sign_psbt(chain, psbt, dir=KEYS_DIR, response='signatures'):
+    """Sign the inputs of a base64 PSBT, a PSET on Elements, that spend a P2WPKH output of our keys.
+    Values, scripts and keys are all read from the PSBT: an input is signed for each of its BIP32
+    derivations from one of our master keys, unless it's finalized or already has that signature.
+    Return only the new partial signatures, in one of the formats of format_signatures, for the
+    caller to add to its PSBT.
+    """
+    check_response_format(response, RESPONSE_FORMATS[1:])
+    with metrics.stage('decode'):
+        parsed = psbt_parser.parse_psbt(psbt)
+    if parsed.elements != (chain in ['liquidv1', 'elements-regtest']):
+        raise exceptions.UnexpectedValueError(f"{chain} transactions must be signed as "
+                                                f"{'PSBT' if parsed.elements else 'PSET'}.")
+
+    ours = {}
+    inputs = []
+    for i, txin in enumerate(parsed.inputs):
+        if txin.final or txin.script is None:
+            continue
+        sighash = wally.WALLY_SIGHASH_ALL if txin.sighash is None else txin.sighash
+        for pubkey, fingerprint, lpath in txin.derivations:
+            if pubkey in txin.signed_pubkeys or txin.script != get_p2wpkh_script(pubkey):
+                continue
+            if fingerprint not in ours:
+                ours[fingerprint] = has_masterkey(chain, fingerprint, dir)
+            if not ours[fingerprint]:
+                continue
+            if sighash not in SIGHASH_TYPES:
+                raise exceptions.UnexpectedValueError(f"Unsupported sighash type {sighash} on input {i}.")
+            inputs.append((i, fingerprint, address_index.format_path(lpath), pubkey, txin.value, sighash))
+
+    plan = get_key_plan(chain, [fingerprint for _, fingerprint, _, _, _, _ in inputs],
+                        [path for _, _, path, _, _, _ in inputs], dir)
+    jobs = []
+    pubkeys = []
+    for i, fingerprint, path, pubkey, value, sighash in inputs:
+        privkey, derived_pubkey, scriptCode = plan[(fingerprint, path)]
+        if bytes(derived_pubkey) != pubkey:
+            # Another master key with the same fingerprint
+            logging.warning(f"Input {i} key {fingerprint}/{path} doesn't match its pubkey, not signed")
+            continue
+        pubkeys.append(pubkey)
+        jobs.append((i, privkey, scriptCode, value, sighash))
+
+    sighashes = SighashEngine(parsed.tx, parsed.elements)
+    sigs = None
+    if parallel.use_parallel(len(jobs)):
+        logging.info(f"Signing {len(jobs)} inputs in parallel")
+        sigs = parallel.map_chunks(sign_psbt_chunk, (chain,), sighashes, jobs)
+    if sigs is None:
+        sigs = sign_psbt_chunk(chain, sighashes, jobs)
+    SIGN_STATS['inputs_signed'] += len(jobs)
+
+    return format_signatures([(job[0], sig, pubkey) for job, sig, pubkey in zip(jobs, sigs, pubkeys)], response)
@@ -57,3 +57,11 @@ class InvalidAssetIdError(SsmError):
 
 class InvalidAssetLabelError(SsmError):
     """Asset label already set"""
+
+
+class ServerBusyError(SsmError):
+    """Too many requests are already waiting to be served"""
+
+
+class UnknownAddressError(SsmError):
+    """Address or script not generated by this SSM"""
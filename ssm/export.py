@@ -0,0 +1,105 @@
+import json
+
+from ssm.constants import EXPORT_FORMATS, IMPORT_BATCH
+from ssm.core import iter_addresses_from_path
+from ssm.exceptions import UnexpectedValueError
+from ssm.util import KEYS_DIR
+
+ELEMENTS_CHAINS = ('liquidv1', 'elements-regtest')
+
+# Output descriptors checksum, as specified in BIP380
+DESCRIPTOR_INPUT_CHARSET = "0123456789()[],'/*abcdefgh@:$%{}IJKLMNOPQRSTUVWXYZ&+-.;<=>?!^_|~ijklmnopqrstuvwxyzABCDEFGH`#\"\\ "
+DESCRIPTOR_CHECKSUM_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+DESCRIPTOR_GENERATOR = (0xf5dee51989, 0xa9fdca3312, 0x1bab10e32d, 0x3706b1677a, 0x644d626ffd)
+
+
+def descriptor_polymod(symbols):
+    chk = 1
+    for value in symbols:
+        top = chk >> 35
+        chk = (chk & 0x7ffffffff) << 5 ^ value
+        for i in range(5):
+            if (top >> i) & 1:
+                chk ^= DESCRIPTOR_GENERATOR[i]
+    return chk
+
+
+def add_descriptor_checksum(descriptor):
+    """Return the descriptor followed by its #checksum, importdescriptors requires it
+    """
+    symbols = []
+    groups = []
+    for c in descriptor:
+        value = DESCRIPTOR_INPUT_CHARSET.find(c)
+        if value < 0:
+            raise UnexpectedValueError(f"Invalid character {c!r} in descriptor.")
+        symbols.append(value & 31)
+        groups.append(value >> 5)
+        if len(groups) == 3:
+            symbols.append(groups[0] * 9 + groups[1] * 3 + groups[2])
+            groups = []
+    if len(groups) == 1:
+        symbols.append(groups[0])
+    elif len(groups) == 2:
+        symbols.append(groups[0] * 3 + groups[1])
+    checksum = descriptor_polymod(symbols + [0] * 8) ^ 1
+    return descriptor + '#' + ''.join(DESCRIPTOR_CHECKSUM_CHARSET[(checksum >> (5 * (7 - i))) & 31] for i in range(8))
+
+
+def format_address(chain, path, address, pubkey, blinding_privkey):
+    item = {
+        'path': path,
+        'address': address,
+        'pubkey': bytes(pubkey).hex()
+    }
+    if chain in ELEMENTS_CHAINS:
+        item['blinding_key'] = bytes(blinding_privkey).hex()
+    return item
+
+
+def get_import_request(format, chain, path, address, pubkey, blinding_privkey, timestamp='now', label=None):
+    """Watch-only import request of an address, for the importmulti or importdescriptors rpc
+    """
+    pubkey = bytes(pubkey).hex()
+    if format == 'importmulti':
+        request = {'scriptPubKey': {'address': address}, 'pubkeys': [pubkey], 'timestamp': timestamp, 'watchonly': True}
+        if chain in ELEMENTS_CHAINS:
+            request['blinding_privkey'] = bytes(blinding_privkey).hex()
+    elif format == 'importdescriptors':
+        if chain in ELEMENTS_CHAINS:
+            descriptor = f"ct({bytes(blinding_privkey).hex()},elwpkh({pubkey}))"
+        else:
+            descriptor = f"wpkh({pubkey})"
+        request = {'desc': add_descriptor_checksum(descriptor), 'timestamp': timestamp}
+    else:
+        raise UnexpectedValueError(f"Unknown import format {format}.")
+    if label is not None:
+        request['label'] = label
+    return request
+
+
+def iter_export(chain, fingerprint, account_path, start, count, format='ndjson', batch_size=IMPORT_BATCH,
+                timestamp='now', label=None, dir=KEYS_DIR):
+    """Yield the lines of an export of the addresses of an account, from index start to start + count - 1.
+    Addresses are derived as the lines are consumed, so memory use doesn't depend on count.
+    Exported addresses are not indexed, an export never writes to the keys dir.
+    """
+    if format not in EXPORT_FORMATS:
+        raise UnexpectedValueError(f"Unknown export format {format}, expected one of {', '.join(EXPORT_FORMATS)}.")
+    if batch_size < 1:
+        raise UnexpectedValueError("Import batches can't be empty.")
+
+    addresses = iter_addresses_from_path(chain, fingerprint, account_path, start, count, dir, index=False)
+    if format == 'ndjson':
+        for address in addresses:
+            yield json.dumps(format_address(chain, *address)) + '\n'
+        return
+
+    batch = []
+    for address in addresses:
+        batch.append(get_import_request(format, chain, *address, timestamp=timestamp, label=label))
+        if len(batch) == batch_size:
+            yield json.dumps(batch) + '\n'
+            batch = []
+    if batch:
+        yield json.dumps(batch) + '\n'
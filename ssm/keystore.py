@@ -0,0 +1,93 @@
+import errno
+import threading
+from os import path
+
+from ssm.exceptions import UnexpectedValueError
+from ssm.records import RecordFile
+
+# Name of the single file keystore in the keys dir. If it exists, keys are read from and written to
+# it, instead of one file per fingerprint in a dir per chain.
+KEYSTORE_FILE = 'keystore.bin'
+
+# Record body:
+# kind (1B) | chain (16B, zero padded) | fingerprint (4B) | key length (1B) | key (78B, zero padded)
+CHAIN_LEN = 16
+FINGERPRINT_LEN = 4
+KEY_MAX_LEN = 78  # BIP32 serialized key, master blinding keys are 64B
+KEY_OFFSET = 1 + CHAIN_LEN + FINGERPRINT_LEN + 1
+
+MASTERKEY = 0
+BLINDING_KEY = 1
+
+_keystores = {}
+_keystores_lock = threading.Lock()
+
+
+def pack_record(kind, chain, fingerprint, key):
+    key = bytes(key)
+    if len(key) > KEY_MAX_LEN:
+        raise UnexpectedValueError(f"Keys can't be longer than {KEY_MAX_LEN}B.")
+    return Keystore.seal(bytes([kind]) + chain.encode().ljust(CHAIN_LEN, b'\0') + bytes.fromhex(fingerprint)
+                            + bytes([len(key)]) + key.ljust(KEY_MAX_LEN, b'\0'))
+
+
+def check_fingerprint(fingerprint):
+    try:
+        return len(bytes.fromhex(fingerprint)) == FINGERPRINT_LEN
+    except (TypeError, ValueError):
+        return False
+
+
+class Keystore(RecordFile):
+    """Single file keystore, one record per (kind, chain, fingerprint), see ssm.records for the file format.
+    Saving a key again appends a new record that replaces the previous one.
+    """
+
+    MAGIC = b'SSMK'
+    RECORD_LEN = 128
+    BODY_LEN = KEY_OFFSET + KEY_MAX_LEN
+
+    def get_record_id(self, body):
+        chain = bytes(body[1:1 + CHAIN_LEN]).rstrip(b'\0').decode()
+        fingerprint = bytes(body[1 + CHAIN_LEN:1 + CHAIN_LEN + FINGERPRINT_LEN]).hex()
+        return body[0], chain, fingerprint
+
+    def get(self, kind, chain, fingerprint):
+        """Return the key as bytes, raise FileNotFoundError if it's not in the keystore
+        """
+        body = self.find((kind, chain, fingerprint))
+        if body is None:
+            raise FileNotFoundError(errno.ENOENT, f"No key {fingerprint} in keystore", self.filename)
+        return body[KEY_OFFSET:KEY_OFFSET + body[KEY_OFFSET - 1]]
+
+    def put(self, kind, chain, fingerprint, key):
+        self.append([pack_record(kind, chain, fingerprint, key)])
+
+
+def get_keystore(dir):
+    """Return the keystore of a keys dir, or None if it still uses the one file per key layout
+    """
+    filename = path.join(dir, KEYSTORE_FILE)
+    with _keystores_lock:
+        keystore = _keystores.get(filename)
+        if keystore is None:
+            if not path.isfile(filename):
+                return None
+            keystore = _keystores[filename] = Keystore(filename)
+        return keystore
+
+
+def create_keystore(dir, keys):
+    """Create the keystore of a keys dir from an iterable of (kind, chain, fingerprint, key).
+    The keystore is written aside and linked in place, so a failed creation leaves the keys dir untouched.
+    Return the number of keys written.
+    """
+    records = [pack_record(*key) for key in keys]
+    filename = path.join(dir, KEYSTORE_FILE)
+    try:
+        Keystore.create(filename, records)
+    except FileExistsError:
+        raise UnexpectedValueError(f"{filename} already exists.")
+    with _keystores_lock:
+        _keystores.pop(filename, None)
+    return len(records)
@@ -0,0 +1,190 @@
+import functools
+import threading
+from contextlib import nullcontext
+from time import perf_counter
+
+from ssm.cache import DERIVATION_CACHE, MASTERKEY_CACHE, PUBLIC_DERIVATION_CACHE
+
+# Metrics are only recorded when enabled, otherwise instrumented code only pays for a global lookup
+ENABLED = False
+
+# Upper bounds (in seconds) of the latency histograms buckets
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGE_SECONDS = 'ssm_stage_seconds'
+REQUEST_SECONDS = 'ssm_request_seconds'
+REQUESTS_TOTAL = 'ssm_requests_total'
+ERRORS_TOTAL = 'ssm_errors_total'
+CACHE_HITS_TOTAL = 'ssm_cache_hits_total'
+CACHE_MISSES_TOTAL = 'ssm_cache_misses_total'
+
+CACHES = {
+    'masterkey': MASTERKEY_CACHE,
+    'derivation': DERIVATION_CACHE,
+    'public_derivation': PUBLIC_DERIVATION_CACHE,
+}
+
+_lock = threading.Lock()
+# (name, labels) -> value
+_counters = {}
+# (name, labels) -> [count of each bucket..., sum, count]
+_histograms = {}
+# cache name -> (hits, misses) already counted
+_caches_seen = {}
+_null_stage = nullcontext()
+
+
+def configure(enabled):
+    global ENABLED
+    ENABLED = enabled
+
+
+def get_labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    if not ENABLED:
+        return
+    key = (name, get_labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    if not ENABLED:
+        return
+    key = (name, get_labels(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+class Stage(object):
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(STAGE_SECONDS, perf_counter() - self.start, stage=self.name)
+        return False
+
+
+def stage(name):
+    """Context manager recording the latency of a block of code as a stage of a request
+    """
+    if not ENABLED:
+        return _null_stage
+    return Stage(name)
+
+
+def timed(name):
+    """Decorator recording the latency of each call of a function as a stage of a request
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with Stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_caches():
+    """Count the cache hits and misses of this process since the last call
+    """
+    for name, cache in CACHES.items():
+        stats = cache.stats()
+        hits, misses = _caches_seen.get(name, (0, 0))
+        # Counters of the caches are never reset, but they may be recreated
+        if stats['hits'] < hits or stats['misses'] < misses:
+            hits, misses = 0, 0
+        inc(CACHE_HITS_TOTAL, stats['hits'] - hits, cache=name)
+        inc(CACHE_MISSES_TOTAL, stats['misses'] - misses, cache=name)
+        _caches_seen[name] = (stats['hits'], stats['misses'])
+
+
+def drain():
+    """Return the metrics recorded so far and forget them.
+    Used by worker processes to send their metrics to the process that serves them.
+    """
+    global _counters, _histograms
+    if not ENABLED:
+        return None
+    record_caches()
+    with _lock:
+        state = (_counters, _histograms)
+        _counters, _histograms = {}, {}
+    return state
+
+
+def merge(state):
+    """Add metrics drained from another process to ours
+    """
+    if state is None:
+        return
+    counters, histograms = state
+    with _lock:
+        for key, value in counters.items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, values in histograms.items():
+            histogram = _histograms.get(key)
+            if histogram is None:
+                _histograms[key] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    histogram[i] += value
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+def render():
+    """All the metrics in the Prometheus text exposition format
+    """
+    record_caches()
+    lines = []
+    with _lock:
+        for name in sorted({name for name, _ in _counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (n, labels), value in sorted(_counters.items()):
+                if n == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in _histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), histogram in sorted(_histograms.items()):
+                if n != name:
+                    continue
+                cumulated = 0
+                for bound, count in zip(BUCKETS, histogram):
+                    cumulated += count
+                    lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {cumulated}")
+                lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {histogram[-1]}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram[-2]}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram[-1]}")
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    global _counters, _histograms
+    with _lock:
+        _counters, _histograms = {}, {}
+        _caches_seen.clear()
@@ -0,0 +1,107 @@
+import logging
+import threading
+
+# multiprocessing and concurrent.futures are only imported when a pool is started,
+# they account for a large part of the import time of ssm.core
+
+# Number of worker processes used to sign large transactions, 0 or 1 disables parallel signing
+SIGN_WORKERS = 0
+# Transactions with less inputs to sign than this are always signed serially
+SIGN_THRESHOLD = 64
+# Number of inputs of the chunks given to a chunk runner
+CHUNK_SIZE = 128
+
+# When set, runner(fn, calls) runs fn(*call) for each call, the arguments of each signing chunk, instead
+# of the worker pool, e.g. the scheduler of the server, and returns their results in order. All signing
+# then goes through it.
+_runner = None
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def configure(workers=None, threshold=None):
+    """Set the number of signing workers and/or the parallel signing threshold.
+    The worker pool is recreated the next time it's needed.
+    """
+    global SIGN_WORKERS, SIGN_THRESHOLD
+    if threshold is not None:
+        SIGN_THRESHOLD = threshold
+    if workers is not None and workers != SIGN_WORKERS:
+        SIGN_WORKERS = workers
+        shutdown()
+
+
+def set_runner(runner, chunk_size=None):
+    """Run signing chunks with runner, or with the worker pool again if runner is None
+    """
+    global _runner, CHUNK_SIZE
+    _runner = runner
+    if chunk_size is not None:
+        CHUNK_SIZE = chunk_size
+
+
+def use_parallel(num_jobs):
+    if _runner is not None:
+        return num_jobs > 0
+    return SIGN_WORKERS > 1 and num_jobs >= max(SIGN_THRESHOLD, 2)
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            logging.info(f"Starting a pool of {SIGN_WORKERS} signing workers")
+            # Workers are forked from a clean server process rather than from a threaded caller
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = multiprocessing.get_context()
+            _executor = ProcessPoolExecutor(max_workers=SIGN_WORKERS, mp_context=context)
+        return _executor
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def split(jobs, parts):
+    """Split jobs in at most parts contiguous chunks of about the same size
+    """
+    size = -(-len(jobs) // parts)
+    return [jobs[i:i + size] for i in range(0, len(jobs), size)]
+
+
+def get_calls(args, engine, chunks):
+    """Arguments of fn for each chunk, jobs start with the index of their input
+    """
+    return [args + (engine.get_slice([job[0] for job in chunk]), chunk) for chunk in chunks]
+
+
+def map_chunks(fn, args, engine, jobs):
+    """Call fn(*args, engine slice, chunk) on the worker pool for each chunk of jobs, where engine is the
+    SighashEngine of the tx: each chunk gets the slice of it for its inputs rather than the whole tx.
+    fn must return a list with one result per job, results are returned flattened in jobs order.
+    If the pool is broken we return None, the caller should fall back to serial work.
+    With a runner, jobs are split in chunks of CHUNK_SIZE instead, whatever the number of workers.
+    """
+    if _runner is not None:
+        chunks = [jobs[i:i + CHUNK_SIZE] for i in range(0, len(jobs), CHUNK_SIZE)]
+        return [result for results in _runner(fn, get_calls(args, engine, chunks)) for result in results]
+
+    from concurrent.futures.process import BrokenProcessPool
+    calls = get_calls(args, engine, split(jobs, SIGN_WORKERS))
+    executor = get_executor()
+    try:
+        futures = [executor.submit(fn, *call) for call in calls]
+        return [result for future in futures for result in future.result()]
+    except BrokenProcessPool:
+        logging.warning("Signing worker pool is broken, it will be restarted")
+        shutdown()
+        return None
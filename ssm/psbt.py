@@ -0,0 +1,244 @@
+import base64
+import binascii
+from collections import namedtuple
+from io import BytesIO
+
+from ssm.exceptions import UnexpectedValueError
+from ssm.sighash import (
+    EXPLICIT_ASSET_LEN,
+    EXPLICIT_NONCE_LEN,
+    EXPLICIT_VALUE_LEN,
+    parse_tx,
+    read_confidential,
+    read_exactly,
+    read_varbytes,
+    varint,
+)
+from ssm.util import read_varint
+
+# BIP174 PSBT, version 0 for Bitcoin, and Elements PSET, built on BIP370 PSBT version 2
+PSBT_MAGIC = b'psbt\xff'
+PSET_MAGIC = b'pset\xff'
+
+PSBT_GLOBAL_UNSIGNED_TX = 0x00
+PSBT_GLOBAL_TX_VERSION = 0x02
+PSBT_GLOBAL_FALLBACK_LOCKTIME = 0x03
+PSBT_GLOBAL_INPUT_COUNT = 0x04
+PSBT_GLOBAL_OUTPUT_COUNT = 0x05
+PSBT_GLOBAL_VERSION = 0xfb
+
+PSBT_IN_WITNESS_UTXO = 0x01
+PSBT_IN_PARTIAL_SIG = 0x02
+PSBT_IN_SIGHASH_TYPE = 0x03
+PSBT_IN_BIP32_DERIVATION = 0x06
+PSBT_IN_FINAL_SCRIPTSIG = 0x07
+PSBT_IN_FINAL_SCRIPTWITNESS = 0x08
+PSBT_IN_PREVIOUS_TXID = 0x0e
+PSBT_IN_OUTPUT_INDEX = 0x0f
+PSBT_IN_SEQUENCE = 0x10
+PSBT_IN_REQUIRED_TIME_LOCKTIME = 0x11
+PSBT_IN_REQUIRED_HEIGHT_LOCKTIME = 0x12
+
+PSBT_OUT_AMOUNT = 0x03
+PSBT_OUT_SCRIPT = 0x04
+
+# Elements fields are proprietary fields with the "pset" prefix
+PSBT_PROPRIETARY = 0xfc
+PSET_PREFIX = b'pset'
+# Input subtypes below this one are issuances and peg-ins, that we can't sign yet
+PSET_IN_ISSUANCE_MAX = 0x0d
+PSET_OUT_VALUE_COMMITMENT = 0x01
+PSET_OUT_ASSET = 0x02
+PSET_OUT_ASSET_COMMITMENT = 0x03
+PSET_OUT_ECDH_PUBKEY = 0x07
+
+DEFAULT_SEQUENCE = b'\xff\xff\xff\xff'
+
+# value is an int in satoshis for Bitcoin, the serialized confidential value for Elements.
+# derivations is a list of (pubkey, fingerprint, path as a list of indexes).
+PsbtInput = namedtuple('PsbtInput', ['value', 'script', 'sighash', 'derivations', 'signed_pubkeys', 'final'])
+# tx is what parse_tx returns: (version, inputs, outputs, locktime)
+Psbt = namedtuple('Psbt', ['elements', 'tx', 'inputs'])
+
+
+def decode_psbt(psbt):
+    """PSBTs are base64, as bitcoind and elementsd return them, hex is accepted too
+    """
+    if isinstance(psbt, (bytes, bytearray)):
+        return bytes(psbt)
+    try:
+        return bytes.fromhex(psbt)
+    except ValueError:
+        pass
+    try:
+        return base64.b64decode(psbt, validate=True)
+    except (binascii.Error, ValueError):
+        raise UnexpectedValueError("PSBT must be base64 or hex.")
+
+
+def read_map(s):
+    """Read a map of key-value pairs up to its separator, return a dict key type -> [(key data, value)]
+    """
+    entries = {}
+    while True:
+        key = read_varbytes(s)
+        if not key:
+            return entries
+        value = read_varbytes(s)
+        entries.setdefault(key[0], []).append((key[1:], value))
+
+
+def get_field(entries, key_type, length=None):
+    """Value of a field that has no key data, or None if it's not in the map
+    """
+    for keydata, value in entries.get(key_type, []):
+        if not keydata:
+            if length is not None and len(value) != length:
+                raise UnexpectedValueError(f"PSBT field {key_type:#x} must be {length} bytes long.")
+            return value
+    return None
+
+
+def get_pset_fields(entries):
+    """Elements proprietary fields of a map, as a dict subtype -> value
+    """
+    fields = {}
+    for keydata, value in entries.get(PSBT_PROPRIETARY, []):
+        s = BytesIO(keydata)
+        if read_varbytes(s) == PSET_PREFIX:
+            fields[read_varint(s)] = value
+    return fields
+
+
+def parse_input(entries, elements=False):
+    sighash = get_field(entries, PSBT_IN_SIGHASH_TYPE, 4)
+    derivations = []
+    for pubkey, origin in entries.get(PSBT_IN_BIP32_DERIVATION, []):
+        if len(origin) < 4 or len(origin) % 4:
+            raise UnexpectedValueError("Invalid PSBT key origin.")
+        path = [int.from_bytes(origin[i:i + 4], 'little') for i in range(4, len(origin), 4)]
+        derivations.append((pubkey, origin[:4].hex(), path))
+
+    value, script = None, None
+    utxo = get_field(entries, PSBT_IN_WITNESS_UTXO)
+    if utxo is not None:
+        s = BytesIO(utxo)
+        if elements:
+            read_confidential(s, EXPLICIT_ASSET_LEN)
+            value = read_confidential(s, EXPLICIT_VALUE_LEN)
+            read_confidential(s, EXPLICIT_NONCE_LEN)
+        else:
+            value = int.from_bytes(read_exactly(s, 8), 'little')
+        script = read_varbytes(s)
+
+    return PsbtInput(
+        value=value,
+        script=script,
+        sighash=None if sighash is None else int.from_bytes(sighash, 'little'),
+        derivations=derivations,
+        signed_pubkeys={pubkey for pubkey, _ in entries.get(PSBT_IN_PARTIAL_SIG, [])},
+        final=PSBT_IN_FINAL_SCRIPTSIG in entries or PSBT_IN_FINAL_SCRIPTWITNESS in entries,
+    )
+
+
+def parse_psbt_v0(s):
+    globals_ = read_map(s)
+    version = get_field(globals_, PSBT_GLOBAL_VERSION, 4)
+    if version is not None and int.from_bytes(version, 'little') != 0:
+        raise UnexpectedValueError("Only version 0 PSBTs are supported on Bitcoin.")
+    tx = get_field(globals_, PSBT_GLOBAL_UNSIGNED_TX)
+    if tx is None:
+        raise UnexpectedValueError("PSBT has no unsigned transaction.")
+    # The unsigned transaction is serialized as the signature hashes need it, it's only parsed once
+    parts = parse_tx(BytesIO(tx))
+    inputs = [parse_input(read_map(s)) for _ in parts[1]]
+    for _ in parts[2]:
+        read_map(s)
+    return Psbt(False, parts, inputs)
+
+
+def get_locktime(globals_, inputs):
+    """Locktime of a version 2 PSBT, as specified in BIP370
+    """
+    times = [get_field(entries, PSBT_IN_REQUIRED_TIME_LOCKTIME, 4) for entries in inputs]
+    heights = [get_field(entries, PSBT_IN_REQUIRED_HEIGHT_LOCKTIME, 4) for entries in inputs]
+    constrained = [(time, height) for time, height in zip(times, heights) if time or height]
+    if not constrained:
+        fallback = get_field(globals_, PSBT_GLOBAL_FALLBACK_LOCKTIME, 4)
+        return fallback or bytes(4)
+    if all(height is not None for _, height in constrained):
+        values = [height for _, height in constrained]
+    elif all(time is not None for time, _ in constrained):
+        values = [time for time, _ in constrained]
+    else:
+        raise UnexpectedValueError("PSET inputs require incompatible locktimes.")
+    return max(int.from_bytes(value, 'little') for value in values).to_bytes(4, 'little')
+
+
+def serialize_pset_output(entries):
+    fields = get_pset_fields(entries)
+    script = get_field(entries, PSBT_OUT_SCRIPT)
+    if script is None:
+        raise UnexpectedValueError("PSET output has no script.")
+    if PSET_OUT_ASSET_COMMITMENT in fields:
+        asset = fields[PSET_OUT_ASSET_COMMITMENT]
+    elif PSET_OUT_ASSET in fields:
+        asset = b'\x01' + fields[PSET_OUT_ASSET]
+    else:
+        raise UnexpectedValueError("PSET output has no asset.")
+    if PSET_OUT_VALUE_COMMITMENT in fields:
+        value = fields[PSET_OUT_VALUE_COMMITMENT]
+    else:
+        amount = get_field(entries, PSBT_OUT_AMOUNT, 8)
+        if amount is None:
+            raise UnexpectedValueError("PSET output has no amount.")
+        value = b'\x01' + int.from_bytes(amount, 'little').to_bytes(8, 'big')
+    nonce = fields.get(PSET_OUT_ECDH_PUBKEY, b'\x00')
+    return asset + value + nonce + varint(len(script)) + script
+
+
+def parse_pset_v2(s):
+    globals_ = read_map(s)
+    version = get_field(globals_, PSBT_GLOBAL_VERSION, 4)
+    if version is None or int.from_bytes(version, 'little') != 2:
+        raise UnexpectedValueError("Only version 2 PSETs are supported.")
+    tx_version = get_field(globals_, PSBT_GLOBAL_TX_VERSION, 4)
+    num_inputs = get_field(globals_, PSBT_GLOBAL_INPUT_COUNT)
+    num_outputs = get_field(globals_, PSBT_GLOBAL_OUTPUT_COUNT)
+    if tx_version is None or num_inputs is None or num_outputs is None:
+        raise UnexpectedValueError("PSET has no transaction version or inputs and outputs count.")
+
+    input_maps = [read_map(s) for _ in range(read_varint(BytesIO(num_inputs)))]
+    output_maps = [read_map(s) for _ in range(read_varint(BytesIO(num_outputs)))]
+
+    tx_inputs = []
+    for entries in input_maps:
+        if any(subtype <= PSET_IN_ISSUANCE_MAX for subtype in get_pset_fields(entries)):
+            raise UnexpectedValueError("PSET inputs with issuances or peg-ins aren't supported.")
+        txid = get_field(entries, PSBT_IN_PREVIOUS_TXID, 32)
+        index = get_field(entries, PSBT_IN_OUTPUT_INDEX, 4)
+        if txid is None or index is None:
+            raise UnexpectedValueError("PSET input has no previous output.")
+        sequence = get_field(entries, PSBT_IN_SEQUENCE, 4) or DEFAULT_SEQUENCE
+        tx_inputs.append((txid + index, sequence, None))
+    tx_outputs = [serialize_pset_output(entries) for entries in output_maps]
+
+    parts = (tx_version, tx_inputs, tx_outputs, get_locktime(globals_, input_maps))
+    return Psbt(True, parts, [parse_input(entries, True) for entries in input_maps])
+
+
+def parse_psbt(psbt):
+    """Parse a base64 PSBT, or PSET for Elements, return a Psbt with the transaction parts that
+    signature hashes commit to, and what we need to know to sign each input.
+    """
+    s = BytesIO(decode_psbt(psbt))
+    magic = s.read(len(PSBT_MAGIC))
+    try:
+        if magic == PSBT_MAGIC:
+            return parse_psbt_v0(s)
+        elif magic == PSET_MAGIC:
+            return parse_pset_v2(s)
+    except IndexError:
+        # read_varint at the end of the data
+        raise UnexpectedValueError("PSBT is truncated.")
+    raise UnexpectedValueError("Not a PSBT or a PSET.")
@@ -0,0 +1,145 @@
+import abc
+import fcntl
+import hashlib
+import mmap
+import os
+import threading
+
+from ssm.exceptions import UnexpectedValueError
+
+HEADER_LEN = 16
+CHECKSUM_LEN = 4
+
+
+class RecordFile(abc.ABC):
+    """Append-only file of fixed-width records, read through mmap.
+
+    The file is a 16B header (magic, version, record length) followed by records. Each record
+    is a body of BODY_LEN bytes, the first 4B of its sha256, and zero padding up to RECORD_LEN.
+    Records are indexed by the id get_record_id returns, and the last record of an id wins.
+    Appends are a single write under an exclusive file lock, a record torn by a crash is
+    detected by its checksum and ignored. Only the records added since the last read are
+    scanned when the file grows, including those appended by other processes.
+
+    Subclasses set MAGIC, VERSION, RECORD_LEN and BODY_LEN, and implement get_record_id.
+    """
+
+    MAGIC = None
+    VERSION = 1
+    RECORD_LEN = None
+    BODY_LEN = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._map = None
+        self._scanned = HEADER_LEN
+        self._index = {}
+
+    @abc.abstractmethod
+    def get_record_id(self, body):
+        """Return the id of the record of a body, a hashable value"""
+
+    @classmethod
+    def get_header(cls):
+        header = cls.MAGIC + bytes([cls.VERSION]) + cls.RECORD_LEN.to_bytes(2, 'little')
+        return header.ljust(HEADER_LEN, b'\0')
+
+    @classmethod
+    def seal(cls, body):
+        """Return the record of a body, with its checksum and padding
+        """
+        body = bytes(body)
+        assert len(body) == cls.BODY_LEN
+        return (body + hashlib.sha256(body).digest()[:CHECKSUM_LEN]).ljust(cls.RECORD_LEN, b'\0')
+
+    @classmethod
+    def unseal(cls, record):
+        """Return the body of a record, or None if it's corrupted
+        """
+        body = record[:cls.BODY_LEN]
+        if hashlib.sha256(body).digest()[:CHECKSUM_LEN] != record[cls.BODY_LEN:cls.BODY_LEN + CHECKSUM_LEN]:
+            return None
+        return body
+
+    @classmethod
+    def create(cls, filename, records=()):
+        """Create the file with some records, atomically: it either fully exists or not at all.
+        Raise FileExistsError if the file already exists.
+        """
+        tmp = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(cls.get_header())
+            for record in records:
+                f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o600)
+        try:
+            # Unlike a rename, a link never replaces a file created meanwhile
+            os.link(tmp, filename)
+        finally:
+            os.unlink(tmp)
+        return cls(filename)
+
+    def _refresh(self):
+        # Caller must hold the lock
+        size = os.stat(self.filename).st_size
+        if self._map is not None and size == len(self._map):
+            return
+        with open(self.filename, 'rb') as f:
+            new_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if new_map[:HEADER_LEN] != self.get_header():
+            new_map.close()
+            raise UnexpectedValueError(f"{self.filename} is not a {type(self).__name__} file.")
+        for offset in range(self._scanned, size - self.RECORD_LEN + 1, self.RECORD_LEN):
+            body = self.unseal(new_map[offset:offset + self.RECORD_LEN])
+            if body is not None:
+                self._index[self.get_record_id(body)] = offset
+            self._scanned = offset + self.RECORD_LEN
+        if self._map is not None:
+            self._map.close()
+        self._map = new_map
+
+    def find(self, record_id):
+        """Return the body of the last record with this id, or None
+        """
+        with self._lock:
+            self._refresh()
+            offset = self._index.get(record_id)
+            if offset is None:
+                return None
+            return self._map[offset:offset + self.BODY_LEN]
+
+    def append(self, records):
+        if not records:
+            return
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            size = os.fstat(fd).st_size
+            # Drop the remains of a torn append, so that records stay aligned
+            aligned = HEADER_LEN + (size - HEADER_LEN) // self.RECORD_LEN * self.RECORD_LEN
+            if aligned != size:
+                os.ftruncate(fd, aligned)
+            os.write(fd, b''.join(records))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __contains__(self, record_id):
+        with self._lock:
+            self._refresh()
+            return record_id in self._index
+
+    def __iter__(self):
+        """Yield the ids of all the records
+        """
+        with self._lock:
+            self._refresh()
+            return iter(list(self._index))
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._index)
@@ -7,10 +7,12 @@ import http.client as httplib
 import base64
 import binascii
 import decimal
+import itertools
 import json
 import os
 import platform
 import sys
+import threading
 import urllib.parse as urlparse
 
 DEFAULT_USER_AGENT = "AuthServiceProxy/0.1"
@@ -19,6 +21,16 @@ DEFAULT_HTTP_TIMEOUT = 30
 
 DEFAULT_ELEMENTS_RPC_PORT = 7041
 
+# Max number of connections to a server, and how long a call waits for one of them
+DEFAULT_POOL_SIZE = 8
+DEFAULT_POOL_TIMEOUT = 30
+
+_pools = {}
+_pools_lock = threading.Lock()
+# (service_port, conf_file) -> (mtimes of the files read, service_url, authpair)
+_conf_cache = {}
+_conf_lock = threading.Lock()
+
 unhexlify = lambda h: binascii.unhexlify(h.encode('utf8'))
 hexlify = lambda b: binascii.hexlify(b).decode('utf8')
 
@@ -79,95 +91,187 @@ class InWarmupError(JSONRPCError):
     RPC_ERROR_CODE = -28
 
 
+def get_default_conf_file():
+    if platform.system() == 'Darwin':
+        conf_file = os.path.expanduser('~/Library/Application Support/Elements/')
+    elif platform.system() == 'Windows':
+        conf_file = os.path.join(os.environ['APPDATA'], 'Elements')
+    else:
+        conf_file = os.path.expanduser('~/.elements')
+    conf_file = os.path.join(conf_file, 'elements.conf')
+
+    # To avoid backward incompatibilty, try to look for the liquid
+    # binaries default dir and conf.
+    if not os.path.exists(conf_file):
+        if platform.system() == 'Darwin':
+            conf_file = os.path.expanduser('~/Library/Application Support/Liquid/')
+        elif platform.system() == 'Windows':
+            conf_file = os.path.join(os.environ['APPDATA'], 'Liquid')
+        else:
+            conf_file = os.path.expanduser('~/.liquid')
+        conf_file = os.path.join(conf_file, 'liquid.conf')
+    return conf_file
+
+
+def read_service_conf(service_port=None, conf_file=None):
+    """Return (service_url, authpair, files read) from the node configuration and cookie files
+    """
+    if conf_file is None:
+        conf_file = get_default_conf_file()
+
+    # Elements Core accepts empty rpcuser, not specified in conf_file
+    conf = {'rpcuser': ""}
+
+    # Extract contents of elements.conf to build service_url
+    try:
+        with open(conf_file, 'r') as fd:
+            for line in fd.readlines():
+                if '#' in line:
+                    line = line[:line.index('#')]
+                if '=' not in line:
+                    continue
+                k, v = line.split('=', 1)
+                conf[k.strip()] = v.strip()
+
+    # Treat a missing elements.conf as though it were empty
+    except FileNotFoundError:
+        pass
+
+    # if chain is specified, chain.key replaces key
+    chain = conf.get('chain', 'liquidv1')
+    for key in conf.copy():
+        if key.startswith(chain + '.'):
+            conf[key[(len(chain) + 1):]] = conf.pop(key)
+
+    if service_port is None:
+        service_port = DEFAULT_ELEMENTS_RPC_PORT
+    conf['rpcport'] = int(conf.get('rpcport', service_port))
+    conf['rpchost'] = conf.get('rpcconnect', 'localhost')
+
+    service_url = ('%s://%s:%d' %
+        ('http', conf['rpchost'], conf['rpcport']))
+
+    if 'rpcwallet' in conf:
+        service_url += ('/wallet/%s' % conf['rpcwallet'])
+
+    cookie_dir = conf.get('datadir', os.path.dirname(conf_file))
+    cookie_dir = os.path.join(cookie_dir, chain)
+    cookie_file = conf.get('rpccookiefile', os.path.join(cookie_dir, ".cookie"))
+    try:
+        with open(cookie_file, 'r') as fd:
+            authpair = fd.read()
+    except IOError as err:
+        if 'rpcpassword' in conf:
+            authpair = "%s:%s" % (conf['rpcuser'], conf['rpcpassword'])
+
+        else:
+            raise ValueError('Cookie file unusable (%s) and rpcpassword not specified in the configuration file: %r' % (err, conf_file))
+
+    return service_url, authpair, (conf_file, cookie_file)
+
+
+def get_mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_service_conf(service_port=None, conf_file=None, refresh=False):
+    """Same as read_service_conf without the files read, cached until one of the files changes.
+    The cookie file changes each time the node restarts.
+    """
+    key = (service_port, conf_file)
+    with _conf_lock:
+        cached = _conf_cache.get(key)
+    if cached is not None and not refresh:
+        mtimes, service_url, authpair = cached
+        if all(get_mtime(filename) == mtime for filename, mtime in mtimes):
+            return service_url, authpair
+
+    service_url, authpair, files = read_service_conf(service_port, conf_file)
+    mtimes = tuple((filename, get_mtime(filename)) for filename in files)
+    with _conf_lock:
+        _conf_cache[key] = (mtimes, service_url, authpair)
+    return service_url, authpair
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP connections to a server, shared by all the proxies and threads using it.
+    At most size connections are in use at once, the other calls wait for one to be released.
+    """
+
+    def __init__(self, host, port, timeout=DEFAULT_HTTP_TIMEOUT, size=DEFAULT_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def get(self, pool_timeout=DEFAULT_POOL_TIMEOUT):
+        """Return (connection, reused), the connection must then be given back with put
+        """
+        if not self._slots.acquire(timeout=pool_timeout):
+            raise JSONRPCError({
+                'code': -345, 'message': 'no HTTP connection available in the pool'})
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return httplib.HTTPConnection(self.host, port=self.port, timeout=self.timeout), False
+
+    def put(self, conn, reusable=True):
+        if reusable:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        """Close the idle connections, those in use are closed when they are given back
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def get_pool(host, port, timeout=DEFAULT_HTTP_TIMEOUT, size=DEFAULT_POOL_SIZE):
+    key = (host, port, timeout, size)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(host, port, timeout, size)
+        return pool
+
+
 class BaseProxy(object):
     """Base JSON-RPC proxy class. Contains only private methods; do not use
-    directly."""
+    directly.
+
+    Proxies of the same server share a pool of keep-alive connections, and the
+    parsed configuration of the node, so they are cheap to create. They can be
+    used from several threads.
+    """
 
     def __init__(self,
                  service_url=None,
                  service_port=None,
                  conf_file=None,
-                 timeout=DEFAULT_HTTP_TIMEOUT):
-
-        # Create a dummy connection early on so if __init__() fails prior to
-        # __conn being created __del__() can detect the condition and handle it
-        # correctly.
-        self.__conn = None
-        authpair = None
+                 timeout=DEFAULT_HTTP_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 pool_timeout=DEFAULT_POOL_TIMEOUT):
 
         if service_url is None:
-            # Figure out the path to the conf file
-            if conf_file is None:
-                if platform.system() == 'Darwin':
-                    conf_file = os.path.expanduser('~/Library/Application Support/Elements/')
-                elif platform.system() == 'Windows':
-                    conf_file = os.path.join(os.environ['APPDATA'], 'Elements')
-                else:
-                    conf_file = os.path.expanduser('~/.elements')
-                conf_file = os.path.join(conf_file, 'elements.conf')
-
-            # To avoid backward incompatibilty, try to look for the liquid
-            # binaries default dir and conf.
-            if not os.path.exists(conf_file):
-                if platform.system() == 'Darwin':
-                    conf_file = os.path.expanduser('~/Library/Application Support/Liquid/')
-                elif platform.system() == 'Windows':
-                    conf_file = os.path.join(os.environ['APPDATA'], 'Liquid')
-                else:
-                    conf_file = os.path.expanduser('~/.liquid')
-                conf_file = os.path.join(conf_file, 'liquid.conf')
-
-            # Elements Core accepts empty rpcuser, not specified in conf_file
-            conf = {'rpcuser': ""}
-
-            # Extract contents of elements.conf to build service_url
-            try:
-                with open(conf_file, 'r') as fd:
-                    for line in fd.readlines():
-                        if '#' in line:
-                            line = line[:line.index('#')]
-                        if '=' not in line:
-                            continue
-                        k, v = line.split('=', 1)
-                        conf[k.strip()] = v.strip()
-
-            # Treat a missing elements.conf as though it were empty
-            except FileNotFoundError:
-                pass
-
-            # if chain is specified, chain.key replaces key
-            chain = conf.get('chain', 'liquidv1')
-            for key in conf.copy():
-                if key.startswith(chain + '.'):
-                    conf[key[(len(chain) + 1):]] = conf.pop(key)
-
-            if service_port is None:
-                service_port = DEFAULT_ELEMENTS_RPC_PORT
-            conf['rpcport'] = int(conf.get('rpcport', service_port))
-            conf['rpchost'] = conf.get('rpcconnect', 'localhost')
-
-            service_url = ('%s://%s:%d' %
-                ('http', conf['rpchost'], conf['rpcport']))
-
-            if 'rpcwallet' in conf:
-                service_url += ('/wallet/%s' % conf['rpcwallet'])
-
-            cookie_dir = conf.get('datadir', os.path.dirname(conf_file))
-            cookie_dir = os.path.join(cookie_dir, chain)
-            cookie_file = conf.get('rpccookiefile', os.path.join(cookie_dir, ".cookie"))
-            try:
-                with open(cookie_file, 'r') as fd:
-                    authpair = fd.read()
-            except IOError as err:
-                if 'rpcpassword' in conf:
-                    authpair = "%s:%s" % (conf['rpcuser'], conf['rpcpassword'])
-
-                else:
-                    raise ValueError('Cookie file unusable (%s) and rpcpassword not specified in the configuration file: %r' % (err, conf_file))
-
+            service_url, authpair = get_service_conf(service_port, conf_file)
+            # Reloaded if the node rejects our credentials
+            self.__conf = (service_port, conf_file)
         else:
             url = urlparse.urlparse(service_url)
             authpair = "%s:%s" % (url.username, url.password)
+            self.__conf = None
 
         self.__service_url = service_url
         self.__url = urlparse.urlparse(service_url)
@@ -179,37 +283,25 @@ class BaseProxy(object):
             port = httplib.HTTP_PORT
         else:
             port = self.__url.port
-        self.__id_count = 0
+        self.__ids = itertools.count(1)
+        self.__set_auth(authpair)
+        self.__pool_timeout = pool_timeout
+        self.__pool = get_pool(self.__url.hostname, port, timeout, pool_size)
 
+    def __set_auth(self, authpair):
         if authpair is None:
             self.__auth_header = None
         else:
             authpair = authpair.encode('utf8')
             self.__auth_header = b"Basic " + base64.b64encode(authpair)
 
-        self.__conn = httplib.HTTPConnection(self.__url.hostname, port=port,
-                                             timeout=timeout)
-
     def _call(self, service_name, *args):
-        self.__id_count += 1
-
         postdata = json.dumps({'version': '1.1',
                                'method': service_name,
                                'params': args,
-                               'id': self.__id_count})
+                               'id': next(self.__ids)})
 
-        headers = {
-            'Host': self.__url.hostname,
-            'User-Agent': DEFAULT_USER_AGENT,
-            'Content-type': 'application/json',
-        }
-
-        if self.__auth_header is not None:
-            headers['Authorization'] = self.__auth_header
-
-        self.__conn.request('POST', self.__url.path, postdata, headers)
-
-        response = self._get_response()
+        response = self._request(postdata)
         if response['error'] is not None:
             raise JSONRPCError(response['error'])
         elif 'result' not in response:
@@ -219,36 +311,170 @@ class BaseProxy(object):
             return response['result']
 
     def _batch(self, rpc_call_list):
-        postdata = json.dumps(list(rpc_call_list))
+        """Send (method, params) calls in a single request, return one response per call in
+        the same order
+        """
+        calls = [{'version': '1.1', 'method': method, 'params': params, 'id': next(self.__ids)}
+                    for method, params in rpc_call_list]
+        if not calls:
+            return []
+        response = self._request(json.dumps(calls))
+        if isinstance(response, dict):
+            # The whole batch was rejected
+            raise JSONRPCError(response.get('error') or {
+                'code': -344, 'message': 'batch request rejected by server'})
+
+        # The server may answer in any order
+        responses = {item.get('id'): item for item in response if isinstance(item, dict)}
+        missing = {'result': None, 'error': {
+            'code': -343, 'message': 'missing JSON-RPC result'}}
+        return [responses.get(call['id'], missing) for call in calls]
+
+    def batch(self):
+        """Collect calls and send them in a single request, see Batch
+        """
+        return Batch(self)
+
+    def _request(self, postdata):
+        """POST postdata on a pooled connection and return the parsed response
+        """
+        for attempt in range(2):
+            headers = {
+                'Host': self.__url.hostname,
+                'User-Agent': DEFAULT_USER_AGENT,
+                'Content-type': 'application/json',
+            }
+
+            if self.__auth_header is not None:
+                headers['Authorization'] = self.__auth_header
+
+            conn, reused = self.__pool.get(self.__pool_timeout)
+            sent = False
+            try:
+                conn.request('POST', self.__url.path, postdata, headers)
+                sent = True
+                http_response = conn.getresponse()
+                body = http_response.read()
+            except (ConnectionError, httplib.BadStatusLine) as e:
+                self.__pool.put(conn, reusable=False)
+                # The server closed this keep-alive connection since its last use: sending fails, or it
+                # hangs up without a byte of response. It didn't run the request, so it's safe to send it
+                # again. Any other failure may come after the request ran, and calls like
+                # sendrawtransaction must not be sent twice.
+                stale = not sent or isinstance(e, httplib.RemoteDisconnected)
+                if reused and attempt == 0 and stale:
+                    continue
+                raise
+            except BaseException:
+                self.__pool.put(conn, reusable=False)
+                raise
+            self.__pool.put(conn, reusable=not http_response.will_close)
+
+            if http_response.status == 401 and self.__conf is not None and attempt == 0:
+                # The node restarted with a new cookie
+                _, authpair = get_service_conf(*self.__conf, refresh=True)
+                self.__set_auth(authpair)
+                continue
+            break
+
+        if not body:
+            raise JSONRPCError({
+                'code': -342, 'message': 'missing HTTP response from server (HTTP %d %s)'
+                    % (http_response.status, http_response.reason)})
 
-        headers = {
-            'Host': self.__url.hostname,
-            'User-Agent': DEFAULT_USER_AGENT,
-            'Content-type': 'application/json',
-        }
+        return json.loads(body.decode('utf8'), parse_float=decimal.Decimal)
 
-        if self.__auth_header is not None:
-            headers['Authorization'] = self.__auth_header
+    def close(self):
+        """Close the idle connections of the pool, which is shared by all the proxies of the same
+        server: the other proxies open new connections when they need them.
+        """
+        self.__pool.close()
+
+
+class BatchCall(object):
+    """A call of a batch, its result is available once the batch is sent"""
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.response = None
+
+    @property
+    def done(self):
+        return self.response is not None
+
+    def error(self):
+        """Return the JSONRPCError of the call, or None if it succeeded
+        """
+        if self.response is None:
+            raise ValueError('batch not sent yet')
+        if self.response.get('error') is not None:
+            return JSONRPCError(self.response['error'])
+        if 'result' not in self.response:
+            return JSONRPCError({
+                'code': -343, 'message': 'missing JSON-RPC result'})
+        return None
 
-        self.__conn.request('POST', self.__url.path, postdata, headers)
-        return self._get_response()
+    def result(self):
+        """Return the result of the call, or raise its JSONRPCError
+        """
+        error = self.error()
+        if error is not None:
+            raise error
+        return self.response['result']
 
-    def _get_response(self):
-        http_response = self.__conn.getresponse()
-        if http_response is None:
-            raise JSONRPCError({
-                'code': -342, 'message': 'missing HTTP response from server'})
 
-        return json.loads(http_response.read().decode('utf8'),
-                          parse_float=decimal.Decimal)
+class Batch(object):
+    """Calls collected to be sent in a single request
 
-    def close(self):
-        if self.__conn is not None:
-            self.__conn.close()
+    Usage:
+    with proxy.batch() as batch:
+        checks = [batch.validateaddress(address) for address in addresses]
+    valid = [check.result()['isvalid'] for check in checks]
+
+    Each call returns a BatchCall, the batch is sent when the with block exits
+    without an exception, or by send. results() returns the result of each call
+    in order, or its JSONRPCError instance instead of raising it.
+    """
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._calls = []
+
+    def call(self, method, *params):
+        call = BatchCall(method, params)
+        self._calls.append(call)
+        return call
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+
+        f = lambda *args: self.call(name, *args)
+        f.__name__ = name
+        return f
+
+    def __len__(self):
+        return len(self._calls)
+
+    def send(self):
+        calls = [call for call in self._calls if not call.done]
+        responses = self._proxy._batch((call.method, call.params) for call in calls)
+        for call, response in zip(calls, responses):
+            call.response = response
+        return self.results()
+
+    def results(self):
+        return [call.error() or call.result() for call in self._calls]
+
+    def __enter__(self):
+        return self
 
-    def __del__(self):
-        if self.__conn is not None:
-            self.__conn.close()
+    def __exit__(self, typ, value, stacktrace):
+        if typ is None:
+            self.send()
+        return False
 
 
 class RawProxy(BaseProxy):
@@ -263,11 +489,15 @@ class RawProxy(BaseProxy):
                  service_port=None,
                  conf_file=None,
                  timeout=DEFAULT_HTTP_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 pool_timeout=DEFAULT_POOL_TIMEOUT,
                  **kwargs):
         super(RawProxy, self).__init__(service_url=service_url,
                                        service_port=service_port,
                                        conf_file=conf_file,
                                        timeout=timeout,
+                                       pool_size=pool_size,
+                                       pool_timeout=pool_timeout,
                                        **kwargs)
 
     def __getattr__(self, name):
@@ -293,5 +523,7 @@ __all__ = (
     'VerifyRejectedError',
     'VerifyAlreadyInChainError',
     'InWarmupError',
+    'Batch',
+    'BatchCall',
     'RawProxy',
 )
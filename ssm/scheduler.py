@@ -0,0 +1,135 @@
+"""Fair scheduling of tasks from several clients on a shared executor.
+
+At most `slots` tasks run at the same time, the others wait in a queue per lane and client.
+Lanes are strict priorities: a task of a lane is only started when no task of a higher lane is
+waiting. Within a lane, clients share the slots in proportion to their weight (stride scheduling):
+each client has a pass, advanced by cost / weight each time one of its tasks starts, and the
+waiting client with the lowest pass goes next. Large jobs are meant to be submitted as many small
+tasks, so that a task of another client never waits for more than the end of one of them.
+"""
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from ssm.exceptions import UnexpectedValueError
+
+LANES = ['high', 'normal', 'low']
+DEFAULT_LANE = 'normal'
+DEFAULT_WEIGHT = 1
+
+
+class Client(object):
+    """Queue and counters of a client in one lane"""
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.tasks = deque()
+        self.pass_ = 0.0
+        self.running = 0
+        self.started = 0
+        self.cost = 0
+
+    def to_dict(self):
+        return {
+            'weight': self.weight,
+            'waiting': len(self.tasks),
+            'running': self.running,
+            'started': self.started,
+            'cost': self.cost,
+        }
+
+
+class Scheduler(object):
+
+    def __init__(self, executor, slots, lanes=LANES):
+        """executor is anything with a concurrent.futures submit method
+        """
+        self.executor = executor
+        self.slots = slots
+        self.lanes = list(lanes)
+        self.running = 0
+        self._lock = threading.Lock()
+        # lane -> client name -> Client
+        self._clients = {lane: {} for lane in self.lanes}
+        # pass of the last task started in each lane, where idle clients start again from
+        self._vtime = {lane: 0.0 for lane in self.lanes}
+
+    def submit(self, client, fn, *args, lane=DEFAULT_LANE, weight=DEFAULT_WEIGHT, cost=1):
+        """Queue fn(*args) for client, return a Future of its result.
+        weight is that of the client in its lane, cost the share of the client it uses, e.g.
+        the number of inputs of a signing chunk.
+        """
+        if lane not in self._clients:
+            raise UnexpectedValueError(f"Unknown lane {lane}.")
+        future = Future()
+        with self._lock:
+            state = self._clients[lane].get(client)
+            if state is None:
+                state = self._clients[lane][client] = Client(weight)
+            state.weight = weight
+            if not state.tasks:
+                # Idle clients don't bank credit for the time they didn't use
+                state.pass_ = max(state.pass_, self._vtime[lane])
+            state.tasks.append((fn, args, future, cost))
+        self._dispatch()
+        return future
+
+    def _next(self):
+        """Pop the next task to start, with the lock held, or return None
+        """
+        for lane in self.lanes:
+            waiting = [state for state in self._clients[lane].values() if state.tasks]
+            if not waiting:
+                continue
+            state = min(waiting, key=lambda state: state.pass_)
+            fn, args, future, cost = state.tasks.popleft()
+            self._vtime[lane] = state.pass_
+            state.pass_ += cost / state.weight
+            state.running += 1
+            state.started += 1
+            state.cost += cost
+            return state, fn, args, future
+        return None
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if self.running >= self.slots:
+                    return
+                task = self._next()
+                if task is None:
+                    return
+                self.running += 1
+            state, fn, args, future = task
+            if not future.set_running_or_notify_cancel():
+                self._finished(state)
+                continue
+            try:
+                inner = self.executor.submit(fn, *args)
+            except Exception as e:
+                future.set_exception(e)
+                self._finished(state)
+                continue
+            inner.add_done_callback(lambda inner, state=state, future=future: self._done(inner, state, future))
+
+    def _done(self, inner, state, future):
+        try:
+            future.set_result(inner.result())
+        except Exception as e:
+            future.set_exception(e)
+        self._finished(state)
+
+    def _finished(self, state):
+        with self._lock:
+            self.running -= 1
+            state.running -= 1
+        self._dispatch()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'slots': self.slots,
+                'running': self.running,
+                'lanes': {lane: {name: state.to_dict() for name, state in clients.items()}
+                            for lane, clients in self._clients.items()},
+            }
@@ -0,0 +1,271 @@
+import hashlib
+from collections import namedtuple
+from io import BytesIO
+
+from wallycore import (
+    WALLY_SIGHASH_ALL,
+    WALLY_SIGHASH_NONE,
+    WALLY_SIGHASH_SINGLE,
+    WALLY_SIGHASH_ANYONECANPAY,
+)
+
+from ssm.util import read_varint
+from ssm.exceptions import UnexpectedValueError
+
+# Elements encodes the issuance and peg-in flags in the 2 high bits of the prevout index
+OUTPOINT_ISSUANCE_FLAG = 1 << 31
+OUTPOINT_PEGIN_FLAG = 1 << 30
+OUTPOINT_INDEX_MASK = 0x3fffffff
+COINBASE_INDEX = 0xffffffff
+
+# Length of the explicit (non blinded) confidential fields, prefix byte included
+EXPLICIT_ASSET_LEN = 33
+EXPLICIT_VALUE_LEN = 9
+EXPLICIT_NONCE_LEN = 33
+
+# Smallest serialized input: outpoint, empty scriptSig and sequence
+MIN_INPUT_SIZE = 41
+
+TxHeader = namedtuple('TxHeader', ['version', 'has_witness', 'num_inputs'])
+
+ZERO_HASH = bytes(32)
+SIGHASH_TYPES = [
+    WALLY_SIGHASH_ALL,
+    WALLY_SIGHASH_NONE,
+    WALLY_SIGHASH_SINGLE,
+    WALLY_SIGHASH_ALL | WALLY_SIGHASH_ANYONECANPAY,
+    WALLY_SIGHASH_NONE | WALLY_SIGHASH_ANYONECANPAY,
+    WALLY_SIGHASH_SINGLE | WALLY_SIGHASH_ANYONECANPAY,
+]
+
+
+def sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def varint(n):
+    if n < 0xfd:
+        return bytes([n])
+    elif n <= 0xffff:
+        return b'\xfd' + n.to_bytes(2, 'little')
+    elif n <= 0xffffffff:
+        return b'\xfe' + n.to_bytes(4, 'little')
+    return b'\xff' + n.to_bytes(8, 'little')
+
+def read_exactly(s, n):
+    data = s.read(n)
+    if len(data) != n:
+        raise UnexpectedValueError("Transaction is truncated.")
+    return data
+
+def read_varbytes(s):
+    """Read a varint length prefixed field of a BytesIO
+    """
+    n = read_varint(s)
+    # A length can be up to 2^64, more than read accepts
+    if n > len(s.getbuffer()) - s.tell():
+        raise UnexpectedValueError("Transaction is truncated.")
+    return read_exactly(s, n)
+
+def read_confidential(s, explicit_len):
+    """Read a confidential asset, value or nonce: either null, explicit or a 33B commitment
+    """
+    prefix = read_exactly(s, 1)
+    if prefix[0] == 0:
+        return prefix
+    elif prefix[0] == 1:
+        return prefix + read_exactly(s, explicit_len - 1)
+    return prefix + read_exactly(s, 32)
+
+def parse_tx(s, elements=False):
+    """Read the parts of a serialized transaction that its signature hashes commit to.
+    Witnesses are skipped, since signature hashes don't commit to them.
+    Return (version, inputs, outputs, locktime) where each input is a tuple
+    (outpoint, sequence, issuance or None) and each output is its serialization, all as bytes.
+    """
+    version = read_exactly(s, 4)
+    has_witness = False
+    if elements:
+        # Elements always has a flag byte, witnesses come after the locktime
+        read_exactly(s, 1)
+        num_inputs = read_varint(s)
+    else:
+        num_inputs = read_varint(s)
+        if num_inputs == 0:
+            # Segwit marker, skip the flag and read the real number of inputs
+            read_exactly(s, 1)
+            num_inputs = read_varint(s)
+            has_witness = True
+
+    inputs = []
+    for _ in range(num_inputs):
+        txhash = read_exactly(s, 32)
+        index = int.from_bytes(read_exactly(s, 4), 'little')
+        read_varbytes(s)  # scriptSig
+        sequence = read_exactly(s, 4)
+        issuance = None
+        if elements and index != COINBASE_INDEX:
+            has_issuance = index & OUTPOINT_ISSUANCE_FLAG
+            index &= OUTPOINT_INDEX_MASK
+            if has_issuance:
+                # blinding nonce, entropy, amount and inflation keys
+                issuance = (read_exactly(s, 64) + read_confidential(s, EXPLICIT_VALUE_LEN)
+                                + read_confidential(s, EXPLICIT_VALUE_LEN))
+        inputs.append((txhash + index.to_bytes(4, 'little'), sequence, issuance))
+
+    num_outputs = read_varint(s)
+    outputs = []
+    for _ in range(num_outputs):
+        if elements:
+            output = (read_confidential(s, EXPLICIT_ASSET_LEN) + read_confidential(s, EXPLICIT_VALUE_LEN)
+                        + read_confidential(s, EXPLICIT_NONCE_LEN))
+        else:
+            output = read_exactly(s, 8)
+        script = read_varbytes(s)
+        outputs.append(output + varint(len(script)) + script)
+
+    if has_witness:
+        for _ in range(num_inputs):
+            for _ in range(read_varint(s)):
+                read_varbytes(s)
+    locktime = read_exactly(s, 4)
+    return version, inputs, outputs, locktime
+
+def read_tx_header(s, size, elements=False):
+    """Read the version, segwit flag and number of inputs of a serialized transaction of size bytes,
+    without parsing it. A number of inputs that can't fit in the remaining bytes is rejected.
+    Return a TxHeader.
+    """
+    try:
+        version = int.from_bytes(read_exactly(s, 4), 'little')
+        if elements:
+            has_witness = read_exactly(s, 1)[0] == 1
+            num_inputs = read_varint(s)
+        else:
+            num_inputs = read_varint(s)
+            has_witness = num_inputs == 0
+            if has_witness:
+                if read_exactly(s, 1)[0] != 1:
+                    raise UnexpectedValueError("Transaction has an invalid segwit flag.")
+                num_inputs = read_varint(s)
+    except IndexError:
+        # read_varint at the end of the data
+        raise UnexpectedValueError("Transaction is truncated.")
+    if num_inputs * MIN_INPUT_SIZE > size - s.tell():
+        raise UnexpectedValueError(f"Transaction is too short for {num_inputs} inputs.")
+    return TxHeader(version, has_witness, num_inputs)
+
+
+class SighashEngine(object):
+    """Segwit v0 (BIP143) signature hashes for all the inputs of a transaction.
+
+    The transaction is parsed once, and the hashes shared by all inputs (hashPrevouts,
+    hashSequence, hashIssuance for Elements and hashOutputs) are computed once per sighash
+    type, along with the sha256 midstate of the part of the preimage that comes before the input.
+    Each input then only costs the hashing of its own outpoint, scriptCode, value and sequence.
+
+    Usage:
+    engine = SighashEngine(bytes.fromhex(tx_hex), elements=False)
+    sighash = engine.get_sighash(index, scriptCode, value)
+
+    tx can also be the (version, inputs, outputs, locktime) tuple parse_tx returns, for transactions
+    that are not serialized, like those of a PSET.
+    """
+
+    def __init__(self, tx, elements=False):
+        self.elements = elements
+        if isinstance(tx, tuple):
+            self.version, self.inputs, self.outputs, self.locktime = tx
+        else:
+            self.version, self.inputs, self.outputs, self.locktime = parse_tx(BytesIO(tx), elements)
+        self.num_inputs = len(self.inputs)
+        self.num_outputs = len(self.outputs)
+        self._midstates = {}
+        # hashPrevouts, hashSequence, hashIssuance and hashOutputs, computed when first needed
+        self._hashes = {}
+
+    def get_hash(self, name, get_data):
+        h = self._hashes.get(name)
+        if h is None:
+            h = self._hashes[name] = sha256d(get_data())
+        return h
+
+    def get_hash_prevouts(self):
+        return self.get_hash('prevouts', lambda: b''.join(outpoint for outpoint, _, _ in self.inputs))
+
+    def get_hash_sequence(self):
+        return self.get_hash('sequence', lambda: b''.join(sequence for _, sequence, _ in self.inputs))
+
+    def get_hash_issuance(self):
+        return self.get_hash('issuance', lambda: b''.join(issuance or b'\x00' for _, _, issuance in self.inputs))
+
+    def get_hash_outputs(self):
+        return self.get_hash('outputs', lambda: b''.join(self.outputs))
+
+    def get_slice(self, indexes):
+        """Engine of the inputs at indexes only, with the hashes shared by all inputs already computed.
+        This is all that signing these inputs needs, and much less to send to a worker than the tx.
+        """
+        engine = SighashEngine.__new__(SighashEngine)
+        engine.elements = self.elements
+        engine.version = self.version
+        engine.locktime = self.locktime
+        engine.num_inputs = self.num_inputs
+        engine.num_outputs = self.num_outputs
+        # index -> input or output, SIGHASH_SINGLE signs the output at the index of the input
+        engine.inputs = {i: self.inputs[i] for i in indexes if 0 <= i < self.num_inputs}
+        engine.outputs = {i: self.outputs[i] for i in indexes if 0 <= i < self.num_outputs}
+        engine._midstates = {}
+        engine._hashes = {
+            'prevouts': self.get_hash_prevouts(),
+            'sequence': self.get_hash_sequence(),
+            'outputs': self.get_hash_outputs(),
+        }
+        if self.elements:
+            engine._hashes['issuance'] = self.get_hash_issuance()
+        return engine
+
+    def get_midstate(self, sighash):
+        """sha256 state after version, hashPrevouts, hashSequence and hashIssuance for this sighash type
+        """
+        midstate = self._midstates.get(sighash)
+        if midstate is None:
+            if sighash not in SIGHASH_TYPES:
+                raise UnexpectedValueError(f"Unsupported sighash type {sighash}.")
+            anyonecanpay = sighash & WALLY_SIGHASH_ANYONECANPAY
+            base = sighash & 0x1f
+            midstate = hashlib.sha256(self.version)
+            midstate.update(ZERO_HASH if anyonecanpay else self.get_hash_prevouts())
+            if anyonecanpay or base in [WALLY_SIGHASH_NONE, WALLY_SIGHASH_SINGLE]:
+                midstate.update(ZERO_HASH)
+            else:
+                midstate.update(self.get_hash_sequence())
+            if self.elements:
+                midstate.update(ZERO_HASH if anyonecanpay else self.get_hash_issuance())
+            self._midstates[sighash] = midstate
+        return midstate
+
+    def get_sighash(self, index, scriptCode, value, sighash=WALLY_SIGHASH_ALL):
+        """value is an int in satoshis for Bitcoin, and the serialized confidential value for Elements
+        """
+        if not 0 <= index < self.num_inputs:
+            raise UnexpectedValueError(f"Input {index} is out of range.")
+        base = sighash & 0x1f
+        outpoint, sequence, issuance = self.inputs[index]
+
+        h = self.get_midstate(sighash).copy()
+        h.update(outpoint)
+        h.update(varint(len(scriptCode)))
+        h.update(scriptCode)
+        h.update(bytes(value) if self.elements else value.to_bytes(8, 'little'))
+        h.update(sequence)
+        if issuance is not None:
+            h.update(issuance)
+        if base == WALLY_SIGHASH_SINGLE:
+            h.update(sha256d(self.outputs[index]) if index < self.num_outputs else ZERO_HASH)
+        elif base == WALLY_SIGHASH_NONE:
+            h.update(ZERO_HASH)
+        else:
+            h.update(self.get_hash_outputs())
+        h.update(self.locktime)
+        h.update(sighash.to_bytes(4, 'little'))
+        return hashlib.sha256(h.digest()).digest()
@@ -1,7 +1,7 @@
 import logging, json
 from binascii import hexlify, unhexlify
 from io import BytesIO
-from os import path, mkdir
+from os import path, mkdir, listdir
 from wallycore import (
     sha256d,
     bip32_key_unserialize,
@@ -22,13 +22,15 @@ from ssm.exceptions import (
     OwnProposalError,
 )
 
-CHAINS = [
-    'bitcoin-main', 
-    'bitcoin-test', 
-    'bitcoin-regtest', 
-    'liquidv1', 
-    'elements-regtest',
-]
+from ssm.cache import (
+    MASTERKEY_CACHE,
+    DERIVATION_CACHE,
+    PUBLIC_DERIVATION_CACHE,
+)
+import ssm.keystore as keystore
+import ssm.metrics as metrics
+
+from ssm.constants import CHAINS
 
 CA_PREFIXES = {
     'liquidv1': 'lq',
@@ -71,6 +73,18 @@ def is_mine(address, connection):
         raise InvalidAddressError('Invalid address: {}'.format(address))
     return connection.getaddressinfo(address)['ismine']
 
+def are_mine(addresses, connection):
+    """Same as is_mine for a list of addresses, checked in a single request to the node
+    """
+    with connection.batch() as batch:
+        checks = [(batch.validateaddress(address), batch.getaddressinfo(address)) for address in addresses]
+    mine = []
+    for address, (validate, info) in zip(addresses, checks):
+        if not validate.result()['isvalid']:
+            raise InvalidAddressError('Invalid address: {}'.format(address))
+        mine.append(info.result()['ismine'])
+    return mine
+
 
 def check_wallet_unlocked(connection):
     """Raise error if wallet is locked
@@ -104,16 +118,6 @@ def do_initial_checks(connection, expect_mainnet, expect_network):
     """
     check_network(expect_mainnet, expect_network, connection)
 
-def set_logging(verbose):
-    """Set logging level
-    """
-
-    logging.basicConfig(format='SSM %(levelname)s %(message)s')
-    if verbose == 1:
-        logging.root.setLevel(logging.INFO)
-    elif verbose > 1:
-        logging.root.setLevel(logging.DEBUG)
-
 def harden(idx):
     if idx[-1] == '\'' or idx[-1] == 'h':
         try:
@@ -134,6 +138,7 @@ def save_to_disk(data, file):
     with open(file, 'wb') as f:
         f.write(data)
 
+@metrics.timed('disk_read')
 def retrieve_from_disk(file):
     with open(file, 'rb') as f:
         data = f.read()
@@ -165,31 +170,85 @@ def get_txid(tx):
     "Return the double sha256 hash of the tx"
     return sha256d(tx)
 
+def masterkey_cache_key(chain, fingerprint, blindingkey=False, dir=KEYS_DIR):
+    """Blinding keys are stored in a single dir whatever the chain, so the chain is not part of their key
+    """
+    return (str(dir), BLINDING_KEYS_DIR if blindingkey else chain, fingerprint, blindingkey)
+
 def get_masterkey_from_disk(chain, fingerprint, blindingkey=False, dir=KEYS_DIR):
-    if blindingkey:
-        dir = path.join(dir, BLINDING_KEYS_DIR)
+    cache_key = masterkey_cache_key(chain, fingerprint, blindingkey, dir)
+    masterkey = MASTERKEY_CACHE.get(cache_key)
+    if masterkey is not None:
+        return masterkey
+
+    store = keystore.get_keystore(dir)
+    if store is not None:
+        with metrics.stage('disk_read'):
+            masterkey_bin = store.get(keystore.BLINDING_KEY if blindingkey else keystore.MASTERKEY, 
+                                        '' if blindingkey else chain, fingerprint)
     else:
-        dir = path.join(dir, chain)
-    check_dir(dir)
-    filename = path.join(dir, fingerprint)
-    masterkey_bin = retrieve_from_disk(filename)
+        if blindingkey:
+            dir = path.join(dir, BLINDING_KEYS_DIR)
+        else:
+            dir = path.join(dir, chain)
+        check_dir(dir)
+        filename = path.join(dir, fingerprint)
+        masterkey_bin = retrieve_from_disk(filename)
     if blindingkey:
-        return masterkey_bin
+        masterkey = masterkey_bin
     else:
-        return bip32_key_unserialize(masterkey_bin)
+        with metrics.stage('unserialize'):
+            masterkey = bip32_key_unserialize(masterkey_bin)
+    MASTERKEY_CACHE.put(cache_key, masterkey)
+    return masterkey
 
 def save_masterkey_to_disk(chain, masterkey, fingerprint, blindingkey=False, dir=KEYS_DIR):
+    cache_key = masterkey_cache_key(chain, fingerprint, blindingkey, dir)
+    store = keystore.get_keystore(dir)
     if blindingkey:
         dir = path.join(dir, BLINDING_KEYS_DIR)
         masterkey_bin = masterkey
     else:
         dir = path.join(dir, chain)
         masterkey_bin = bip32_key_serialize(masterkey, BIP32_FLAG_KEY_PRIVATE)
-    check_dir(dir)
-    # TODO: check that a file with the same fingerprint doesn't exist. 
-    # The probability to have a collision on a fingerprint is small, but still
-    filename = path.join(dir, fingerprint)
-    save_to_disk(masterkey_bin, filename)
+    if store is not None:
+        store.put(keystore.BLINDING_KEY if blindingkey else keystore.MASTERKEY, 
+                    '' if blindingkey else chain, fingerprint, masterkey_bin)
+    else:
+        check_dir(dir)
+        # TODO: check that a file with the same fingerprint doesn't exist. 
+        # The probability to have a collision on a fingerprint is small, but still
+        filename = path.join(dir, fingerprint)
+        save_to_disk(masterkey_bin, filename)
+    # Whatever was cached for this fingerprint is stale from now on
+    MASTERKEY_CACHE.invalidate(cache_key)
+    if not blindingkey:
+        DERIVATION_CACHE.invalidate_master(cache_key)
+        PUBLIC_DERIVATION_CACHE.invalidate_master(cache_key)
+
+def migrate_to_keystore(dir=KEYS_DIR):
+    """Copy all the master keys and master blinding keys of a keys dir to a new single file keystore,
+    which is then used instead of the one file per key layout. Old files are left untouched.
+    Return the number of keys migrated.
+    """
+    def iter_keys():
+        for chain in CHAINS:
+            chain_dir = path.join(dir, chain)
+            if not path.isdir(chain_dir):
+                continue
+            for fingerprint in sorted(listdir(chain_dir)):
+                if keystore.check_fingerprint(fingerprint):
+                    yield keystore.MASTERKEY, chain, fingerprint, retrieve_from_disk(path.join(chain_dir, fingerprint))
+        blinding_dir = path.join(dir, BLINDING_KEYS_DIR)
+        if path.isdir(blinding_dir):
+            for fingerprint in sorted(listdir(blinding_dir)):
+                if keystore.check_fingerprint(fingerprint):
+                    yield keystore.BLINDING_KEY, '', fingerprint, retrieve_from_disk(path.join(blinding_dir, fingerprint))
+
+    count = keystore.create_keystore(dir, iter_keys())
+    # Cached keys are still valid, but make sure the next reads go through the keystore
+    MASTERKEY_CACHE.clear()
+    return count
 
 def save_salt_to_disk(fingerprint, salt):
     dir = path.join(KEYS_DIR, 'salt')
@@ -0,0 +1,81 @@
+import pytest
+import threading
+from os import path
+
+from ssm.core import (
+    get_address_from_path,
+    restore_hd_wallet,
+)
+
+from ssm.address_pool import (
+    AddressPool,
+    ADDRESS_POOL_FILE,
+    RESERVE_BLOCK,
+)
+
+import ssm.core as core
+import ssm.exceptions as exceptions
+
+HDKEY_TEST = "tprv8ZgxMBicQKsPe8NFkADNQ7GMKyBkaWTRkrHStwdzcR9HvRbjbq6bNi37G3biAFtUE4hUmnuHojdqJdnqQ9qETcszgW41gn1e2GMjimt8HCQ"
+BLINDING_KEY = "cf215ffecd670b7427b2fc90ee129ab6f801c1deed4a1b9b1b0341a8c05d8a43aafb994891a4d42e9afefd0614d497e65d572f939e04190659f93f5bad8d446e"
+ACCOUNT = "84h/1h/0h/0"
+
+def wait_refill(pool):
+    for _ in range(100):
+        with pool._lock:
+            if not any(p.refilling for p in pool._pools.values()):
+                return
+        threading.Event().wait(0.01)
+
+@pytest.mark.parametrize("chain", ["bitcoin-regtest", "elements-regtest"])
+def test_address_pool(chain, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    fingerprint = restore_hd_wallet(chain, HDKEY_TEST, BLINDING_KEY, keys_dir)
+    derive = lambda *args: core.get_addresses_from_path(*args, keys_dir)
+    pool = AddressPool(keys_dir, derive, high_water=10, low_water=5)
+
+    issued = [pool.next_address(chain, fingerprint, ACCOUNT)]
+    wait_refill(pool)
+    issued += [pool.next_address(chain, fingerprint, ACCOUNT) for _ in range(24)]
+    for i, (path, address, pubkey, bkey) in enumerate(issued):
+        assert path == f"{ACCOUNT}/{i}"
+        assert (address, pubkey, bkey) == get_address_from_path(chain, fingerprint, path, keys_dir)
+
+    # After a restart, issuance resumes after the last reserved block
+    restarted = AddressPool(keys_dir, derive, high_water=10, low_water=5)
+    path, _, _, _ = restarted.next_address(chain, fingerprint, ACCOUNT)
+    assert path == f"{ACCOUNT}/{2 * RESERVE_BLOCK}"
+
+def test_address_pool_wrong_account(tmpdir):
+    pool = AddressPool(tmpdir.mkdir("ssm_keys"))
+    with pytest.raises(exceptions.UnexpectedValueError):
+        pool.next_address("bitcoin-regtest", "a2ef94f8", "0/1/2/3/4/5/6/7")
+
+def test_address_pool_keys_dir(tmpdir):
+    # Addresses are derived from the keys dir of the pool
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    chain = "bitcoin-regtest"
+    fingerprint = restore_hd_wallet(chain, HDKEY_TEST, None, keys_dir)
+    pool = AddressPool(keys_dir, high_water=10, low_water=5)
+    path_, address, _, _ = pool.next_address(chain, fingerprint, ACCOUNT)
+    wait_refill(pool)
+    assert address == get_address_from_path(chain, fingerprint, path_, keys_dir)[0]
+    assert pool.stats()[f"{chain}/{fingerprint}/{ACCOUNT}"]['available'] > 0
+
+@pytest.mark.parametrize("chain,fingerprint", [
+    ("bitcoin-regtest", "abcd"),
+    ("bitcoin-regtest", "zz"),
+    ("bitcoin-regtest", None),
+    ("bitcoin-regtest", "deadbeef"),
+    ("not-a-chain-with-a-long-name", "deadbeef"),
+])
+def test_address_pool_unknown_key(chain, fingerprint, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    restore_hd_wallet("bitcoin-regtest", HDKEY_TEST, None, keys_dir)
+    pool = AddressPool(keys_dir)
+    with pytest.raises(exceptions.UnexpectedValueError):
+        pool.next_address(chain, fingerprint, ACCOUNT)
+    # Nothing is reserved or queued for refill
+    assert pool.stats() == {}
+    assert not path.isfile(path.join(keys_dir, ADDRESS_POOL_FILE))
+    assert pool._thread is None
@@ -0,0 +1,93 @@
+import pytest
+import json
+import sys
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'server'))
+
+import batch
+import server
+import ssm.parallel as parallel
+
+# The server signs on all the cores, tests sign in the calling thread
+parallel.configure(workers=0)
+
+ENDPOINT = '/api/v1'
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+def call(method, params=None, id=None):
+    call = {"jsonrpc": "2.0", "method": method, "params": params or []}
+    if id is not None:
+        call["id"] = id
+    return call
+
+def post(client, data):
+    return client.post(ENDPOINT, data=json.dumps(data), content_type='application/json')
+
+def test_batch_order(client):
+    calls = [call("server_status", id=i) if i % 2 else call("no_such_method", id=i) for i in range(10)]
+    responses = post(client, calls).get_json()
+    assert [response["id"] for response in responses] == list(range(10))
+    for i, response in enumerate(responses):
+        if i % 2:
+            assert "methods" in response["result"]
+        else:
+            assert response["error"]["code"] == batch.METHOD_NOT_FOUND
+
+def test_batch_notifications(client):
+    responses = post(client, [call("server_status"), call("server_status", id=1), call("server_status")]).get_json()
+    assert [response["id"] for response in responses] == [1]
+    # Nothing to answer when all the calls are notifications
+    response = post(client, [call("server_status"), call("server_status")])
+    assert response.status_code == 204 and not response.data
+
+def test_batch_errors(client):
+    calls = [
+        call("new_address", ["bitcoin-regtest", "deadbeef", "0h/1"], id="unknown key"),
+        call("server_status", id="ok"),
+        call("server_status", ["unexpected"], id="too many params"),
+        call("server_status", {"unexpected": 1}, id="unknown param"),
+        {"jsonrpc": "2.0", "id": "no method"},
+        42,
+    ]
+    responses = post(client, calls).get_json()
+    assert [response["id"] for response in responses] == ["unknown key", "ok", "too many params", "unknown param",
+                                                            "no method", None]
+    # A failing call doesn't fail the others
+    assert responses[0]["error"]["code"] == batch.SERVER_ERROR
+    assert "result" in responses[1]
+    assert [response["error"]["code"] for response in responses[2:]] == [batch.INVALID_PARAMS, batch.INVALID_PARAMS,
+                                                                        batch.INVALID_REQUEST, batch.INVALID_REQUEST]
+
+def test_batch_param_types(client):
+    # Parameters are type checked like those of single calls
+    params = ["bitcoin-regtest", "deadbeef", "84h/1h/0h/0", "0", 10]
+    single = post(client, call("new_addresses", params, id=1)).get_json()
+    assert single["error"]["code"] == batch.INVALID_PARAMS
+    responses = post(client, [call("new_addresses", params, id=1)]).get_json()
+    assert responses[0]["error"]["code"] == batch.INVALID_PARAMS
+    assert "start" in responses[0]["error"]["data"]["message"]
+
+def test_batch_size(client):
+    response = post(client, []).get_json()
+    assert response["error"]["code"] == batch.INVALID_REQUEST
+    calls = [call("server_status", id=i) for i in range(batch.MAX_BATCH_SIZE + 1)]
+    response = post(client, calls).get_json()
+    assert response["error"]["code"] == batch.INVALID_REQUEST
+    assert str(batch.MAX_BATCH_SIZE) in response["error"]["data"]["message"]
+
+def test_single_call_not_decoded(client, monkeypatch):
+    decoded = []
+    monkeypatch.setattr(batch, 'json', type('json', (), {
+        'loads': staticmethod(lambda data: decoded.append(data) or json.loads(data)),
+        'dumps': staticmethod(json.dumps),
+    }))
+    # Single calls are only decoded by flask_jsonrpc
+    assert post(client, call("server_status", id=1)).get_json()["id"] == 1
+    assert decoded == []
+    responses = client.post(ENDPOINT, data=" \n" + json.dumps([call("server_status", id=1)]),
+                            content_type='application/json').get_json()
+    assert [response["id"] for response in responses] == [1] and len(decoded) == 1
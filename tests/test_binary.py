@@ -0,0 +1,155 @@
+import pytest
+import json
+import sys
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'server'))
+
+from ssm.binary import MIMETYPE, pack_request, unpack_request, pack_address, unpack_addresses
+from ssm.core import get_addresses_from_path, restore_hd_wallet, sign_tx_v2, unpack_signatures
+from ssm.sighash import varint
+import ssm.core as core
+import ssm.exceptions as exceptions
+import ssm.parallel as parallel
+
+import server
+import executor
+
+# The server signs on all the cores, tests sign in the calling thread
+parallel.configure(workers=0)
+
+HDKEY_TEST = "tprv8ZgxMBicQKsPe8NFkADNQ7GMKyBkaWTRkrHStwdzcR9HvRbjbq6bNi37G3biAFtUE4hUmnuHojdqJdnqQ9qETcszgW41gn1e2GMjimt8HCQ"
+CHAIN = "bitcoin-regtest"
+ACCOUNT = "84h/1h/0h/0"
+NUM_INPUTS = 3
+OUTPUT_SCRIPT = bytes.fromhex("0014aa7e9c8bbf41d3bc16226551149aa598298f749d")
+
+def test_request():
+    params = {"chain": "bitcoin-regtest", "inputs": [{"fingerprint": "a2ef94f8", "path": "0h", "value": 1}]}
+    payload = bytes(range(256)) * 1000
+    assert unpack_request(pack_request(params, payload)) == (params, payload)
+    assert unpack_request(pack_request(params)) == (params, b'')
+
+    for wrong in [b'', b'\x10{}', b'\x02[]', b'\x03{"a', b'\xff' + b'\xff' * 8]:
+        with pytest.raises(exceptions.UnexpectedValueError):
+            unpack_request(wrong)
+
+def test_addresses():
+    addresses = [
+        ("0h/0", "bcrt1qfoo", bytes(33), None),
+        ("0h/1", "el1qqbar", bytes(range(33)), bytes(range(32))),
+    ]
+    data = b''.join(pack_address(*address) for address in addresses)
+    assert list(unpack_addresses(data)) == addresses
+    with pytest.raises(exceptions.UnexpectedValueError):
+        list(unpack_addresses(data[:-1]))
+
+@pytest.fixture
+def keys_dir(tmpdir, monkeypatch):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    monkeypatch.setattr(core, 'KEYS_DIR', str(keys_dir))
+    return keys_dir
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+def post(client, route, params, payload=b''):
+    return client.post(f"/api/v1/binary/{route}", data=pack_request(params, payload), content_type=MIMETYPE)
+
+def make_tx():
+    tx = (2).to_bytes(4, 'little') + varint(NUM_INPUTS)
+    for i in range(NUM_INPUTS):
+        tx += i.to_bytes(32, 'little') + bytes(4) + b'\x00' + b'\xff' * 4
+    tx += varint(1) + (100000).to_bytes(8, 'little') + varint(len(OUTPUT_SCRIPT)) + OUTPUT_SCRIPT
+    return tx + bytes(4)
+
+def test_sign_tx_route(client, keys_dir):
+    fingerprint = restore_hd_wallet(CHAIN, HDKEY_TEST, None, keys_dir)
+    inputs = [{"fingerprint": fingerprint, "path": f"0h/0h/{i}h", "value": 100000} for i in range(NUM_INPUTS)]
+    tx = make_tx()
+    expected = sign_tx_v2(CHAIN, tx, inputs, dir=keys_dir)
+
+    response = post(client, "sign_tx", {"chain": CHAIN, "inputs": inputs}, tx)
+    assert response.status_code == 200 and response.mimetype == MIMETYPE
+    assert response.data == expected
+    response = post(client, "sign_tx", {"chain": CHAIN, "inputs": inputs, "response": "signatures"}, tx)
+    assert [i for i, _, _ in unpack_signatures(response.data)] == list(range(NUM_INPUTS))
+
+    for params, payload in [
+        ({"chain": CHAIN, "inputs": inputs}, tx[:-1]),
+        ({"chain": CHAIN, "inputs": inputs, "response": "base64"}, tx),
+        ({"chain": CHAIN}, tx),
+        ({"chain": CHAIN, "inputs": None}, tx),
+        ({"chain": CHAIN, "inputs": [dict(inputs[0], fingerprint="deadbeef")] + inputs[1:]}, tx),
+    ]:
+        response = post(client, "sign_tx", params, payload)
+        assert response.status_code == 400
+        assert "error" in response.get_json()
+        assert str(keys_dir) not in response.get_json()["error"]
+
+def test_new_addresses_route(client, keys_dir):
+    fingerprint = restore_hd_wallet(CHAIN, HDKEY_TEST, None, keys_dir)
+    params = {"chain": CHAIN, "fingerprint": fingerprint, "account_path": ACCOUNT, "start": 0, "count": 300}
+    response = post(client, "new_addresses", params)
+    assert response.status_code == 200 and response.mimetype == MIMETYPE
+    expected = get_addresses_from_path(CHAIN, fingerprint, ACCOUNT, 0, 300, keys_dir)
+    assert [(path, address) for path, address, _, _ in unpack_addresses(response.data)] == \
+        [(path, address) for path, address, _, _ in expected]
+
+    for wrong in [
+        {"fingerprint": None},
+        {"fingerprint": "abcd"},
+        {"fingerprint": "deadbeef"},
+        {"chain": "nochain"},
+        {"chain": None},
+        {"account_path": None},
+        {"count": "many"},
+        {"start": -1},
+    ]:
+        response = post(client, "new_addresses", dict(params, **wrong))
+        assert response.status_code == 400
+        assert response.mimetype == "application/json"
+        assert str(keys_dir) not in response.get_json()["error"]
+
+def test_stream_new_addresses_route(client, keys_dir, monkeypatch):
+    # handlers re-exports the new_addresses method under the name of its module
+    monkeypatch.setattr(sys.modules['handlers.new_addresses'], 'STREAM_CHUNK', 128)
+    calls = []
+    run = executor.run
+    monkeypatch.setattr(executor, 'run', lambda method, *args: calls.append(method) or run(method, *args))
+    fingerprint = restore_hd_wallet(CHAIN, HDKEY_TEST, None, keys_dir)
+    params = {"chain": CHAIN, "fingerprint": fingerprint, "account_path": ACCOUNT, "start": 0, "count": 300}
+    response = client.post("/api/v1/stream/new_addresses", json=params)
+    assert response.status_code == 200 and response.mimetype == "application/x-ndjson"
+    expected = get_addresses_from_path(CHAIN, fingerprint, ACCOUNT, 0, 300, keys_dir)
+    assert [(line["path"], line["address"]) for line in map(json.loads, response.data.splitlines())] == \
+        [(path, address) for path, address, _, _ in expected]
+    # Chunks are derived by the executor
+    assert calls == ['new_addresses'] * 3
+
+    for wrong in [
+        {"fingerprint": "abcd"},
+        {"fingerprint": "deadbeef"},
+        {"chain": None},
+        {"account_path": None},
+        {"start": None},
+        {"count": "many"},
+        {"start": -1},
+    ]:
+        response = client.post("/api/v1/stream/new_addresses", json=dict(params, **wrong))
+        assert response.status_code == 400
+        assert str(keys_dir) not in response.get_json()["error"]
+    response = client.post("/api/v1/stream/new_addresses", json=[params])
+    assert response.status_code == 400
+
+    # Once streaming, a busy server ends the stream with the error
+    def busy(method, *args):
+        if calls:
+            raise exceptions.ServerBusyError("Too many new_addresses calls waiting, try again later.")
+        calls.append(method)
+        return run(method, *args)
+    calls.clear()
+    monkeypatch.setattr(executor, 'run', busy)
+    lines = client.post("/api/v1/stream/new_addresses", json=params).data.splitlines()
+    assert len(lines) == 129 and "error" in json.loads(lines[-1])
@@ -0,0 +1,102 @@
+import pytest
+import click
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from os import path
+
+from cli.cli import cli
+from cli.client import SOCKET_ENV, connect, forward, get_command
+from cli.daemon import make_server
+
+ROOT_DIR = path.join(path.dirname(path.realpath(__file__)), '..')
+
+# Modules that only some commands need, they must not be imported at startup
+HEAVY_MODULES = ['ssm.connect', 'ssm.rpc', 'http.client', 'ssl', 'multiprocessing', 'concurrent.futures.process',
+                    'ssm.core', 'ssm.util', 'ssm.export', 'ssm.address_index']
+# Time (in seconds) ssm-cli --help may take, interpreter startup included. It takes about 40ms without
+# wally, importing it and ssm.core for every command would take most of what's left.
+CLI_STARTUP_BUDGET = 0.15
+
+def test_startup_imports():
+    script = "import sys, json, cli.cli; print(json.dumps(sorted(sys.modules)))"
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT_DIR, check=True,
+                            stdout=subprocess.PIPE).stdout
+    modules = json.loads(output)
+    assert [module for module in HEAVY_MODULES if module in modules] == []
+
+def test_startup_time():
+    env = {k: v for k, v in os.environ.items() if k != SOCKET_ENV}
+    timings = []
+    for _ in range(5):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "cli.client", "--help"], cwd=ROOT_DIR, env=env, check=True,
+                        stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    # The fastest run, the others may have waited for the CPU
+    assert min(timings) < CLI_STARTUP_BUDGET
+
+def test_client_does_not_import_click():
+    script = "import sys, cli.client; print('click' in sys.modules, 'ssm.core' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT_DIR, check=True,
+                            stdout=subprocess.PIPE).stdout
+    assert output.split() == [b'False', b'False']
+
+@pytest.fixture
+def daemon(tmpdir):
+    socket_path = str(tmpdir.join("ssm-cli.sock"))
+    server = make_server(cli, socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield socket_path
+    server.shutdown()
+    server.server_close()
+
+def run(socket_path, args):
+    stdout, stderr = io.StringIO(), io.StringIO()
+    code = forward(connect(socket_path), args, stdout, stderr)
+    return code, stdout.getvalue(), stderr.getvalue()
+
+def test_daemon(daemon):
+    code, stdout, _ = run(daemon, ["--help"])
+    assert code == 0 and "Crypto SSM Command-Line Interface" in stdout
+
+    code, _, stderr = run(daemon, ["bogus"])
+    assert code == 2 and "No such command" in stderr
+
+    code, _, stderr = run(daemon, ["daemon"])
+    assert code == 2
+
+    # The daemon keeps serving after a failed command
+    code, stdout, _ = run(daemon, ["export-addresses", "--help"])
+    assert code == 0 and "importdescriptors" in stdout
+
+    # Only the subcommand starts a daemon, not an argument that happens to be called daemon
+    code, stdout, _ = run(daemon, ["-p", "daemon", "--help"])
+    assert code == 0 and "Crypto SSM Command-Line Interface" in stdout
+
+def test_daemon_cwd(daemon, tmpdir):
+    # Commands run in the dir of the client, then the daemon goes back to its own
+    cwd = os.getcwd()
+    with connect(daemon) as client:
+        client.sendall((json.dumps({'args': ["--help"], 'cwd': str(tmpdir)}) + '\n').encode())
+        with client.makefile('r', encoding='utf-8') as response:
+            assert json.loads(response.readlines()[-1]) == {'exit': 0}
+    assert os.getcwd() == cwd
+
+def test_get_command():
+    assert get_command([]) is None
+    assert get_command(["-v", "--help"]) is None
+    assert get_command(["daemon"]) == "daemon"
+    assert get_command(["-vv", "-c", "liquidv1", "--index-addresses", "daemon", "-s", "x"]) == "daemon"
+    assert get_command(["--chain=liquidv1", "--", "daemon"]) == "daemon"
+    assert get_command(["-p", "daemon", "new-addresses", "daemon"]) == "new-addresses"
+    assert get_command(["export-addresses", "daemon"]) == "export-addresses"
+
+def test_daemon_already_running(daemon):
+    with pytest.raises(click.ClickException):
+        make_server(cli, daemon)
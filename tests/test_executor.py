@@ -0,0 +1,83 @@
+import pytest
+import sys
+import threading
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'server'))
+
+import executor
+import ssm.exceptions as exceptions
+from ssm.util import btc2sat
+
+def test_client_queues(monkeypatch):
+    monkeypatch.setattr(executor, 'CLIENTS', {})
+    executor.configure_clients("withdrawals=high:4,reporting=normal")
+    assert executor.CLIENTS == {'withdrawals': ('high', 4), 'reporting': ('normal', 1)}
+
+    executor.set_client('withdrawals')
+    assert executor.get_queue('sign_tx') == ('withdrawals', 'high', 4)
+    # Names that aren't configured share the queue of the method
+    for client in [None, 'made-up-name']:
+        executor.set_client(client)
+        assert executor.get_queue('sign_tx') == ('sign_tx', 'normal', 1)
+        assert executor.get_queue('new_addresses') == ('new_addresses', 'low', 1)
+    executor.set_client(None)
+
+@pytest.mark.parametrize("spec", ["withdrawals", "withdrawals=urgent:1", "withdrawals=high:0", "withdrawals=high:x"])
+def test_client_wrong_spec(spec, monkeypatch):
+    monkeypatch.setattr(executor, 'CLIENTS', {})
+    with pytest.raises(exceptions.UnexpectedValueError):
+        executor.configure_clients(spec)
+
+@pytest.fixture
+def methods(monkeypatch):
+    monkeypatch.setattr(executor, '_methods', {})
+    monkeypatch.setattr(executor, 'METHOD_LIMITS', {'slow': 1})
+    monkeypatch.setattr(executor, 'QUEUE_TIMEOUT', 0.05)
+    return executor._methods
+
+def test_busy(methods):
+    started, release = threading.Event(), threading.Event()
+    def slow():
+        started.set()
+        release.wait()
+        return 'done'
+    results = []
+    thread = threading.Thread(target=lambda: results.append(executor.run('slow', slow)))
+    thread.start()
+    started.wait()
+    # The only slot of the method is taken, the next call gives up after QUEUE_TIMEOUT
+    assert executor.status()['methods']['slow']['running'] == 1
+    with pytest.raises(exceptions.ServerBusyError):
+        executor.run('slow', slow)
+    release.set()
+    thread.join()
+    assert results == ['done']
+    # The slot is free again
+    assert executor.run('slow', lambda: 'again') == 'again'
+
+    stats = executor.status()['methods']['slow']
+    assert (stats['limit'], stats['waiting'], stats['running']) == (1, 0, 0)
+    assert (stats['calls'], stats['errors'], stats['rejected']) == (2, 0, 1)
+    assert 0 < stats['avg_latency'] <= stats['max_latency']
+
+def test_stats(methods):
+    def fail():
+        raise exceptions.UnexpectedValueError("failed")
+    assert executor.run('other', btc2sat, 1.5) == 150000000
+    with pytest.raises(exceptions.UnexpectedValueError):
+        executor.run('other', fail)
+    stats = executor.status()['methods']['other']
+    assert stats['limit'] == executor.DEFAULT_LIMIT
+    assert (stats['calls'], stats['errors'], stats['rejected'], stats['running']) == (2, 1, 0, 0)
+
+def test_pool(methods):
+    executor.start(1)
+    try:
+        assert executor.run('other', btc2sat, 1.5) == 150000000
+        status = executor.status()
+        assert status['pool_size'] == 1
+        assert status['scheduler']['lanes']['normal']['other']['started'] == 1
+    finally:
+        executor.shutdown()
+    assert executor.status()['scheduler'] is None
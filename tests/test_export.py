@@ -0,0 +1,69 @@
+import pytest
+import json
+
+from ssm.core import (
+    get_addresses_from_path,
+    restore_hd_wallet,
+)
+
+from ssm.export import (
+    add_descriptor_checksum,
+    iter_export,
+)
+
+import ssm.address_index as address_index
+import ssm.exceptions as exceptions
+
+HDKEY_TEST = "tprv8ZgxMBicQKsPe8NFkADNQ7GMKyBkaWTRkrHStwdzcR9HvRbjbq6bNi37G3biAFtUE4hUmnuHojdqJdnqQ9qETcszgW41gn1e2GMjimt8HCQ"
+BLINDING_KEY = "cf215ffecd670b7427b2fc90ee129ab6f801c1deed4a1b9b1b0341a8c05d8a43aafb994891a4d42e9afefd0614d497e65d572f939e04190659f93f5bad8d446e"
+ACCOUNT = "84h/1h/0h/0"
+
+# BIP380 test vectors
+@pytest.mark.parametrize("descriptor, expected", [
+    ("raw(deadbeef)", "raw(deadbeef)#89f8spxm"),
+    ("addr(mkmZxiEcEd8ZqjQWVZuC6so5dFMKEFpN2j)", "addr(mkmZxiEcEd8ZqjQWVZuC6so5dFMKEFpN2j)#02wpgw69"),
+])
+def test_descriptor_checksum(descriptor, expected):
+    assert add_descriptor_checksum(descriptor) == expected
+
+@pytest.mark.parametrize("chain", ["bitcoin-regtest", "elements-regtest"])
+def test_export_addresses(chain, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    fingerprint = restore_hd_wallet(chain, HDKEY_TEST, BLINDING_KEY, keys_dir)
+    expected = get_addresses_from_path(chain, fingerprint, ACCOUNT, 5, 7, keys_dir)
+
+    lines = list(iter_export(chain, fingerprint, ACCOUNT, 5, 7, dir=keys_dir))
+    assert len(lines) == 7
+    for line, (path, address, pubkey, bkey) in zip(lines, expected):
+        item = json.loads(line)
+        assert (item['path'], item['address'], item['pubkey']) == (path, address, bytes(pubkey).hex())
+        assert item.get('blinding_key') == (bytes(bkey).hex() if chain == "elements-regtest" else None)
+
+    lines = list(iter_export(chain, fingerprint, ACCOUNT, 5, 7, 'importmulti', 3, 0, 'ssm', keys_dir))
+    batches = [json.loads(line) for line in lines]
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    requests = sum(batches, [])
+    assert [request['scriptPubKey']['address'] for request in requests] == [address for _, address, _, _ in expected]
+    assert all(request['timestamp'] == 0 and request['label'] == 'ssm' for request in requests)
+
+    lines = list(iter_export(chain, fingerprint, ACCOUNT, 5, 7, 'importdescriptors', dir=keys_dir))
+    requests = json.loads(lines[0])
+    assert len(lines) == 1 and len(requests) == 7
+    for request, (_, _, pubkey, _) in zip(requests, expected):
+        descriptor = request['desc'].split('#')[0]
+        assert descriptor.endswith(f"wpkh({bytes(pubkey).hex()})" + (")" if chain == "elements-regtest" else ""))
+        assert add_descriptor_checksum(descriptor) == request['desc']
+
+def test_export_wrong_format(tmpdir):
+    with pytest.raises(exceptions.UnexpectedValueError):
+        list(iter_export("bitcoin-regtest", "a2ef94f8", ACCOUNT, 0, 1, 'csv', dir=tmpdir))
+
+def test_export_not_indexed(tmpdir, monkeypatch):
+    # Even with the address index enabled, exports don't touch it
+    monkeypatch.setattr(address_index, 'INDEX_ADDRESSES', True)
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    chain = "bitcoin-regtest"
+    fingerprint = restore_hd_wallet(chain, HDKEY_TEST, None, keys_dir)
+    lines = list(iter_export(chain, fingerprint, ACCOUNT, 0, 300, dir=keys_dir))
+    assert len(lines) == 300
+    assert not keys_dir.join(address_index.ADDRESS_INDEX_FILE).exists()
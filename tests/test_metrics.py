@@ -0,0 +1,56 @@
+import pytest
+
+from ssm.core import (
+    get_child_from_path,
+    get_public_child_from_path,
+    restore_hd_wallet,
+)
+
+import ssm.metrics as metrics
+
+CHAIN = "bitcoin-main"
+HDKEY_TEST = "tprv8ZgxMBicQKsPe8NFkADNQ7GMKyBkaWTRkrHStwdzcR9HvRbjbq6bNi37G3biAFtUE4hUmnuHojdqJdnqQ9qETcszgW41gn1e2GMjimt8HCQ"
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.reset()
+    metrics.configure(True)
+    yield
+    metrics.configure(False)
+    metrics.reset()
+
+def test_metrics_disabled(tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    metrics.reset()
+    fingerprint = restore_hd_wallet(CHAIN, HDKEY_TEST, None, keys_dir)
+    get_child_from_path(CHAIN, fingerprint, "0h/1", keys_dir)
+    assert metrics.drain() is None
+    assert metrics.STAGE_SECONDS not in metrics.render()
+
+def test_stages(enabled_metrics, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    fingerprint = restore_hd_wallet(CHAIN, HDKEY_TEST, None, keys_dir)
+    get_child_from_path(CHAIN, fingerprint, "0h/1", keys_dir)
+    output = metrics.render()
+    assert 'ssm_stage_seconds_count{stage="derivation"} 1' in output
+    assert 'ssm_stage_seconds_bucket{stage="derivation",le="+Inf"} 1' in output
+    assert 'ssm_cache_misses_total{cache="derivation"}' in output
+
+def test_public_derivation_stage(enabled_metrics, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    fingerprint = restore_hd_wallet(CHAIN, HDKEY_TEST, None, keys_dir)
+    # The hardened account is derived privately, within the same derivation stage
+    get_public_child_from_path(CHAIN, fingerprint, "84h/0h/0h/0/1", keys_dir)
+    assert 'ssm_stage_seconds_count{stage="derivation"} 1' in metrics.render()
+
+def test_drain_merge(enabled_metrics):
+    metrics.inc(metrics.REQUESTS_TOTAL, method="sign_tx", chain=CHAIN)
+    metrics.observe(metrics.REQUEST_SECONDS, 0.002, method="sign_tx")
+    state = metrics.drain()
+    assert metrics.drain()[0].get((metrics.REQUESTS_TOTAL, (("chain", CHAIN), ("method", "sign_tx")))) is None
+    metrics.merge(state)
+    metrics.merge(state)
+    output = metrics.render()
+    assert f'ssm_requests_total{{chain="{CHAIN}",method="sign_tx"}} 2' in output
+    assert 'ssm_request_seconds_bucket{method="sign_tx",le="0.001"} 0' in output
+    assert 'ssm_request_seconds_bucket{method="sign_tx",le="0.0025"} 2' in output
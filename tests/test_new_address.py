@@ -6,11 +6,32 @@ from wallycore import (
     bip32_key_get_fingerprint,
     bip32_key_from_base58,
     bip32_key_to_base58,
-    BIP32_FLAG_KEY_PRIVATE
+    bip32_key_from_parent,
+    bip32_key_to_addr_segwit,
+    BIP32_FLAG_KEY_PRIVATE,
+    BIP32_FLAG_KEY_PUBLIC,
 )
 
 from ssm.core import (
     get_child_from_path,   
+    get_public_child_from_path,
+    get_address_from_child,
+    get_blinding_key_from_address,
+    get_blinding_keys_from_scripts,
+    get_p2wpkh_script,
+    get_path_from_address,
+    get_path_from_script,
+    get_address_from_path,
+    get_addresses_from_path,
+    restore_hd_wallet,
+)
+
+from ssm.cache import (
+    DERIVATION_CACHE,
+    MASTERKEY_CACHE,
+    PUBLIC_DERIVATION_CACHE,
+    DerivationCache,
+    get_public_node,
 )
 
 from ssm.util import (
@@ -21,7 +42,12 @@ from ssm.util import (
     save_masterkey_to_disk,
 )
 
+import ssm.address_index as address_index
+import ssm.exceptions as exceptions
+
 CHAIN = "bitcoin-main"
+HDKEY_TEST = "tprv8ZgxMBicQKsPe8NFkADNQ7GMKyBkaWTRkrHStwdzcR9HvRbjbq6bNi37G3biAFtUE4hUmnuHojdqJdnqQ9qETcszgW41gn1e2GMjimt8HCQ"
+BLINDING_KEY = "cf215ffecd670b7427b2fc90ee129ab6f801c1deed4a1b9b1b0341a8c05d8a43aafb994891a4d42e9afefd0614d497e65d572f939e04190659f93f5bad8d446e"
 
 BIP32_VECTORS = path.join(path.dirname(path.realpath(__file__)), "bip32_test_vectors.json")
 
@@ -95,4 +121,124 @@ def test_bip32_hdkey_derivation(bip32_test_vectors, paths, tmpdir):
             test_child = childs.pop(0)
             assert bip32_key_to_base58(child, BIP32_FLAG_KEY_PRIVATE) == test_child
 
-# TODO: test the extended pubkey and bech32 address derivation 
\ No newline at end of file
+# TODO: test the extended pubkey and bech32 address derivation 
+
+def test_derivation_cache(bip32_test_vectors, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    xprv = next(iter(bip32_test_vectors))
+    masterkey = bip32_key_from_base58(xprv)
+    fingerprint = bytearray(4)
+    bip32_key_get_fingerprint(masterkey, fingerprint)
+    fingerprint = str(fingerprint.hex())
+    save_masterkey_to_disk(CHAIN, masterkey, fingerprint, False, keys_dir)
+
+    DERIVATION_CACHE.clear()
+    first = get_child_from_path(CHAIN, fingerprint, "84h/1h/0h/0/0", keys_dir)
+    hits = DERIVATION_CACHE.stats()['hits']
+    children = [get_child_from_path(CHAIN, fingerprint, f"84h/1h/0h/0/{i}", keys_dir) for i in range(1, 5)]
+    assert DERIVATION_CACHE.stats()['hits'] == hits + 4
+
+    # Cached derivation must give the same keys than a derivation from the masterkey
+    for i, child in enumerate([first] + children):
+        current = masterkey
+        for idx in parse_path(f"84h/1h/0h/0/{i}"):
+            current = bip32_key_from_parent(current, idx, BIP32_FLAG_KEY_PRIVATE)
+        assert bip32_key_to_base58(child, BIP32_FLAG_KEY_PRIVATE) == bip32_key_to_base58(current, BIP32_FLAG_KEY_PRIVATE)
+
+def test_derivation_cache_public_only(bip32_test_vectors):
+    cache = DerivationCache(16, keep_private=False)
+    masterkey = bip32_key_from_base58(next(iter(bip32_test_vectors)))
+    lpath = parse_path("0h/1/2")
+    # Private nodes are not kept at all
+    cache.store('master', lpath[:1], masterkey)
+    assert len(cache) == 0
+    cache.store('master', lpath[:1], get_public_node(masterkey), False)
+    # Public nodes can't be used for a private derivation
+    assert cache.deepest('master', lpath) == (0, None)
+    depth, node = cache.deepest('master', lpath, private=False)
+    assert depth == 1
+    assert bip32_key_to_base58(node, BIP32_FLAG_KEY_PUBLIC) == bip32_key_to_base58(masterkey, BIP32_FLAG_KEY_PUBLIC)
+
+@pytest.mark.parametrize("path", ["0/1", "0h/1/2", "84h/1h/0h/0/7", "0h/1h"])
+def test_public_derivation(path, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    fingerprint = restore_hd_wallet(CHAIN, HDKEY_TEST, None, keys_dir)
+    PUBLIC_DERIVATION_CACHE.clear()
+    child = get_child_from_path(CHAIN, fingerprint, path, keys_dir)
+    expected = bip32_key_to_base58(child, BIP32_FLAG_KEY_PUBLIC)
+    assert bip32_key_to_base58(get_public_child_from_path(CHAIN, fingerprint, path, keys_dir), 
+                                BIP32_FLAG_KEY_PUBLIC) == expected
+
+    # Once the account is cached, its children are derived without the private keys
+    MASTERKEY_CACHE.clear()
+    DERIVATION_CACHE.clear()
+    sibling = path[:-1] + "9"
+    public_child = get_public_child_from_path(CHAIN, fingerprint, sibling, keys_dir)
+    if not path.endswith("h"):
+        assert len(MASTERKEY_CACHE) == 0
+        assert len(DERIVATION_CACHE) == 0
+    expected = bip32_key_to_base58(get_child_from_path(CHAIN, fingerprint, sibling, keys_dir), BIP32_FLAG_KEY_PUBLIC)
+    assert bip32_key_to_base58(public_child, BIP32_FLAG_KEY_PUBLIC) == expected
+
+@pytest.mark.parametrize("chain", ["bitcoin-regtest", "elements-regtest"])
+def test_new_addresses(chain, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    fingerprint = restore_hd_wallet(chain, HDKEY_TEST, BLINDING_KEY, keys_dir)
+
+    addresses = get_addresses_from_path(chain, fingerprint, "84h/1h/0h/0", 5, 10, keys_dir)
+    assert len(addresses) == 10
+    for i, (path, address, pubkey, bkey) in enumerate(addresses):
+        assert path == f"84h/1h/0h/0/{i + 5}"
+        assert (address, pubkey, bkey) == get_address_from_path(chain, fingerprint, path, keys_dir)
+        # Public derivation gives the same address than the private child
+        child = get_child_from_path(chain, fingerprint, path, keys_dir)
+        assert (address, pubkey, bkey) == get_address_from_child(chain, fingerprint, child, keys_dir)
+
+    with pytest.raises(exceptions.UnexpectedValueError):
+        get_addresses_from_path(chain, fingerprint, "84h/1h/0h/0", 2**31 - 1, 2, keys_dir)
+
+def test_bulk_blinding_keys(tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    chain = "elements-regtest"
+    fingerprint = restore_hd_wallet(chain, HDKEY_TEST, BLINDING_KEY, keys_dir)
+    addresses = get_addresses_from_path(chain, fingerprint, "84h/1h/0h/0", 0, 5, keys_dir)
+    privkeys, pubkeys = get_blinding_keys_from_scripts(chain, fingerprint, 
+                                                        [get_p2wpkh_script(pubkey) for _, _, pubkey, _ in addresses], keys_dir)
+    assert len(privkeys) == 5 * 32 and len(pubkeys) == 5 * 33
+    for i, (path, _, _, bkey) in enumerate(addresses):
+        unconfidential = bip32_key_to_addr_segwit(get_child_from_path(chain, fingerprint, path, keys_dir), "ert", 0)
+        expected = get_blinding_key_from_address(unconfidential, chain, fingerprint, keys_dir)
+        assert privkeys[i * 32:(i + 1) * 32] == bytes(expected) == bytes(bkey)
+
+@pytest.mark.parametrize("chain", ["bitcoin-regtest", "elements-regtest"])
+def test_address_index(chain, tmpdir, monkeypatch):
+    monkeypatch.setattr(address_index, 'INDEX_ADDRESSES', True)
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    fingerprint = restore_hd_wallet(chain, HDKEY_TEST, BLINDING_KEY, keys_dir)
+    addresses = get_addresses_from_path(chain, fingerprint, "84'/1'/0'/0", 0, 10, keys_dir)
+    addresses.append(("0h/7", ) + get_address_from_path(chain, fingerprint, "0h/7", keys_dir))
+    for path, address, pubkey, _ in addresses:
+        expected = (fingerprint, path.replace("'", "h"))
+        assert get_path_from_address(chain, address, keys_dir) == expected
+        assert get_path_from_script(chain, get_p2wpkh_script(pubkey), keys_dir) == expected
+
+    # Addresses generated again are not indexed twice, and other chains don't share the index
+    index = address_index.get_address_index(keys_dir)
+    size = len(index)
+    get_addresses_from_path(chain, fingerprint, "84'/1'/0'/0", 0, 10, keys_dir)
+    assert len(index) == size == 11
+    with pytest.raises(exceptions.UnknownAddressError):
+        get_path_from_script("liquidv1", get_p2wpkh_script(addresses[0][2]), keys_dir)
+    with pytest.raises(exceptions.InvalidAddressError):
+        get_path_from_address(chain, "not an address", keys_dir)
+
+
+def test_address_index_disabled(tmpdir):
+    # Addresses are only indexed on demand
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    chain = "bitcoin-regtest"
+    fingerprint = restore_hd_wallet(chain, HDKEY_TEST, None, keys_dir)
+    _, address, _, _ = get_addresses_from_path(chain, fingerprint, "84h/1h/0h/0", 0, 10, keys_dir)[0]
+    assert not keys_dir.join(address_index.ADDRESS_INDEX_FILE).exists()
+    with pytest.raises(exceptions.UnknownAddressError):
+        get_path_from_address(chain, address, keys_dir)
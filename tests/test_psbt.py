@@ -0,0 +1,161 @@
+import pytest
+import base64
+import pickle
+
+from wallycore import (
+    bip32_key_get_priv_key,
+    ec_public_key_from_private_key,
+    tx_from_hex,
+    tx_get_input_witness,
+    WALLY_TX_FLAG_USE_WITNESS,
+    WALLY_TX_FLAG_USE_ELEMENTS,
+)
+
+from ssm.core import (
+    get_child_from_path,
+    get_p2wpkh_script,
+    restore_hd_wallet,
+    sign_psbt,
+    sign_tx_v2,
+)
+from ssm.psbt import parse_psbt
+from ssm.sighash import varint
+from ssm.util import parse_path
+
+import ssm.exceptions as exceptions
+import ssm.parallel as parallel
+
+HDKEY_TEST = "tprv8ZgxMBicQKsPe8NFkADNQ7GMKyBkaWTRkrHStwdzcR9HvRbjbq6bNi37G3biAFtUE4hUmnuHojdqJdnqQ9qETcszgW41gn1e2GMjimt8HCQ"
+NUM_INPUTS = 3
+INPUT_VALUE = 100000
+ASSET = bytes.fromhex("5ac9f65c0efcc4775e0baec4ec03abdde22473cd3cf33c0419ca290e0751b225")
+BLINDING_KEY = "cf215ffecd670b7427b2fc90ee129ab6f801c1deed4a1b9b1b0341a8c05d8a43aafb994891a4d42e9afefd0614d497e65d572f939e04190659f93f5bad8d446e"
+OUTPUT_SCRIPT = bytes.fromhex("0014aa7e9c8bbf41d3bc16226551149aa598298f749d")
+
+def field(key_type, value, keydata=b''):
+    key = bytes([key_type]) + keydata
+    return varint(len(key)) + key + varint(len(value)) + value
+
+def pset_field(subtype, value):
+    return field(0xfc, value, varint(4) + b'pset' + varint(subtype))
+
+def get_pubkey(chain, fingerprint, i, keys_dir):
+    child = get_child_from_path(chain, fingerprint, f"0h/0h/{i}h", keys_dir)
+    return bytes(ec_public_key_from_private_key(bip32_key_get_priv_key(child)))
+
+def input_fields(chain, fingerprint, i, keys_dir):
+    """Witness utxo and derivation of an input spending our key at 0h/0h/ih"""
+    pubkey = get_pubkey(chain, fingerprint, i, keys_dir)
+    script = get_p2wpkh_script(pubkey)
+    if chain == 'elements-regtest':
+        utxo = b'\x01' + ASSET + b'\x01' + INPUT_VALUE.to_bytes(8, 'big') + b'\x00'
+    else:
+        utxo = INPUT_VALUE.to_bytes(8, 'little')
+    origin = bytes.fromhex(fingerprint) + b''.join(n.to_bytes(4, 'little') for n in parse_path(f"0h/0h/{i}h"))
+    return field(0x01, utxo + varint(len(script)) + script) + field(0x06, origin, pubkey)
+
+def make_tx(elements=False):
+    tx = (2).to_bytes(4, 'little') + (b'\x00' if elements else b'') + varint(NUM_INPUTS)
+    for i in range(NUM_INPUTS):
+        tx += i.to_bytes(32, 'little') + (0).to_bytes(4, 'little') + b'\x00' + b'\xff' * 4
+    value = INPUT_VALUE * NUM_INPUTS - 1000
+    if elements:
+        tx += varint(1) + b'\x01' + ASSET + b'\x01' + value.to_bytes(8, 'big') + b'\x00'
+    else:
+        tx += varint(1) + value.to_bytes(8, 'little')
+    return tx + varint(len(OUTPUT_SCRIPT)) + OUTPUT_SCRIPT + (0).to_bytes(4, 'little')
+
+def make_psbt(fingerprint, keys_dir, extra=None):
+    chain = 'bitcoin-regtest'
+    psbt = b'psbt\xff' + field(0x00, make_tx()) + b'\x00'
+    for i in range(NUM_INPUTS):
+        psbt += input_fields(chain, fingerprint, i, keys_dir) + (extra or {}).get(i, b'') + b'\x00'
+    return base64.b64encode(psbt + b'\x00').decode()
+
+def make_pset(fingerprint, keys_dir):
+    chain = 'elements-regtest'
+    psbt = b'pset\xff' + field(0x02, (2).to_bytes(4, 'little')) + field(0x04, varint(NUM_INPUTS)) \
+            + field(0x05, varint(1)) + field(0xfb, (2).to_bytes(4, 'little')) + b'\x00'
+    for i in range(NUM_INPUTS):
+        psbt += field(0x0e, i.to_bytes(32, 'little')) + field(0x0f, bytes(4)) \
+                + input_fields(chain, fingerprint, i, keys_dir) + b'\x00'
+    psbt += field(0x03, (INPUT_VALUE * NUM_INPUTS - 1000).to_bytes(8, 'little')) + field(0x04, OUTPUT_SCRIPT) \
+            + pset_field(0x02, ASSET) + b'\x00'
+    return base64.b64encode(psbt).decode()
+
+def get_expected_signatures(chain, fingerprint, keys_dir):
+    """Signatures of the same transaction signed with sign_tx_v2"""
+    elements = chain == 'elements-regtest'
+    if elements:
+        value = (b'\x01' + INPUT_VALUE.to_bytes(8, 'big')).hex()
+    else:
+        value = INPUT_VALUE
+    inputs = [{"fingerprint": fingerprint, "path": f"0h/0h/{i}h", "value": value} for i in range(NUM_INPUTS)]
+    signed = sign_tx_v2(chain, make_tx(elements).hex(), inputs, dir=keys_dir)
+    flags = WALLY_TX_FLAG_USE_WITNESS | (WALLY_TX_FLAG_USE_ELEMENTS if elements else 0)
+    Tx = tx_from_hex(signed, flags)
+    return [bytes(tx_get_input_witness(Tx, i, 0)).hex() for i in range(NUM_INPUTS)]
+
+@pytest.mark.parametrize("chain", ['bitcoin-regtest', 'elements-regtest'])
+def test_sign_psbt(chain, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    if chain == 'elements-regtest':
+        fingerprint = restore_hd_wallet(chain, HDKEY_TEST, BLINDING_KEY, keys_dir)
+        psbt = make_pset(fingerprint, keys_dir)
+    else:
+        fingerprint = restore_hd_wallet(chain, HDKEY_TEST, None, keys_dir)
+        psbt = make_psbt(fingerprint, keys_dir)
+
+    signatures = sign_psbt(chain, psbt, keys_dir)
+    assert [sig["index"] for sig in signatures] == list(range(NUM_INPUTS))
+    assert [sig["pubkey"] for sig in signatures] == [get_pubkey(chain, fingerprint, i, keys_dir).hex()
+                                                        for i in range(NUM_INPUTS)]
+    assert [sig["signature"] for sig in signatures] == get_expected_signatures(chain, fingerprint, keys_dir)
+
+def test_sign_psbt_chunks(tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    chain = 'bitcoin-regtest'
+    fingerprint = restore_hd_wallet(chain, HDKEY_TEST, None, keys_dir)
+    psbt = make_psbt(fingerprint, keys_dir)
+    expected = sign_psbt(chain, psbt, keys_dir)
+    # Each input signed by its own chunk, as a worker would
+    chunk_size = parallel.CHUNK_SIZE
+    parallel.set_runner(lambda fn, calls: [fn(*pickle.loads(pickle.dumps(call))) for call in calls], 1)
+    try:
+        assert sign_psbt(chain, psbt, keys_dir) == expected
+    finally:
+        parallel.set_runner(None, chunk_size)
+
+def test_sign_psbt_skips(tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    chain = 'bitcoin-regtest'
+    fingerprint = restore_hd_wallet(chain, HDKEY_TEST, None, keys_dir)
+    pubkey = get_pubkey(chain, fingerprint, 0, keys_dir)
+    extra = {
+        # already signed by us
+        0: field(0x02, bytes(71), pubkey),
+        # finalized
+        1: field(0x08, b'\x00'),
+    }
+    signatures = sign_psbt(chain, make_psbt(fingerprint, keys_dir, extra), keys_dir)
+    assert [sig["index"] for sig in signatures] == [2]
+
+    # Derivations from keys we don't have are left to other signers
+    psbt = base64.b64decode(make_psbt(fingerprint, keys_dir)).replace(bytes.fromhex(fingerprint), bytes(4))
+    assert sign_psbt(chain, base64.b64encode(psbt).decode(), keys_dir) == []
+
+def test_sign_psbt_wrong_psbt(tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    fingerprint = restore_hd_wallet('bitcoin-regtest', HDKEY_TEST, None, keys_dir)
+    psbt = make_psbt(fingerprint, keys_dir)
+    # A Bitcoin PSBT can't be signed on Elements
+    with pytest.raises(exceptions.UnexpectedValueError):
+        sign_psbt('elements-regtest', psbt, keys_dir)
+    huge_field = b'psbt\xff' + b'\x01\x00' + b'\xff' * 9
+    for wrong in ["not a psbt", base64.b64encode(b'psbt\xff').decode(), psbt[:40], base64.b64encode(huge_field).decode()]:
+        with pytest.raises(exceptions.UnexpectedValueError):
+            parse_psbt(wrong)
+    # Unsupported sighash types are rejected
+    with pytest.raises(exceptions.UnexpectedValueError):
+        sign_psbt('bitcoin-regtest', make_psbt(fingerprint, keys_dir, {0: field(0x03, (4).to_bytes(4, 'little'))}),
+                    keys_dir)
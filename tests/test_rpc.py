@@ -0,0 +1,222 @@
+import pytest
+import base64
+import json
+import os
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ssm.rpc as rpc
+from ssm.connect import ConnCtx
+from ssm.rpc import RawProxy, JSONRPCError, InvalidAddressOrKeyError
+from ssm.util import are_mine
+import ssm.exceptions as exceptions
+
+class FakeNodeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send the headers and body at once, as the nodes do
+    wbufsize = -1
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections.append(self.connection)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Authorization') != self.server.get_auth():
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        request = json.loads(body)
+        with self.server.lock:
+            self.server.requests += 1
+        if isinstance(request, dict) and request['params'] == ['hang up']:
+            # The request ran, and the connection breaks in the middle of the response
+            self.wfile.write(b'HTTP/1.1 2')
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+            return
+        if isinstance(request, list):
+            # Answers out of order, clients must match them by id
+            response = [self.answer(call) for call in reversed(request)]
+        else:
+            response = self.answer(request)
+        data = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def answer(self, request):
+        method, params = request['method'], request['params']
+        if params and params[0] == 'bogus':
+            return {'result': None, 'error': {'code': -5, 'message': 'Invalid address'}, 'id': request['id']}
+        if method == 'validateaddress':
+            return {'result': {'isvalid': params[0] != 'invalid'}, 'error': None, 'id': request['id']}
+        if method == 'getaddressinfo':
+            return {'result': {'ismine': params[0].startswith('mine')}, 'error': None, 'id': request['id']}
+        return {'result': {'method': method, 'params': params}, 'error': None, 'id': request['id']}
+
+    def log_message(self, *args):
+        pass
+
+class FakeNode(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, cookie_file):
+        super().__init__(('127.0.0.1', 0), FakeNodeHandler)
+        self.cookie_file = cookie_file
+        self.connections = []
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def get_auth(self):
+        with open(self.cookie_file) as f:
+            return "Basic " + base64.b64encode(f.read().encode()).decode()
+
+    def handle_error(self, request, client_address):
+        # Connections dropped on purpose
+        pass
+
+    def drop_connections(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.shutdown(socket.SHUT_RDWR)
+
+@pytest.fixture
+def node(tmpdir):
+    conf_file = tmpdir.join("elements.conf")
+    cookie_file = tmpdir.mkdir("elementsregtest").join(".cookie")
+    cookie_file.write("__cookie__:first")
+    server = FakeNode(str(cookie_file))
+    conf_file.write(f"chain=elementsregtest\nrpcport={server.server_address[1]}\nrpcconnect=127.0.0.1\n")
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server, str(conf_file)
+    server.shutdown()
+    server.server_close()
+
+def test_keep_alive(node):
+    server, conf_file = node
+    proxy = RawProxy(conf_file=conf_file)
+    for i in range(10):
+        assert proxy.getblockcount() == {'method': 'getblockcount', 'params': []}
+    assert len(server.connections) == 1
+
+    # Proxies of the same node share the connections and the parsed configuration
+    other = RawProxy(conf_file=conf_file)
+    assert other.getwalletinfo()['method'] == 'getwalletinfo'
+    assert len(server.connections) == 1
+
+    with pytest.raises(InvalidAddressOrKeyError):
+        proxy.validateaddress('bogus')
+    assert proxy.getbalance('el1q')['params'] == ['el1q']
+    assert len(server.connections) == 1
+
+def test_conf_is_cached(node, monkeypatch):
+    _, conf_file = node
+    RawProxy(conf_file=conf_file)
+    calls = []
+    read_service_conf = rpc.read_service_conf
+    monkeypatch.setattr(rpc, 'read_service_conf', lambda *args: calls.append(args) or read_service_conf(*args))
+    for _ in range(10):
+        RawProxy(conf_file=conf_file)
+    assert calls == []
+
+def test_stale_connection(node):
+    server, conf_file = node
+    proxy = RawProxy(conf_file=conf_file)
+    proxy.getblockcount()
+    server.drop_connections()
+    assert proxy.getblockcount()['method'] == 'getblockcount'
+    assert len(server.connections) == 2
+
+def test_no_retry_after_response(node):
+    server, conf_file = node
+    proxy = RawProxy(conf_file=conf_file)
+    proxy.getblockcount()
+    requests = server.requests
+    # The connection was reused, but the node may have run the call, it's not sent again
+    with pytest.raises((ConnectionError, rpc.httplib.HTTPException)):
+        proxy.sendrawtransaction('hang up')
+    assert server.requests == requests + 1
+    assert proxy.getblockcount()['method'] == 'getblockcount'
+
+def test_new_cookie(node):
+    server, conf_file = node
+    proxy = RawProxy(conf_file=conf_file)
+    proxy.getblockcount()
+    with open(server.cookie_file, 'w') as f:
+        f.write("__cookie__:second")
+    os.utime(server.cookie_file, ns=(0, 0))
+    assert proxy.getblockcount()['method'] == 'getblockcount'
+
+def test_pool_size(node):
+    server, conf_file = node
+    proxy = RawProxy(conf_file=conf_file, pool_size=2)
+    errors = []
+
+    def calls():
+        try:
+            for _ in range(20):
+                proxy.getblockcount()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=calls) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(server.connections) <= 2
+
+def test_pool_timeout(node):
+    _, conf_file = node
+    proxy = RawProxy(conf_file=conf_file, pool_size=1, pool_timeout=0.01)
+    pool = rpc.get_pool('127.0.0.1', node[0].server_address[1], rpc.DEFAULT_HTTP_TIMEOUT, 1)
+    conn, _ = pool.get()
+    try:
+        with pytest.raises(JSONRPCError):
+            proxy.getblockcount()
+    finally:
+        pool.put(conn)
+
+def test_conn_ctx_reuses_proxy(node):
+    _, conf_file = node
+    with ConnCtx({'conf_file': conf_file}, None) as cc:
+        assert cc.connection is cc.connection
+
+def test_batch(node):
+    server, conf_file = node
+    proxy = RawProxy(conf_file=conf_file)
+    with proxy.batch() as batch:
+        calls = [batch.getbalance(i) for i in range(5)]
+        bogus = batch.validateaddress('bogus')
+        assert not bogus.done
+    assert server.requests == 1
+    assert [call.result()['params'] for call in calls] == [[i] for i in range(5)]
+    with pytest.raises(InvalidAddressOrKeyError):
+        bogus.result()
+    results = batch.results()
+    assert isinstance(results[-1], InvalidAddressOrKeyError)
+    assert results[0] == {'method': 'getbalance', 'params': [0]}
+
+    # Nothing is sent if the block fails
+    with pytest.raises(ZeroDivisionError):
+        with proxy.batch() as batch:
+            call = batch.getbalance()
+            1 / 0
+    assert not call.done and server.requests == 1
+
+def test_are_mine(node):
+    server, conf_file = node
+    proxy = RawProxy(conf_file=conf_file)
+    assert are_mine(['mine1', 'other', 'mine2'], proxy) == [True, False, True]
+    assert server.requests == 1
+    with pytest.raises(exceptions.InvalidAddressError):
+        are_mine(['mine1', 'invalid'], proxy)
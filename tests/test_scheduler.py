@@ -0,0 +1,73 @@
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ssm.scheduler import Scheduler
+import ssm.exceptions as exceptions
+
+@pytest.fixture
+def scheduler():
+    executor = ThreadPoolExecutor(max_workers=1)
+    scheduler = Scheduler(executor, 1)
+    # Holds the only slot until set, so that the tasks submitted meanwhile all wait
+    gate = threading.Event()
+    blocker = scheduler.submit('blocker', gate.wait)
+    yield scheduler, gate
+    gate.set()
+    blocker.result()
+    executor.shutdown()
+
+def submit_all(scheduler, tasks, started):
+    """Submit (client, lane, weight) tasks recording the order they start in"""
+    return [scheduler.submit(client, started.append, client, lane=lane, weight=weight)
+                for client, lane, weight in tasks]
+
+def test_lanes(scheduler):
+    scheduler, gate = scheduler
+    started = []
+    futures = submit_all(scheduler, [('consolidation', 'low', 1)] * 3 + [('withdrawals', 'high', 1)] * 2
+                            + [('deposits', 'normal', 1)], started)
+    gate.set()
+    for future in futures:
+        future.result()
+    assert started == ['withdrawals'] * 2 + ['deposits'] + ['consolidation'] * 3
+
+def test_weights(scheduler):
+    scheduler, gate = scheduler
+    started = []
+    futures = submit_all(scheduler, [('a', 'normal', 3)] * 12 + [('b', 'normal', 1)] * 12, started)
+    gate.set()
+    for future in futures:
+        future.result()
+    # a gets 3 slots for each slot of b while both are waiting
+    assert started[:8].count('a') == 6
+    assert started[-6:] == ['b'] * 6
+    stats = scheduler.stats()
+    assert stats['lanes']['normal']['a']['started'] == 12
+    assert stats['running'] == 0
+
+def test_idle_client(scheduler):
+    scheduler, gate = scheduler
+    started = []
+    futures = submit_all(scheduler, [('a', 'normal', 1)] * 4, started)
+    gate.set()
+    for future in futures:
+        future.result()
+    # b didn't bank credit while a was alone, they alternate from now on
+    gate.clear()
+    blocker = scheduler.submit('blocker', gate.wait)
+    futures = submit_all(scheduler, [('a', 'normal', 1)] * 3 + [('b', 'normal', 1)] * 3, started)
+    gate.set()
+    for future in futures + [blocker]:
+        future.result()
+    assert started[4:] in [['a', 'b'] * 3, ['b', 'a'] * 3]
+
+def test_errors(scheduler):
+    scheduler, gate = scheduler
+    future = scheduler.submit('a', int, 'not a number')
+    gate.set()
+    with pytest.raises(ValueError):
+        future.result()
+    assert scheduler.submit('a', int, '42').result() == 42
+    with pytest.raises(exceptions.UnexpectedValueError):
+        scheduler.submit('a', int, '42', lane='urgent')
@@ -1,21 +1,41 @@
 import pytest
+import base64
 import json
+import pickle
 from os import path
 
 from wallycore import (
+    tx_get_btc_signature_hash,
+    tx_get_elements_signature_hash,
+    tx_confidential_value_from_satoshi,
+    ec_public_key_from_private_key,
     bip32_key_get_fingerprint,
     bip32_key_from_base58,
     bip32_key_to_base58,
+    bip32_key_get_priv_key,
     tx_get_output_value,
     tx_from_hex,
+    tx_get_input_witness,
+    tx_get_num_inputs,
     WALLY_TX_FLAG_USE_WITNESS,
     BIP32_FLAG_KEY_PRIVATE
 )
 
 from ssm.core import (
+    get_address_from_path,
+    get_p2wpkh_script,
     get_child_from_path,
+    get_key_plan,
+    get_script_code,
+    get_sighash_engine,
+    get_tx_from_hex,
+    check_tx,
+    MAX_TX_SIZE,
+    sign_tx_v2,
     sign_tx,
+    unpack_signatures,
     restore_hd_wallet,
+    SIGN_STATS,
 )
 
 from ssm.util import (
@@ -24,9 +44,15 @@ from ssm.util import (
     harden,
     parse_path,
     save_masterkey_to_disk,
+    btc2sat,
+    tx_input_has_witness,
 )
 
+from ssm.sighash import SIGHASH_TYPES
+
+import ssm.address_index as address_index
 import ssm.exceptions as exceptions
+import ssm.parallel as parallel
 
 CHAINS = ['bitcoin-regtest', 'elements-regtest']
 BTC_VECTORS = path.join(path.dirname(path.realpath(__file__)), "sign_tx_btc_test_vectors.json")
@@ -126,3 +152,196 @@ def test_sign_elements(sign_tx_elements_test_vectors, tmpdir):
           raise ValueError("Provided unsigned and signed tx are identical")
         tx_out = sign_tx(k, prev_tx, fingerprints, paths, values, keys_dir)
         assert tx_out == case["signed_tx"][0]
+
+@pytest.fixture
+def parallel_signing():
+    workers, threshold = parallel.SIGN_WORKERS, parallel.SIGN_THRESHOLD
+    parallel.configure(workers=2, threshold=1)
+    yield
+    parallel.configure(workers=workers, threshold=threshold)
+
+def test_sign_parallel(sign_tx_btc_test_vectors, sign_tx_elements_test_vectors, parallel_signing, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    vectors = {**sign_tx_btc_test_vectors, **sign_tx_elements_test_vectors}
+    for k, v in vectors.items():
+      for case in v:
+        fingerprints, paths, values, prev_tx = prepare_signature(k, case.copy(), keys_dir)
+        tx_out = sign_tx(k, prev_tx, fingerprints, paths, values, keys_dir)
+        assert tx_out == case["signed_tx"][0]
+
+def test_key_plan(tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    fingerprint = restore_hd_wallet(CHAINS[0], HDKEY_TEST, None, keys_dir)
+    paths = ["0h/0h/1h", "0h/0h/2h", "0h/0h/1h", "0h/0h/1h"]
+    avoided = SIGN_STATS['derivations_avoided']
+    plan = get_key_plan(CHAINS[0], [fingerprint] * len(paths), paths, keys_dir)
+    assert len(plan) == 2
+    assert SIGN_STATS['derivations_avoided'] == avoided + 2
+    privkey, pubkey, script_code = plan[(fingerprint, "0h/0h/1h")]
+    child = get_child_from_path(CHAINS[0], fingerprint, "0h/0h/1h", keys_dir)
+    assert bytes(privkey) == bytes(bip32_key_get_priv_key(child))
+
+def test_sighash_engine(sign_tx_btc_test_vectors, sign_tx_elements_test_vectors):
+    script_code = get_script_code(ec_public_key_from_private_key(bytes.fromhex(BLINDING_KEY[:64])))
+    vectors = {**sign_tx_btc_test_vectors, **sign_tx_elements_test_vectors}
+    for k, v in vectors.items():
+      for case in v:
+        # Witnesses must not change the sighashes, so check both unsigned and signed tx
+        for tx in [case["prev_tx"][0], case["signed_tx"][0]]:
+          Tx = get_tx_from_hex(k, tx)
+          engine = get_sighash_engine(k, bytes.fromhex(tx))
+          for i, value in enumerate(case["values"]):
+            if k in ['bitcoin-test', 'bitcoin-regtest']:
+              value = btc2sat(float(value))
+              get_expected = tx_get_btc_signature_hash
+            else:
+              try:
+                value = bytearray.fromhex(value)
+              except ValueError:
+                value = tx_confidential_value_from_satoshi(btc2sat(float(value)))
+              get_expected = tx_get_elements_signature_hash
+            # What signing chunks get instead of the whole tx
+            sliced = pickle.loads(pickle.dumps(engine.get_slice([i])))
+            for sighash in SIGHASH_TYPES:
+              expected = get_expected(Tx, i, script_code, value, sighash, WALLY_TX_FLAG_USE_WITNESS)
+              assert engine.get_sighash(i, script_code, value, sighash) == bytes(expected)
+              assert sliced.get_sighash(i, script_code, value, sighash) == bytes(expected)
+
+def prepare_inputs(chain: str, case: dict, keys_dir: str):
+    fingerprints, paths, values, prev_tx = prepare_signature(chain, case, keys_dir)
+    inputs = []
+    for fingerprint, path, value in zip(fingerprints.split(), paths.split(), values.split()):
+      try:
+        value = btc2sat(float(value))
+      except ValueError:
+        pass
+      inputs.append({"fingerprint": fingerprint, "path": path, "value": value})
+    return inputs, prev_tx
+
+def test_sign_tx_v2(sign_tx_btc_test_vectors, sign_tx_elements_test_vectors, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    vectors = {**sign_tx_btc_test_vectors, **sign_tx_elements_test_vectors}
+    for k, v in vectors.items():
+      for case in v:
+        inputs, prev_tx = prepare_inputs(k, case.copy(), keys_dir)
+        assert sign_tx_v2(k, prev_tx, inputs, dir=keys_dir) == case["signed_tx"][0]
+
+        # Skipped inputs are left untouched
+        inputs[0]["skip"] = True
+        tx_out = sign_tx_v2(k, prev_tx, inputs, dir=keys_dir)
+        assert not tx_input_has_witness(get_tx_from_hex(k, tx_out), 0)
+
+def test_sign_tx_v2_script_pubkey(sign_tx_btc_test_vectors, sign_tx_elements_test_vectors, tmpdir, monkeypatch):
+    monkeypatch.setattr(address_index, 'INDEX_ADDRESSES', True)
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    vectors = {**sign_tx_btc_test_vectors, **sign_tx_elements_test_vectors}
+    for k, v in vectors.items():
+      for case in v:
+        inputs, prev_tx = prepare_inputs(k, case.copy(), keys_dir)
+        # Once we gave the address of a key, the script of its outputs is enough to sign them
+        for txin in inputs:
+          _, pubkey, _ = get_address_from_path(k, txin.pop("fingerprint"), txin.pop("path"), keys_dir)
+          txin["script_pubkey"] = get_p2wpkh_script(pubkey).hex()
+        assert sign_tx_v2(k, prev_tx, inputs, dir=keys_dir) == case["signed_tx"][0]
+
+    with pytest.raises(exceptions.UnknownAddressError):
+        sign_tx_v2(k, prev_tx, [dict(inputs[0], script_pubkey="0014" + "00" * 20)] + inputs[1:], dir=keys_dir)
+
+def test_sign_tx_v2_wrong_inputs(sign_tx_btc_test_vectors, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    case = sign_tx_btc_test_vectors[CHAINS[0]][0]
+    inputs, prev_tx = prepare_inputs(CHAINS[0], case.copy(), keys_dir)
+    with pytest.raises(exceptions.MissingValueError):
+        sign_tx_v2(CHAINS[0], prev_tx, inputs + inputs, dir=keys_dir)
+    # Bitcoin values must be integer amounts in satoshis
+    for value in ["1.00000000", 1.0, True, -1]:
+        with pytest.raises(exceptions.UnexpectedValueError):
+            sign_tx_v2(CHAINS[0], prev_tx, [dict(inputs[0], value=value)], dir=keys_dir)
+    with pytest.raises(exceptions.UnexpectedValueError):
+        sign_tx_v2(CHAINS[0], prev_tx, inputs, sighash=4, dir=keys_dir)
+
+def test_sign_tx_signatures_only(sign_tx_btc_test_vectors, sign_tx_elements_test_vectors, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    vectors = {**sign_tx_btc_test_vectors, **sign_tx_elements_test_vectors}
+    for k, v in vectors.items():
+      for case in v:
+        inputs, prev_tx = prepare_inputs(k, case.copy(), keys_dir)
+        # Same witnesses as the signed tx
+        Tx = get_tx_from_hex(k, case["signed_tx"][0])
+        expected = [(i, bytes(tx_get_input_witness(Tx, i, 0)), bytes(tx_get_input_witness(Tx, i, 1)))
+                        for i in range(len(inputs))]
+        signatures = sign_tx_v2(k, prev_tx, inputs, dir=keys_dir, response='signatures')
+        assert [(sig["index"], bytes.fromhex(sig["signature"]), bytes.fromhex(sig["pubkey"]))
+                    for sig in signatures] == expected
+        blob = sign_tx_v2(k, prev_tx, inputs, dir=keys_dir, response='base64')
+        assert unpack_signatures(base64.b64decode(blob)) == expected
+
+        fingerprints, paths, values, prev_tx = prepare_signature(k, case.copy(), keys_dir)
+        assert sign_tx(k, prev_tx, fingerprints, paths, values, keys_dir, response='signatures') == signatures
+
+    with pytest.raises(exceptions.UnexpectedValueError):
+        sign_tx_v2(k, prev_tx, inputs, dir=keys_dir, response='hex')
+    with pytest.raises(exceptions.UnexpectedValueError):
+        unpack_signatures(base64.b64decode(blob)[:-1])
+
+def test_sign_tx_bytes(sign_tx_btc_test_vectors, sign_tx_elements_test_vectors, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    vectors = {**sign_tx_btc_test_vectors, **sign_tx_elements_test_vectors}
+    for k, v in vectors.items():
+      for case in v:
+        inputs, prev_tx = prepare_inputs(k, case.copy(), keys_dir)
+        # Raw transactions, as sent to the binary endpoints, are signed as raw transactions
+        assert sign_tx_v2(k, bytes.fromhex(prev_tx), inputs, dir=keys_dir) == bytes.fromhex(case["signed_tx"][0])
+        blob = sign_tx_v2(k, bytes.fromhex(prev_tx), inputs, dir=keys_dir, response='binary')
+        signatures = sign_tx_v2(k, prev_tx, inputs, dir=keys_dir, response='signatures')
+        assert [i for i, _, _ in unpack_signatures(blob)] == [sig["index"] for sig in signatures]
+
+def test_tx_header(sign_tx_btc_test_vectors, sign_tx_elements_test_vectors):
+    vectors = {**sign_tx_btc_test_vectors, **sign_tx_elements_test_vectors}
+    for k, v in vectors.items():
+      for case in v:
+        for tx in [case["prev_tx"][0], case["signed_tx"][0]]:
+          Tx = get_tx_from_hex(k, tx)
+          header, raw_tx = check_tx(k, tx)
+          assert raw_tx == bytes.fromhex(tx)
+          assert header.num_inputs == tx_get_num_inputs(Tx)
+          assert header.has_witness or tx == case["prev_tx"][0]
+
+def test_tx_header_rejects(sign_tx_btc_test_vectors, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    case = sign_tx_btc_test_vectors[CHAINS[0]][0]
+    inputs, prev_tx = prepare_inputs(CHAINS[0], case.copy(), keys_dir)
+    raw_tx = bytes.fromhex(prev_tx)
+    for tx in ["00" * (MAX_TX_SIZE + 1), "zz" + prev_tx[2:], raw_tx[:4].hex(), (raw_tx[:4] + b'\xfd\xff\xff').hex()]:
+        with pytest.raises(exceptions.UnexpectedValueError):
+            check_tx(CHAINS[0], tx)
+    # Only the header is read, a scriptSig longer than the tx is left to wally
+    tx = raw_tx[:4] + b'\x01' + bytes(36) + b'\xfd\x00\x01' + bytes(2)
+    assert check_tx(CHAINS[0], tx)[0].num_inputs == 1
+
+    # The number of inputs is checked before the rest of the tx is even read
+    tx = (raw_tx[:4] + bytes([len(inputs) + 1]) + bytes(41 * (len(inputs) + 1))).hex()
+    with pytest.raises(exceptions.MissingValueError):
+        sign_tx_v2(CHAINS[0], tx, inputs, dir=keys_dir)
+
+@pytest.fixture
+def chunk_runner():
+    chunks = []
+    def runner(fn, calls):
+        chunks.extend(len(call[-1]) for call in calls)
+        # Chunks are sent to workers, they must only carry their slice of the tx
+        return [fn(*pickle.loads(pickle.dumps(call))) for call in calls]
+    chunk_size = parallel.CHUNK_SIZE
+    parallel.set_runner(runner, 1)
+    yield chunks
+    parallel.set_runner(None, chunk_size)
+
+def test_sign_chunks(sign_tx_btc_test_vectors, sign_tx_elements_test_vectors, chunk_runner, tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    vectors = {**sign_tx_btc_test_vectors, **sign_tx_elements_test_vectors}
+    for k, v in vectors.items():
+      for case in v:
+        inputs, prev_tx = prepare_inputs(k, case.copy(), keys_dir)
+        assert sign_tx_v2(k, prev_tx, inputs, dir=keys_dir) == case["signed_tx"][0]
+    # Every input was signed by its own chunk
+    assert chunk_runner and set(chunk_runner) == {1}
@@ -1,15 +1,29 @@
 import pytest
 from io import BytesIO
 
+from wallycore import (
+    bip32_key_from_base58,
+)
+
+import ssm.cache as cache
+import ssm.exceptions as exceptions
+import ssm.keystore as keystore
+
 from ssm.util import (
     hdkey_to_base58,
     get_masterkey_from_disk,
     harden,
     parse_path,
     save_masterkey_to_disk,
+    migrate_to_keystore,
     read_varint,
 )
 
+from ssm.cache import (
+    LRUCache,
+    MASTERKEY_CACHE,
+)
+
 VARINT = {
     "00": 0, 
     "01": 1,
@@ -26,3 +40,88 @@ def test_read_varint():
     for k, v in VARINT.items():
         res = read_varint(BytesIO(bytes.fromhex(k)))
         assert res == v
+
+CHAIN = "bitcoin-main"
+FINGERPRINT = "3442193e"
+XPRV1 = "xprv9s21ZrQH143K3QTDL4LXw2F7HEK3wJUD2nW2nRk4stbPy6cq3jPPqjiChkVvvNKmPGJxWUtg6LnF5kejMRNNU3TGtRBeJgk33yuGBxrMPHi"
+XPRV2 = "xprv9s21ZrQH143K31xYSDQpPDxsXRTUcvj2iNHm5NUtrGiGG5e2DtALGdso3pGz6ssrdK4PFmM8NSpSBHNqPqm55Qn3LqFtT2emdEXVYsCzC2U"
+
+def test_masterkey_cache(tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    MASTERKEY_CACHE.clear()
+    save_masterkey_to_disk(CHAIN, bip32_key_from_base58(XPRV1), FINGERPRINT, False, keys_dir)
+
+    before = MASTERKEY_CACHE.stats()
+    first = get_masterkey_from_disk(CHAIN, FINGERPRINT, False, keys_dir)
+    second = get_masterkey_from_disk(CHAIN, FINGERPRINT, False, keys_dir)
+    after = MASTERKEY_CACHE.stats()
+    assert hdkey_to_base58(first) == hdkey_to_base58(second) == XPRV1
+    assert after['misses'] == before['misses'] + 1
+    assert after['hits'] == before['hits'] + 1
+
+    # Writing a key under the same fingerprint must not serve the old one
+    save_masterkey_to_disk(CHAIN, bip32_key_from_base58(XPRV2), FINGERPRINT, False, keys_dir)
+    assert hdkey_to_base58(get_masterkey_from_disk(CHAIN, FINGERPRINT, False, keys_dir)) == XPRV2
+
+def test_lru_cache_eviction(monkeypatch):
+    lru = LRUCache(2, ttl=10)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+    # 'b' is now the least recently used entry
+    lru.put('c', 3)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1 and lru.get('c') == 3
+
+    now = cache.monotonic()
+    monkeypatch.setattr(cache, 'monotonic', lambda: now + 11)
+    assert lru.get('a') is None
+    assert lru.stats()['evictions'] == 2
+
+def test_keystore_migration(tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    blinding_key = bytes(range(64))
+    save_masterkey_to_disk(CHAIN, bip32_key_from_base58(XPRV1), FINGERPRINT, False, keys_dir)
+    save_masterkey_to_disk("liquidv1", bip32_key_from_base58(XPRV2), FINGERPRINT, False, keys_dir)
+    save_masterkey_to_disk("liquidv1", blinding_key, FINGERPRINT, True, keys_dir)
+    assert migrate_to_keystore(keys_dir) == 3
+    with pytest.raises(exceptions.UnexpectedValueError):
+        migrate_to_keystore(keys_dir)
+
+    # Keys are now read from the keystore, even if the old files are gone
+    for f in keys_dir.visit(lambda p: p.isfile() and p.basename == FINGERPRINT):
+        f.remove()
+    assert hdkey_to_base58(get_masterkey_from_disk(CHAIN, FINGERPRINT, False, keys_dir)) == XPRV1
+    assert hdkey_to_base58(get_masterkey_from_disk("liquidv1", FINGERPRINT, False, keys_dir)) == XPRV2
+    assert get_masterkey_from_disk("liquidv1", FINGERPRINT, True, keys_dir) == blinding_key
+    with pytest.raises(FileNotFoundError):
+        get_masterkey_from_disk(CHAIN, "00000000", False, keys_dir)
+
+    # Saving again a key appends a record that replaces the previous one
+    save_masterkey_to_disk(CHAIN, bip32_key_from_base58(XPRV2), FINGERPRINT, False, keys_dir)
+    assert hdkey_to_base58(get_masterkey_from_disk(CHAIN, FINGERPRINT, False, keys_dir)) == XPRV2
+    assert not keys_dir.join(CHAIN, FINGERPRINT).exists()
+
+def test_keystore_torn_record(tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    keystore.create_keystore(keys_dir, [])
+    store = keystore.get_keystore(keys_dir)
+    store.put(keystore.MASTERKEY, CHAIN, FINGERPRINT, b'first')
+    # A record cut short by a crash is ignored, and the next append overwrites it
+    with open(store.filename, 'ab') as f:
+        f.write(keystore.pack_record(keystore.MASTERKEY, CHAIN, FINGERPRINT, b'torn')[:50])
+    assert store.get(keystore.MASTERKEY, CHAIN, FINGERPRINT) == b'first'
+    store.put(keystore.MASTERKEY, CHAIN, FINGERPRINT, b'second')
+    assert store.get(keystore.MASTERKEY, CHAIN, FINGERPRINT) == b'second'
+    assert keystore.Keystore(store.filename).get(keystore.MASTERKEY, CHAIN, FINGERPRINT) == b'second'
+
+
+def test_keystore_file_format(tmpdir):
+    keys_dir = tmpdir.mkdir("ssm_keys")
+    keystore.create_keystore(keys_dir, [(keystore.MASTERKEY, CHAIN, FINGERPRINT, b'key')])
+    with open(keys_dir.join(keystore.KEYSTORE_FILE), 'rb') as f:
+        data = f.read()
+    # Files written before the keystore used ssm.records: magic, version and record length, then records
+    assert data[:16] == b'SSMK\x01' + (128).to_bytes(2, 'little') + bytes(9)
+    assert data[16:] == keystore.pack_record(keystore.MASTERKEY, CHAIN, FINGERPRINT, b'key')
+    assert len(data) == 16 + 128